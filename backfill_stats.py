@@ -0,0 +1,10 @@
+import logging
+
+from db import create_table, rebuild_source_aggregates
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+# Пересборка агрегатов /sourcestats из полной истории stats_log
+create_table()
+days = rebuild_source_aggregates()
+print(f'Агрегаты по источникам пересобраны: {days} строк источник/день')
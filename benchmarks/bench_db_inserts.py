@@ -0,0 +1,71 @@
+"""Сравнение скорости вставки статистики: до и после ConnectionManager.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_db_inserts [количество строк]
+"""
+import csv
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import db
+
+
+def insert_per_connection(rows):
+    """Старое поведение add_stat_row: новое соединение и commit на каждую строку"""
+    for user_id, full_name, username, action, source, _ in rows:
+        conn = sqlite3.connect('legacy.db')
+        conn.execute('''INSERT INTO stats_log (user_id, full_name, username, action, source)
+                        VALUES (?, ?, ?, ?, ?)''',
+                     (user_id, full_name, username, action, source))
+        conn.commit()
+        conn.close()
+        with open('legacy.csv', 'a', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerow([user_id, full_name, username, action, source, datetime.now().isoformat()])
+
+
+def insert_long_lived(rows):
+    """add_stat_row через долгоживущее настроенное соединение"""
+    for row in rows:
+        db.add_stat_row(*row[:5])
+
+
+def insert_batched(rows, batch_size=200):
+    """Пакетная запись, как ее выполняет StatsWriter"""
+    for i in range(0, len(rows), batch_size):
+        db.add_stat_rows(rows[i:i + batch_size])
+
+
+def measure(name, func, rows):
+    started = time.perf_counter()
+    func(rows)
+    elapsed = time.perf_counter() - started
+    print(f"{name:<40} {len(rows) / elapsed:>12.0f} inserts/sec")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rows = [(i, 'Test User', 'test_user', 'mfo_150k', 'direct', time.time()) for i in range(count)]
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        db.create_table()
+        # Отдельная база с настройками по умолчанию для старого варианта
+        legacy = sqlite3.connect('legacy.db')
+        legacy.execute('''CREATE TABLE stats_log
+                          (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, full_name TEXT,
+                           username TEXT, action TEXT, source TEXT,
+                           timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+        legacy.close()
+
+        print(f"Inserting {count} rows")
+        measure('connect per insert (before)', insert_per_connection, rows)
+        measure('long-lived connection (after)', insert_long_lived, rows)
+        measure('long-lived connection, batched', insert_batched, rows)
+        db.close_db_connections()
+
+
+if __name__ == '__main__':
+    main()
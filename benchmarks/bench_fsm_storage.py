@@ -0,0 +1,63 @@
+"""Задержка get_data/set_data: SQLiteStorage против MemoryStorage.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_fsm_storage [количество пользователей]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+
+import db
+from fsm_storage import SQLiteStorage
+
+
+async def measure(name, storage, users, repeats=5):
+    started = time.perf_counter()
+    for _ in range(repeats):
+        for user in users:
+            await storage.set_data(user=user, data={'last_bot_message_id': user})
+    set_us = (time.perf_counter() - started) / (repeats * len(users)) * 1e6
+
+    started = time.perf_counter()
+    for _ in range(repeats):
+        for user in users:
+            await storage.get_data(user=user)
+    get_us = (time.perf_counter() - started) / (repeats * len(users)) * 1e6
+    print(f"{name:<36} set_data {set_us:>8.2f} us   get_data {get_us:>8.2f} us")
+
+
+async def measure_cold(storage, users):
+    # Каждое обращение - промах кеша и чтение из sqlite
+    started = time.perf_counter()
+    for user in users:
+        await storage.get_data(user=user)
+    get_us = (time.perf_counter() - started) / len(users) * 1e6
+    print(f"{'SQLiteStorage (cold, from sqlite)':<36} {'':<21} get_data {get_us:>8.2f} us")
+
+
+async def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    users = list(range(1, count + 1))
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        db.create_table()
+
+        await measure('MemoryStorage', MemoryStorage(), users)
+
+        storage = SQLiteStorage(max_cached=count)
+        await measure('SQLiteStorage (hot, LRU cache)', storage, users)
+        started = time.perf_counter()
+        await storage.flush()
+        print(f"flush of {count} dirty records: {(time.perf_counter() - started) * 1000:.1f} ms")
+        await storage.close()
+
+        await measure_cold(SQLiteStorage(max_cached=count), users)
+        db.close_db_connections()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,91 @@
+"""Стоимость маршрутизации для каждого callback_data, который отправляет бот.
+
+Сравнивает CallbackRouter.resolve с цепочкой if/elif, которая раньше
+была в callback_handler.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_router [количество повторов]
+"""
+import json
+import sys
+import timeit
+
+from catalog import load_catalog
+from router import CallbackRouter
+
+LEGACY_MFO = ('express', 'urgent', 'amoney', 'rocket', 'nebus', 'dobro', 'finmoll')
+LEGACY_PTS = ('pts_drive', 'pts_kredi', 'pts_cashdrive', 'pts_sovcom')
+
+
+def legacy_resolve(data):
+    """Порядок проверок старого callback_handler"""
+    if data == 'pts_5m':
+        return 'pts_5m'
+    if data == 'start_menu':
+        return 'start_menu'
+    elif data == 'mfo_150k':
+        return 'mfo_150k'
+    elif data.startswith('mfo_'):
+        name = data[len('mfo_'):]
+        for mfo in LEGACY_MFO:
+            if name == mfo:
+                return data
+    elif data.startswith('pts_'):
+        if data in list(LEGACY_PTS):
+            for pts in LEGACY_PTS:
+                if data == pts:
+                    return data
+    elif data.startswith('get_loan_'):
+        name = data.replace('get_loan_', '')
+        if name in list(LEGACY_PTS):
+            return data
+        return data
+    elif data == 'back_to_main':
+        return data
+    elif data == 'pledge_50m':
+        return data
+    elif data == 'help':
+        return data
+    elif data == 'back_to_start':
+        return data
+    elif data == 'get_pledge_loan':
+        return data
+    return None
+
+
+def emitted_callbacks(catalog):
+    """Собирает все callback_data из клавиатур каталога"""
+    keys = set()
+    for markup in list(catalog.keyboards.values()) + [s.reply_markup for s in catalog.screens.values()]:
+        if not markup:
+            continue
+        for row in json.loads(markup)['inline_keyboard']:
+            for button in row:
+                if 'callback_data' in button:
+                    keys.add(button['callback_data'])
+    return sorted(keys)
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    catalog = load_catalog()
+
+    async def handler(callback_query, state, arg):
+        pass
+
+    router = CallbackRouter(fallback=handler)
+    for key in catalog.screens:
+        router.add_exact(key, handler)
+    for prefix in ('get_loan_', 'mfo_', 'pts_'):
+        router.add_prefix(prefix, handler)
+
+    keys = emitted_callbacks(catalog) + ['get_loan_removed_offer', 'unknown_callback']
+    print(f"{'callback_data':<28} {'router ns':>10} {'if/elif ns':>11}")
+    for key in keys:
+        router_ns = timeit.timeit(lambda: router.resolve(key), number=number) / number * 1e9
+        legacy_ns = timeit.timeit(lambda: legacy_resolve(key), number=number) / number * 1e9
+        print(f"{key:<28} {router_ns:>10.0f} {legacy_ns:>11.0f}")
+
+
+if __name__ == '__main__':
+    main()
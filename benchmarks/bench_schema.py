@@ -0,0 +1,94 @@
+"""Размер базы и время запросов: старая таблица stats_log против нормализованной схемы.
+
+Строит базу со старой схемой (свободный текст в каждой строке и
+одноколоночные индексы), переносит ее через db.migrate_legacy_stats
+и сравнивает размер файла и время типичных запросов.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_schema [количество строк]
+"""
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+import db
+
+ACTIONS = ('start', 'start_menu', 'mfo_150k', 'pts_5m', 'mfo_express', 'get_loan_express', 'get_loan_pts_sovcom')
+SOURCES = ('direct', 'vk_ads', 'telegram_channel', 'partner_blog')
+
+
+def build_legacy(path, count, users):
+    conn = sqlite3.connect(path)
+    conn.execute('''CREATE TABLE stats_log
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, full_name TEXT,
+                     username TEXT, action TEXT, source TEXT,
+                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+    conn.execute('CREATE INDEX idx_user_id ON stats_log(user_id)')
+    conn.execute('CREATE INDEX idx_action ON stats_log(action)')
+    conn.execute('CREATE INDEX idx_source ON stats_log(source)')
+    random.seed(42)
+    started = int(time.time()) - 365 * 86400
+    conn.executemany(
+        'INSERT INTO stats_log (user_id, full_name, username, action, source, timestamp) '
+        'VALUES (?, ?, ?, ?, ?, datetime(?, \'unixepoch\'))',
+        ((user, f'Пользователь Тестовый {user}', f'test_user_{user}', random.choice(ACTIONS),
+          random.choice(SOURCES), started + i * 365 * 86400 // count)
+         for i, user in ((i, random.randint(1, users)) for i in range(count))))
+    conn.commit()
+    conn.close()
+
+
+def timed(conn, sql, params, repeats):
+    started = time.perf_counter()
+    for i in range(repeats):
+        conn.execute(sql, params(i)).fetchall()
+    return (time.perf_counter() - started) / repeats * 1000
+
+
+def file_size(path):
+    conn = sqlite3.connect(path)
+    conn.execute('VACUUM')
+    conn.close()
+    return os.path.getsize(path)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    users = max(count // 20, 1)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        build_legacy(db.DB_FILE, count, users)
+        legacy_size = file_size(db.DB_FILE)
+        legacy = sqlite3.connect(db.DB_FILE)
+        user_ms = [timed(legacy, 'SELECT action, source, timestamp FROM stats_log WHERE user_id = ? '
+                                 'ORDER BY timestamp DESC', lambda i: (i % users + 1,), 200)]
+        scan_ms = [timed(legacy, 'SELECT action, COUNT(*) FROM stats_log GROUP BY action', lambda i: (), 3)]
+        legacy.close()
+
+        db.create_table()
+        started = time.perf_counter()
+        db.migrate_legacy_stats(pause=0)
+        migration_s = time.perf_counter() - started
+        conn = db.get_db_connection()
+        user_ms.append(timed(conn, '''SELECT a.name, s.name, datetime(e.ts, 'unixepoch')
+                                      FROM events e
+                                      JOIN actions a ON a.id = e.action_id
+                                      JOIN sources s ON s.id = e.source_id
+                                      WHERE e.user_id = ? ORDER BY e.ts DESC''', lambda i: (i % users + 1,), 200))
+        scan_ms.append(timed(conn, 'SELECT a.name, n FROM (SELECT action_id, COUNT(*) AS n FROM events '
+                                   'GROUP BY action_id) JOIN actions a ON a.id = action_id', lambda i: (), 3))
+        db.close_db_connections()
+        normalized_size = file_size(db.DB_FILE)
+
+    print(f"{count} events, {users} users, migration took {migration_s:.1f}s")
+    print(f"{'':<28} {'stats_log':>12} {'normalized':>12}")
+    print(f"{'file size, MB':<28} {legacy_size / 2 ** 20:>12.1f} {normalized_size / 2 ** 20:>12.1f}")
+    print(f"{'user history query, ms':<28} {user_ms[0]:>12.3f} {user_ms[1]:>12.3f}")
+    print(f"{'count by action, ms':<28} {scan_ms[0]:>12.1f} {scan_ms[1]:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
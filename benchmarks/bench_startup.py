@@ -0,0 +1,165 @@
+"""Холодный старт бота: время от запуска процесса до ответа на первый update.
+
+Поднимает локальный фиктивный Bot API (TELEGRAM_API_URL), запускает
+`python bot.py` во временном каталоге и, как только открылся порт,
+отправляет в вебхук /start. Для каждого запуска печатается, когда
+закончились импорты (первая строка лога бота), когда сервер начал
+принимать вебхуки, когда бот ответил на первый update (sendMessage) и
+какие запросы к Telegram он сделал до ответа и за весь запуск. Каждый ответ
+фиктивного Bot API задерживается на время сетевого запроса к настоящему
+(по умолчанию 150 мс). Первый запуск идет на пустой базе, остальные -
+на уже созданной.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_startup [количество запусков] [задержка Bot API, мс]
+"""
+import asyncio
+import json
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+from aiohttp import ClientSession, web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = '123456:bench'
+USER = {'id': 42, 'is_bot': False, 'first_name': 'Bench'}
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'Bot', 'username': 'bench_bot'}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class FakeBotApi:
+    """Отвечает на любые методы Bot API с задержкой latency и запоминает время каждого запроса.
+
+    Адрес вебхука хранится между запусками бота, как в настоящем Telegram.
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.webhook_url = ''
+        self.calls = []
+        self.replied = asyncio.Event()
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        self.calls.append((time.perf_counter(), method))
+        await asyncio.sleep(self.latency)
+        if method == 'sendMessage':
+            self.replied.set()
+            result = {'message_id': 1, 'date': int(time.time()), 'chat': {'id': USER['id'], 'type': 'private'},
+                      'from': BOT_USER, 'text': 'ok'}
+        elif method == 'getWebhookInfo':
+            result = {'url': self.webhook_url, 'has_custom_certificate': False, 'pending_update_count': 0}
+        elif method in ('setWebhook', 'deleteWebhook'):
+            self.webhook_url = (await request.post()).get('url', '')
+            result = True
+        elif method == 'getMe':
+            result = BOT_USER
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+
+async def read_log(stream, marks, started, webhook_ready):
+    while True:
+        line = await stream.readline()
+        if not line:
+            return
+        now = time.perf_counter() - started
+        marks.setdefault('imports', now)
+        if b'Webhook server listening' in line:
+            marks.setdefault('listening', now)
+        if 'Webhook установлен'.encode() in line or 'Webhook уже установлен'.encode() in line:
+            webhook_ready.set()
+
+
+async def wait_listening(port, timeout=30):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.002)
+    raise TimeoutError(f"bot did not open port {port} in {timeout}s")
+
+
+async def run_once(workdir, port, api_url, api):
+    env = dict(os.environ, API_TOKEN=TOKEN, PORT=str(port), TELEGRAM_API_URL=api_url,
+               WEBHOOK_URL=f'http://127.0.0.1:{port}')
+    api.calls.clear()
+    api.replied.clear()
+    marks = {}
+    started = time.perf_counter()
+    proc = await asyncio.create_subprocess_exec(sys.executable, os.path.join(ROOT, 'bot.py'), cwd=workdir, env=env,
+                                                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    webhook_ready = asyncio.Event()
+    log_task = asyncio.create_task(read_log(proc.stderr, marks, started, webhook_ready))
+    try:
+        await wait_listening(port)
+        marks['port_open'] = time.perf_counter() - started
+        update = {'update_id': int(time.time() * 1000) % 2 ** 31,
+                  'message': {'message_id': 1, 'date': int(time.time()), 'from': USER,
+                              'chat': {'id': USER['id'], 'type': 'private'}, 'text': '/start bench',
+                              'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]}}
+        async with ClientSession() as session:
+            async with session.post(f'http://127.0.0.1:{port}/webhook', data=json.dumps(update),
+                                    headers={'Content-Type': 'application/json'}) as response:
+                response.raise_for_status()
+        await asyncio.wait_for(api.replied.wait(), 30)
+        replied_at = next(at for at, method in api.calls if method == 'sendMessage')
+        marks['first_reply'] = replied_at - started
+        marks['calls_before_reply'] = [method for at, method in api.calls if at < replied_at]
+        # Фоновая установка вебхука должна завершиться до остановки, иначе следующий запуск ее повторит
+        await asyncio.wait_for(webhook_ready.wait(), 30)
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        await proc.wait()
+        await log_task
+    marks['calls'] = [method for at, method in api.calls]
+    return marks
+
+
+async def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.15
+    api = FakeBotApi(latency)
+    app = web.Application()
+    app.router.add_route('POST', '/bot{token}/{method}', api.handle)
+    api_runner = web.AppRunner(app)
+    await api_runner.setup()
+    api_port = free_port()
+    await web.TCPSite(api_runner, '127.0.0.1', api_port).start()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        shutil.copy(os.path.join(ROOT, 'offers.json'), tmp)
+        if os.path.isdir(os.path.join(ROOT, 'images')):
+            shutil.copytree(os.path.join(ROOT, 'images'), os.path.join(tmp, 'images'))
+        # Порт (и адрес вебхука) один на все запуски, как у сервиса на Render
+        port = free_port()
+        for i in range(runs):
+            results.append(await run_once(tmp, port, f'http://127.0.0.1:{api_port}', api))
+    await api_runner.cleanup()
+
+    print(f"{'run':<10} {'imports, s':>11} {'listening, s':>13} {'first reply, s':>15}  "
+          f"Telegram calls before reply / all calls")
+    for i, marks in enumerate(results):
+        name = 'empty db' if i == 0 else f'warm {i}'
+        print(f"{name:<10} {marks.get('imports', 0):>11.3f} {marks.get('listening', marks['port_open']):>13.3f} "
+              f"{marks['first_reply']:>15.3f}  {', '.join(marks['calls_before_reply']) or '-'} / "
+              f"{', '.join(marks['calls'])}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,168 @@
+"""Проверка планов запросов db.py на большой базе.
+
+Заполняет временную базу (по умолчанию 2 000 000 событий и три месяца
+истории, старые месяцы уходят в архив), вызывает функции db.py и
+перехватывает все выполненные ими запросы. Для каждого запроса
+печатается EXPLAIN QUERY PLAN. Если у горячего запроса (он выполняется
+на каждый update или команду) в плане есть полный проход по таблице
+или временное B-дерево, скрипт завершается с кодом 1. Запросы
+обслуживания (пересборка агрегатов, экспорт, очистка) только печатаются.
+
+Запуск из корня репозитория:
+    python -m benchmarks.query_plans [количество событий]
+"""
+import os
+import re
+import sys
+import tempfile
+import time
+
+import db
+
+ACTIONS = ('start', 'start_menu', 'mfo_150k', 'pts_5m', 'mfo_express', 'get_loan_express', 'get_loan_pts_sovcom')
+SOURCES = ('direct', 'vk_ads', 'telegram_channel', 'partner_blog')
+HISTORY_DAYS = 90
+
+SKIPPED = re.compile(r'\s*(PRAGMA|BEGIN|COMMIT|ROLLBACK|CREATE|DROP|ATTACH|DETACH|VACUUM|SAVEPOINT|RELEASE)\b', re.I)
+# Полный проход по таблице или индексу и сортировка во временном B-дереве
+BAD_PLAN = re.compile(r'^SCAN |TEMP B-TREE')
+# Полный проход допустим только по покрывающему индексу source_totals:
+# в ней по строке на источник, а запрос читает их все
+ALLOWED_SCANS = ('USING COVERING INDEX idx_source_totals_total', 'USING COVERING INDEX sqlite_autoindex_source_totals_1')
+
+
+def seed(count):
+    users = max(count // 20, 1)
+    now = int(time.time())
+    started = now - HISTORY_DAYS * 86400
+    db.create_table()
+    conn = db.get_db_connection()
+    conn.executemany('INSERT INTO actions (name) VALUES (?)', [(name,) for name in ACTIONS])
+    conn.executemany('INSERT INTO sources (name) VALUES (?)', [(name,) for name in SOURCES])
+    conn.execute('''
+        WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?)
+        INSERT INTO events (id, user_id, action_id, source_id, ts)
+        SELECT i, abs(random()) % ? + 1, abs(random()) % ? + 1, abs(random()) % ? + 1, ? + i * ? / ?
+        FROM n
+    ''', (count, users, len(ACTIONS), len(SOURCES), started, HISTORY_DAYS * 86400, count))
+    conn.execute('''
+        WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?)
+        INSERT INTO users (user_id, full_name, username, updated_at)
+        SELECT i, 'Пользователь ' || i, 'user_' || i, ? FROM n
+    ''', (users, now))
+    conn.execute('''
+        WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?)
+        INSERT INTO user_first_interaction (user_id, first_interaction_time, next_reminder_at)
+        SELECT i, datetime(? - i * 60, 'unixepoch'), CASE WHEN i % 10 = 0 THEN ? + i ELSE NULL END FROM n
+    ''', (users, now, now))
+    conn.execute('''
+        WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?)
+        INSERT INTO pending_events (user_id, event_type, event_data, created_at, processed)
+        SELECT i % ? + 1, 'start', '{}', datetime(? - i * 60, 'unixepoch'), i > 100 FROM n
+    ''', (count // 10, users, now))
+    conn.commit()
+    db.rebuild_source_aggregates()
+    db.seal_stats_months()
+    return users, now
+
+
+def explain(conn, sql):
+    """План запроса; запросы к архиву разбираются на подключенном архиве"""
+    if 'archive.' not in sql:
+        return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql)]
+    with db.attached_archive(conn, db.archived_months()[-1]):
+        return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql)]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        started = time.perf_counter()
+        users, now = seed(count)
+        print(f"Seeded {count} events, {users} users, archives {db.archived_months()} "
+              f"in {time.perf_counter() - started:.1f}s\n")
+
+        conn = db.get_db_connection()
+        user_id = 7
+        page = db.get_user_stats_page(user_id, 20)
+        cursor = (page[-1]['timestamp'], page[-1]['id'])
+        today = time.strftime('%Y-%m-%d', time.gmtime(now))
+        month_ago = time.strftime('%Y-%m-%d', time.gmtime(now - 45 * 86400))
+
+        # (название, вызов, горячий запрос)
+        scenarios = [
+            ('add_stat_rows', lambda: db.add_stat_rows([(user_id, 'Новое Имя', 'new', 'get_loan_new', 'new_source', now)]), True),
+            ('get_source_stats', lambda: db.get_source_stats(), True),
+            ('get_source_stats range', lambda: db.get_source_stats(month_ago, today), True),
+            ('get_user_stats', lambda: db.get_user_stats(user_id), True),
+            ('get_user_stats range', lambda: db.get_user_stats(user_id, month_ago, today), True),
+            ('get_user_stats_page', lambda: db.get_user_stats_page(user_id, 20), True),
+            ('get_user_stats_page before', lambda: db.get_user_stats_page(user_id, 20, before=cursor), True),
+            ('get_user_stats_page after', lambda: db.get_user_stats_page(user_id, 20, after=cursor), True),
+            ('add_user_first_interaction', lambda: db.add_user_first_interaction(users + 1), True),
+            ('get_due_reminders', lambda: db.get_due_reminders(now + 3600), True),
+            ('get_reminder_states', lambda: db.get_reminder_states([1, 2, 3]), True),
+            ('mark_reminders_sent', lambda: db.mark_reminders_sent([(1, 1), (2, 10)]), True),
+            ('reschedule_reminders', lambda: db.reschedule_reminders([(3, now + 60)]), True),
+            ('mark_users_blocked', lambda: db.mark_users_blocked([4]), True),
+            ('add_pending_event', lambda: db.add_pending_event(1, 'start', '{}'), True),
+            ('get_unprocessed_pending_events', lambda: db.get_unprocessed_pending_events(limit=100), True),
+            ('mark_pending_events_processed', lambda: db.mark_pending_events_processed([1, 2]), True),
+            ('save_media_file_id', lambda: db.save_media_file_id('images/a.jpg', 'hash', 'file_id'), True),
+            ('get_fsm_record', lambda: db.get_fsm_record('1', '1'), True),
+            ('save_fsm_records', lambda: db.save_fsm_records([('1', '1', 'state', '{}', '{}'),
+                                                              ('2', '2', None, '{}', '{}')]), True),
+            ('get_bot_state', lambda: db.get_bot_state('last_update_id'), True),
+            ('set_bot_state', lambda: db.set_bot_state('last_update_id', 1), True),
+            ('get_funnel_days', lambda: db.get_funnel_days(month_ago, today), True),
+            ('get_funnel_days source', lambda: db.get_funnel_days(month_ago, today, 'vk_ads'), True),
+            ('get_funnel_convert_times', lambda: db.get_funnel_convert_times(month_ago, today, 'vk_ads'), True),
+            ('get_reminder_cohorts', lambda: db.get_reminder_cohorts(24, month_ago), True),
+            ('get_media_cache', lambda: db.get_media_cache(), False),
+            ('update_reminder_cohorts', lambda: db.update_reminder_cohorts(now=now + 4 * 86400), False),
+            ('update_funnel', lambda: db.update_funnel(
+                lambda action: 'get_loan' if action.startswith('get_loan_') else None), False),
+            ('iter_stat_rows', lambda: list(db.iter_stat_rows(count - 1000)), False),
+            ('prune_pending_events', lambda: db.prune_pending_events(30), False),
+            ('seal_stats_months', lambda: db.seal_stats_months(), False),
+            ('rebuild_source_aggregates', lambda: db.rebuild_source_aggregates(), False),
+        ]
+
+        statements = []
+        for name, call, hot in scenarios:
+            conn.set_trace_callback(statements.append)
+            try:
+                call()
+            finally:
+                conn.set_trace_callback(None)
+            seen = set()
+            for sql in statements:
+                # Одинаковые запросы с разными значениями разбираются один раз
+                shape = re.sub(r"'[^']*'|\b\d+\b", '?', ' '.join(sql.split()))
+                shape = re.sub(r'\?(?:\s*,\s*\?)+', '?, ...', shape)
+                if shape in seen or SKIPPED.match(sql):
+                    continue
+                seen.add(shape)
+                plan = explain(conn, sql)
+                bad = hot and any(BAD_PLAN.search(step) and not step.endswith(ALLOWED_SCANS) for step in plan)
+                if bad:
+                    failures.append((name, shape))
+                print(f"{'FAIL' if bad else 'ok  '} [{name}] {shape[:100]}")
+                for step in plan:
+                    print(f"       {step}")
+            statements.clear()
+        db.close_db_connections()
+
+    print()
+    if failures:
+        print(f"{len(failures)} hot queries use a full scan or a temp B-tree:")
+        for name, shape in failures:
+            print(f"  [{name}] {shape[:100]}")
+        sys.exit(1)
+    print("All hot queries use indexes")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,41 @@
 import logging
 from aiogram import Bot, Dispatcher, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.bot.api import TELEGRAM_PRODUCTION, TelegramAPIServer
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
-from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
-from aiogram.utils import executor
+from aiogram.dispatcher.webhook import BOT_DISPATCHER_KEY
+from aiogram.utils.exceptions import BadRequest, MessageNotModified
 from dotenv import load_dotenv
 import os
+import signal
 import asyncio
 import aiohttp
-from datetime import datetime
+from aiohttp import web
+from datetime import datetime, timedelta
+import tempfile
+from collections import Counter
 from db import (
-    create_table, add_stat_row, get_source_stats, get_user_stats,
-    add_user_first_interaction, get_users_for_reminder, mark_reminder_sent,
-    add_pending_event, get_unprocessed_pending_events, mark_pending_event_processed
+    ensure_schema, close_db_connections, get_source_stats, get_user_stats_page,
+    add_user_first_interaction, REMINDER_COHORT_HOURS,
+    add_pending_event, list_tables, migrate_legacy_stats
 )
 import sqlite3
+from stats_writer import StatsWriter
+from csv_log import CsvEventLog
+from db_snapshot import SnapshotCache
+from media_cache import MediaCache
+from catalog import load_catalog
+from router import CallbackRouter
+from reminders import ReminderScheduler
+from pending_replay import PendingReplay
+from maintenance import PendingEventsPruner, StatsArchiver
+from funnel import FunnelTracker
+from cohorts import ReminderCohortTracker
+from update_queue import UpdateQueue
+from dedup import UpdateDeduplicator
+from throttling import CallbackThrottler
+from broadcast import Broadcaster
+from fsm_storage import SQLiteStorage
 
 # Загружаем переменные окружения из .env файла
 load_dotenv()
@@ -36,42 +56,56 @@ if not API_TOKEN:
 
 WEBHOOK_PATH = "/webhook"
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # задаём в Render переменную окружения WEBHOOK_URL
+# Свой сервер Bot API (например, локальный telegram-bot-api); по умолчанию - api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
 
 logger.info("Starting bot initialization...")
 
 # Инициализация бота и диспетчера
-bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
+bot = Bot(token=API_TOKEN,
+          server=TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else TELEGRAM_PRODUCTION)
+storage = SQLiteStorage()
 dp = Dispatcher(bot, storage=storage)
 
+# Повторные доставки одного update'а отбрасываются до хендлеров
+deduplicator = UpdateDeduplicator()
+dp.middleware.setup(deduplicator)
+
+# Окна (секунды) для повторных нажатий одной кнопки: по точному callback_data или префиксу
+CALLBACK_THROTTLE_WINDOWS = {
+    'get_loan_': 2.0,
+    'us:': 0.5,
+}
+throttler = CallbackThrottler(default_window=1.0, windows=CALLBACK_THROTTLE_WINDOWS)
+dp.middleware.setup(throttler)
+
 # Флаг для отслеживания состояния бота
 bot_is_running = False
 
-create_table()
+# Очередь входящих update'ов: вебхук отвечает сразу, обработка идет в фоне
+update_queue = UpdateQueue(dp)
 
-ADMIN_IDS = [1006600764, 130155491]  # Список Telegram user_id админов
+# Фоновая пакетная запись статистики и ее CSV-зеркало с ротацией
+csv_log = CsvEventLog()
+stats_writer = StatsWriter(csv_log=csv_log)
 
-# Информация о МФО
-mfo_info = {
-    'express': ("ЭкспрессДеньги", "0%", "30 000 ₽", "7 дней"),
-    'urgent': ("Срочноденьги", "0%", "30 000 ₽", "7 дней"),
-    'amoney': ("А Деньги", "0%", "30 000 ₽", "7 дней"),
-    'rocket': ("РокетМэн", "0,6%", "30 000 ₽", "7 дней"),
-    'nebus': ("Небус", "от 0,48%", "30 000 ₽", "7 дней"),
-    'dobro': ("Доброзайм", "от 0%", "30 000 ₽", "7 дней"),
-    'finmoll': ("ФИНМОЛЛ", "от 0,59%", "30 000 ₽", "7 дней")
-}
+# Сжатые снимки базы для /getdb
+db_snapshots = SnapshotCache()
 
-# Ссылки на МФО
-mfo_links = {
-    'express': 'https://clck.ru/3M6gGy',
-    'urgent': 'https://trk.ppdu.ru/click/XTQAqAhA?erid=2SDnjc7jaxR',
-    'amoney': 'https://trk.ppdu.ru/click/Z2nIYcGH?erid=LjN8KSUm6',
-    'rocket': 'https://trk.ppdu.ru/click/Zm2xFzSS?erid=2SDnjcXCda4',
-    'nebus': 'https://trk.ppdu.ru/click/jOAljKvs?erid=2SDnjck7R1e',
-    'dobro': 'https://trk.ppdu.ru/click/zub20YhE?erid=LjN8JvgqW',
-    'finmoll': 'https://trk.ppdu.ru/click/wQwFZLCW?erid=2SDnjd4YnrC',
-}
+# Кеш file_id изображений предложений
+media_cache = MediaCache()
+
+# Рассылки с ограничением частоты (~30 msg/s и не чаще 1 msg/s в чат)
+broadcaster = Broadcaster()
+
+# Каталог предложений и меню (загружается один раз)
+catalog = load_catalog()
+# Воронка по источнику первого касания для /funnel
+funnel = FunnelTracker(catalog)
+# Возвраты и конверсии после напоминаний для /remindstats
+reminder_cohorts = ReminderCohortTracker()
+
+ADMIN_IDS = [1006600764, 130155491]  # Список Telegram user_id админов
 
 async def setup_webhook():
     """Устанавливает вебхук"""
@@ -79,11 +113,18 @@ async def setup_webhook():
     try:
         if WEBHOOK_URL:
             webhook_url = WEBHOOK_URL + WEBHOOK_PATH
+            # Вебхук сохраняется в Telegram между перезапусками: если он уже
+            # установлен, не переустанавливаем его и не сбрасываем очередь update'ов
+            webhook_info = await bot.get_webhook_info()
+            if webhook_info.url == webhook_url:
+                logger.info(f"Webhook уже установлен: {webhook_url}")
+                bot_is_running = True
+                return
             await bot.set_webhook(
                 webhook_url,
                 max_connections=100,
                 allowed_updates=["message", "callback_query"],
-                drop_pending_updates=True
+                drop_pending_updates=False
             )
             logger.info(f"Webhook установлен: {webhook_url}")
             bot_is_running = True
@@ -117,54 +158,26 @@ async def check_webhook_health():
             logger.error(f"Ошибка при проверке состояния вебхука: {e}")
             await asyncio.sleep(60)  # При ошибке ждем минуту перед следующей попыткой
 
-logger.info("Bot initialized successfully")
+async def migrate_stats_in_background():
+    """Переносит старую таблицу stats_log в нормализованную схему, не блокируя бота"""
+    try:
+        report = await asyncio.get_running_loop().run_in_executor(None, migrate_legacy_stats)
+        if report:
+            logger.info(f"Stats migration finished: {report['rows_moved']} rows moved in {report['seconds']}s, "
+                        f"{report['size_before']} -> {report['size_after']} bytes")
+    except Exception as e:
+        logger.error(f"Ошибка при миграции статистики: {e}")
+
+async def seal_csv_in_background():
+    """Сжимает CSV-остатки прошлого запуска в пуле потоков, уже после открытия порта"""
+    try:
+        sealed = await asyncio.get_running_loop().run_in_executor(None, csv_log.seal_leftovers)
+        if sealed:
+            logger.info(f"Sealed {sealed} CSV leftovers from the previous run")
+    except Exception as e:
+        logger.error(f"Ошибка при сжатии CSV-остатков: {e}")
 
-# Клавиатуры
-def get_start_menu():
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("🚀 Перейти в меню", callback_data="start_menu"))
-    return keyboard
-
-def get_main_menu():
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("💸 Без залога до 150к", callback_data="mfo_150k"))
-    keyboard.add(InlineKeyboardButton("🚗 Под ПТС до 5млн", callback_data="pts_5m"))
-    keyboard.add(InlineKeyboardButton("🏠 Под недвижимость до 50м", callback_data="pledge_50m"))
-    keyboard.add(InlineKeyboardButton("◀️ Назад", callback_data="back_to_start"))
-    return keyboard
-
-def get_mfo_menu():
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("⚡️ ЭкспрессДеньги 0%", callback_data="mfo_express"))
-    keyboard.add(InlineKeyboardButton("⚡️ Срочноденьги 0%", callback_data="mfo_urgent"))
-    keyboard.add(InlineKeyboardButton("⚡️ А Деньги 7 дней 0%", callback_data="mfo_amoney"))
-    keyboard.add(InlineKeyboardButton("⚡️ РокетМэн 0,6%", callback_data="mfo_rocket"))
-    keyboard.add(InlineKeyboardButton("⚡️ Небус от 0,48%", callback_data="mfo_nebus"))
-    keyboard.add(InlineKeyboardButton("⚡️ Доброзайм от 0%", callback_data="mfo_dobro"))
-    keyboard.add(InlineKeyboardButton("⚡️ ФИНМОЛЛ от 0,59%", callback_data="mfo_finmoll"))
-    keyboard.add(InlineKeyboardButton("◀️ Назад", callback_data="back_to_main"))
-    return keyboard
-
-def get_loan_keyboard(mfo_name: str):
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("📝 Получить займ", callback_data=f"get_loan_{mfo_name}"))
-    keyboard.add(InlineKeyboardButton("◀️ Назад к списку МФО", callback_data="mfo_150k"))
-    return keyboard
-
-def get_pts_keyboard():
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("⚡️ Драйв от 2% в мес.", callback_data="pts_drive"))
-    keyboard.add(InlineKeyboardButton("⚡️ Креди от 3% в мес.", callback_data="pts_kredi"))
-    keyboard.add(InlineKeyboardButton("⚡️ КэшДрайв от 1,7% в мес.", callback_data="pts_cashdrive"))
-    keyboard.add(InlineKeyboardButton("⚡️ Совком от 1,5% в мес.", callback_data="pts_sovcom"))
-    keyboard.add(InlineKeyboardButton("◀️ Назад", callback_data="back_to_main"))
-    return keyboard
-
-def get_pledge_keyboard():
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("📝 Получить кредит", callback_data="get_pledge_loan"))
-    keyboard.add(InlineKeyboardButton("◀️ Назад", callback_data="back_to_main"))
-    return keyboard
+logger.info("Bot initialized successfully")
 
 # Хендлеры
 @dp.message_handler(commands=['start'])
@@ -174,19 +187,12 @@ async def cmd_start(message: types.Message):
         full_name = user.full_name or f"{user.first_name or ''} {user.last_name or ''}".strip()
         args = message.get_args()
         source = args if args else 'direct'
-        add_user_first_interaction(user.id)
-        welcome_message = (
-            f"Привет, {full_name}. Вы находитесь в Финансовом Агрегаторе.\n\n"
-            "Мы собрали для вас лучшие финансовые решения с наиболее выгодными условиями, чтобы помочь вам в важных моментах. В нашем ассортименте:\n\n"
-            "🔍 Займы от МФО без залога — быстро и удобно.\n"
-            "🔍 Займы под залог авто или недвижимости — надежные решения для получения необходимой суммы.\n"
-            "🔍 И другие финансовые инструменты с оптимальными условиями, чтобы каждый нашел подходящий вариант.\n\n"
-            "Изучите доступные предложения и выберите то, что соответствует вашим потребностям. Мы здесь, чтобы помочь вам сделать правильный выбор!"
-        )
-        msg = await message.answer(welcome_message, reply_markup=get_start_menu())
+        reminder_scheduler.schedule(user.id, add_user_first_interaction(user.id))
+        welcome = catalog.screen('back_to_start')
+        msg = await message.answer(catalog.render(welcome, full_name), reply_markup=welcome.reply_markup)
         logger.info(f"Start message sent to user {user.id} from source: {source}")
         await dp.storage.set_data(user=user.id, data={'start_message_sent': True, 'last_bot_message_id': msg.message_id})
-        add_stat_row(user.id, user.full_name, user.username, 'start', source)
+        stats_writer.add(user.id, user.full_name, user.username, 'start', source)
     except Exception as e:
         logger.error(f"Error in start command handler: {e}")
         # Сохраняем событие, если не удалось ответить
@@ -195,461 +201,173 @@ async def cmd_start(message: types.Message):
         except Exception as db_e:
             logger.error(f"Error saving pending start event: {db_e}")
 
+async def send_screen(chat_id, screen, full_name=''):
+    """Отправляет экран каталога: фото, если оно есть, иначе текст"""
+    text = catalog.render(screen, full_name)
+    if screen.image:
+        try:
+            msg = await media_cache.send_photo(
+                bot,
+                chat_id=chat_id,
+                name=screen.image,
+                caption=text,
+                reply_markup=screen.reply_markup,
+                parse_mode=screen.parse_mode
+            )
+            if msg is not None:
+                return msg
+            logger.info(f"No image found for {screen.key}, sending text message")
+        except Exception as e:
+            # Пробуем отправить хотя бы текстовое сообщение
+            logger.error(f"Error sending photo for {screen.key}: {e}")
+    return await bot.send_message(
+        chat_id=chat_id,
+        text=text,
+        reply_markup=screen.reply_markup,
+        parse_mode=screen.parse_mode
+    )
+
+async def delete_message_safe(chat_id, message_id, description):
+    """Удаляет сообщение, не прерывая обработку при ошибке"""
+    try:
+        await bot.delete_message(chat_id=chat_id, message_id=message_id)
+        logger.info(f"Deleted {description} message {message_id}")
+    except Exception as e:
+        if "Message to delete not found" in str(e):
+            logger.info(f"{description.capitalize()} message was already deleted")
+        else:
+            logger.error(f'Ошибка при удалении сообщения {message_id}: {e}')
+
+# Счетчики навигации: каким способом выполнен переход и между какими типами сообщений
+navigation_paths = Counter()
+navigation_transitions = Counter()
+
+def screen_kind(screen):
+    """Тип сообщения, которым показывается экран: фото или текст"""
+    return 'photo' if screen.image and media_cache.find_image(screen.image) else 'text'
+
+async def edit_screen(message, screen, full_name=''):
+    """Показывает экран в уже отправленном сообщении.
+
+    Возвращает способ редактирования или None, если тип содержимого
+    меняется (текст <-> фото) и сообщение нужно отправить заново.
+    """
+    text = catalog.render(screen, full_name)
+    chat_id = message.chat.id
+    kind = screen_kind(screen)
+    if message.photo:
+        if kind != 'photo':
+            return None
+        await media_cache.edit_photo(
+            bot,
+            chat_id=chat_id,
+            message_id=message.message_id,
+            name=screen.image,
+            caption=text,
+            reply_markup=screen.reply_markup,
+            parse_mode=screen.parse_mode
+        )
+        return 'edit_media'
+    if kind != 'text':
+        return None
+    current_text = message.html_text if screen.parse_mode == 'HTML' else message.text
+    if current_text == text:
+        # Текст тот же - меняем только клавиатуру
+        await bot.edit_message_reply_markup(
+            chat_id=chat_id,
+            message_id=message.message_id,
+            reply_markup=screen.reply_markup
+        )
+        return 'edit_markup'
+    await bot.edit_message_text(
+        text=text,
+        chat_id=chat_id,
+        message_id=message.message_id,
+        reply_markup=screen.reply_markup,
+        parse_mode=screen.parse_mode
+    )
+    return 'edit_text'
+
+async def show_screen(callback_query: types.CallbackQuery, state: FSMContext, key: str):
+    """Показывает экран каталога вместо текущего сообщения.
+
+    По возможности сообщение редактируется на месте; отправка нового
+    и удаление старого остаются только для смены типа содержимого.
+    """
+    screen = catalog.screen(key)
+
+    # Получаем id предыдущего сообщения, если есть
+    data_state = await state.get_data()
+    last_bot_message_id = data_state.get('last_bot_message_id')
+    logger.info(f"Last message ID: {last_bot_message_id}")
+
+    user = callback_query.from_user
+    message = callback_query.message
+    chat_id = message.chat.id
+    if screen.track:
+        stats_writer.add(user.id, user.full_name, user.username, screen.track)
+
+    transition = f"{'photo' if message.photo else 'text'}->{screen_kind(screen)}"
+    path = None
+    # Ответ на callback не зависит от результата - отправляем его параллельно
+    answer = asyncio.create_task(callback_query.answer())
+    try:
+        try:
+            path = await edit_screen(message, screen, user.full_name)
+        except MessageNotModified:
+            path = 'not_modified'
+        except BadRequest as e:
+            logger.warning(f"Can't edit message {message.message_id}, sending a new one: {e}")
+            navigation_paths['edit_failed'] += 1
+
+        tasks = []
+        current_id = message.message_id
+        if path is None:
+            path = 'resend'
+            msg = await send_screen(chat_id, screen, user.full_name)
+            current_id = msg.message_id
+            # Удаляем текущее сообщение только после успешной отправки нового
+            tasks.append(delete_message_safe(chat_id, message.message_id, 'current'))
+        if last_bot_message_id and last_bot_message_id not in (message.message_id, current_id):
+            tasks.append(delete_message_safe(chat_id, last_bot_message_id, 'previous'))
+        if current_id != last_bot_message_id:
+            await state.update_data(last_bot_message_id=current_id)
+        await asyncio.gather(*tasks)
+    finally:
+        # Ответ на callback забираем при любом исходе, иначе его ошибка останется
+        # непрочитанной, если показ экрана упал (NetworkError, RetryAfter и т.п.)
+        (answered,) = await asyncio.gather(answer, return_exceptions=True)
+        if isinstance(answered, Exception):
+            logger.warning(f"Can't answer callback {callback_query.id}: {answered}")
+
+    navigation_paths[path] += 1
+    navigation_transitions[f"{transition}:{path}"] += 1
+
+async def offer_unavailable(callback_query: types.CallbackQuery, state: FSMContext, offer_id: str):
+    """Кнопка предложения, которого уже нет в каталоге (старое сообщение)"""
+    logger.warning(f"Offer is not in catalog: {callback_query.data}")
+    await callback_query.answer('Это предложение больше недоступно', show_alert=True)
+
+async def unknown_callback(callback_query: types.CallbackQuery, state: FSMContext, data: str):
+    """Быстрый ответ на неизвестный callback_data"""
+    logger.warning(f"Unknown callback_data: {data}")
+    await callback_query.answer()
+
+# Маршруты callback_data: экраны каталога - точные ключи,
+# остальные кнопки предложений - по префиксу
+router = CallbackRouter(fallback=unknown_callback)
+for screen_key in catalog.screens:
+    router.add_exact(screen_key, show_screen)
+for offer_prefix in ('get_loan_', 'mfo_', 'pts_'):
+    router.add_prefix(offer_prefix, offer_unavailable)
+
 @dp.callback_query_handler(lambda c: True)
 async def callback_handler(callback_query: types.CallbackQuery, state: FSMContext):
     data = callback_query.data
     logger.info(f"Received callback_data: {data}")
     logger.info(f"Processing callback for user {callback_query.from_user.id}")
     try:
-        # Получаем id предыдущего сообщения, если есть
-        data_state = await state.get_data()
-        last_bot_message_id = data_state.get('last_bot_message_id')
-        logger.info(f"Last message ID: {last_bot_message_id}")
-        
-        if data == 'pts_5m':
-            logger.info("Processing pts_5m callback")
-            add_stat_row(callback_query.from_user.id, callback_query.from_user.full_name, callback_query.from_user.username, 'pts_5m')
-            # Отправляем новое сообщение с меню ПТС
-            logger.info("Sending PTS menu message")
-            msg = await bot.send_message(
-                chat_id=callback_query.message.chat.id,
-                text="🚀 Займы под залог ПТС – с минимальными переплатами от лицензированных кредиторов!\n\n"
-                     "Получите деньги быстро и безопасно, сохранив возможность пользоваться своим авто. Мы сотрудничаем только с проверенными компаниями, предлагающими честные условия по залогу транспортных средств.\n\n"
-                     "🔹 Авто остается у вас\n"
-                     "🔹 Минимальные требования к документам\n"
-                     "🔹 Решение за 15 минут\n\n"
-                     "Выбирайте надежного кредитора из нашего тщательно отобранного списка и решайте финансовые вопросы без риска!",
-                reply_markup=get_pts_keyboard()
-            )
-            logger.info(f"Sent PTS menu message with ID: {msg.message_id}")
-            await state.update_data(last_bot_message_id=msg.message_id)
-            
-            # Удаляем предыдущее сообщение только после успешной отправки нового
-            if last_bot_message_id:
-                try:
-                    await bot.delete_message(chat_id=callback_query.message.chat.id, message_id=last_bot_message_id)
-                    logger.info(f"Deleted previous message {last_bot_message_id}")
-                except Exception as e:
-                    logger.error(f'Ошибка при удалении предыдущего сообщения: {e}')
-            
-            # Удаляем текущее сообщение с кнопками
-            try:
-                await callback_query.message.delete()
-                logger.info("Deleted current message with buttons")
-            except Exception as e:
-                logger.error(f'Ошибка при удалении текущего сообщения: {e}')
-        else:
-            # Удаляем предыдущее сообщение, если оно есть
-            if last_bot_message_id:
-                try:
-                    await bot.delete_message(chat_id=callback_query.message.chat.id, message_id=last_bot_message_id)
-                    logger.info(f"Deleted previous message {last_bot_message_id}")
-                except Exception as e:
-                    if "Message to delete not found" in str(e):
-                        logger.info("Previous message was already deleted")
-                    else:
-                        logger.error(f'Ошибка при удалении предыдущего сообщения: {e}')
-            
-            # Удаляем текущее сообщение с кнопками
-            try:
-                await callback_query.message.delete()
-                logger.info("Deleted current message with buttons")
-            except Exception as e:
-                if "Message to delete not found" in str(e):
-                    logger.info("Current message was already deleted")
-                else:
-                    logger.error(f'Ошибка при удалении текущего сообщения: {e}')
-
-            if data == 'start_menu':
-                msg = await bot.send_message(
-                    chat_id=callback_query.message.chat.id,
-                    text="Выбери финпродукт, который тебя интересует:",
-                    reply_markup=get_main_menu()
-                )
-                await state.update_data(last_bot_message_id=msg.message_id)
-            elif data == 'mfo_150k':
-                add_stat_row(callback_query.from_user.id, callback_query.from_user.full_name, callback_query.from_user.username, 'mfo_150k')
-                # Отправляем новое сообщение с меню МФО
-                msg = await bot.send_message(
-                    chat_id=callback_query.message.chat.id,
-                    text="💫 Быстрые займы с нулевыми процентами от лицензированных МФО! 🚀\n\n"
-                         "Получите займ без переплат, выбрав проверенную организацию из нашего тщательно отобранного списка. Мы обеспечим вас всей необходимой информацией для безопасного и выгодного оформления займа. Доверяйте только надежным компаниям и начните улучшать свое финансовое положение уже сегодня!",
-                    reply_markup=get_mfo_menu()
-                )
-                await state.update_data(last_bot_message_id=msg.message_id)
-            elif data.startswith('mfo_'):
-                mfo_name = data[len('mfo_'):]
-                if mfo_name in mfo_info:
-                    if mfo_name == 'express':
-                        msg = await bot.send_message(
-                            chat_id=callback_query.message.chat.id,
-                            text="💸 <b>ЭкспрессДеньги</b>\n\n"
-                                 "🥇 Первый и 🏅 шестой займ — <b>без процентов</b>!\n"
-                                 "🎁 Постоянные клиенты получают <b>бонусы</b> и привилегии!\n"
-                                 "💰 Кешбэк за выполнение заданий: выполняйте простые задания и получайте возврат!\n\n"
-                                 "<b>Условия:</b>\n"
-                                 "👤 Гражданам РФ от 18 до 70 лет\n"
-                                 "💵 Сумма: от 1 000 до 100 000 ₽ (шаг 1 000 ₽)\n"
-                                 "📆 Срок: до 52 недель\n\n"
-                                 "⚡️ Решение моментально! В случае доп. проверки — до 10-15 минут.\n\n"
-                                 "<b>Тарифы:</b>\n"
-                                 "🆕 Стандартный (новый клиент): от 1 000 до 30 000 ₽ — с 1 по 29 день <b>0%</b>, с 30 дня — 0,6%/день\n"
-                                 "📈 Долгосрочный: от 31 000 до 100 000 ₽ — с 10 по 24 неделю <b>0,6%/день</b>\n",
-                            reply_markup=get_loan_keyboard(mfo_name),
-                            parse_mode='HTML'
-                        )
-                        await state.update_data(last_bot_message_id=msg.message_id)
-                    elif mfo_name == 'urgent':
-                        msg = await bot.send_message(
-                            chat_id=callback_query.message.chat.id,
-                            text="💸 <b>Срочноденьги</b>\n\n"
-                                 "🎉 <b>Ваш кредит — первый заём бесплатно!</b>\n\n"
-                                 "<b>Описание:</b>\n"
-                                 "💵 Сумма займа: от 2 000 до 30 000 ₽\n"
-                                 "📆 Срок займа: до 30 дней\n"
-                                 "🥇 Первый заём бесплатно (до 7 дней)\n\n"
-                                 "<b>Преимущества:</b>\n"
-                                 "💰 Выгодные условия\n"
-                                 "🪪 Только паспорт для оформления\n"
-                                 "⚡️ До 8 минут — и деньги уже на карте!\n\n"
-                                 "<b>Требования к заёмщику:</b>\n"
-                                 "🔞 Возраст: 18–65 лет\n"
-                                 "🇷🇺 Гражданство РФ, паспорт РФ\n"
-                                 "🏠 Регистрация на территории РФ\n\n"
-                                 "🌍 Все регионы РФ, кроме: Крым, Дагестан, Карачаево-Черкессия, Севастополь, Чечня, ДНР, ЛНР.\n",
-                            reply_markup=get_loan_keyboard(mfo_name),
-                            parse_mode='HTML'
-                        )
-                        await state.update_data(last_bot_message_id=msg.message_id)
-                    elif mfo_name == 'amoney':
-                        msg = await bot.send_message(
-                            chat_id=callback_query.message.chat.id,
-                            text="💳 <b>Кредитный лимит от 'А Деньги'</b>\n\n"
-                                 "⚡️ Новый вид заёмных средств: быстрота одобрения как у онлайн-займов и удобство кредитки!\n\n"
-                                 "📝 Подайте заявку, получите лимит и превратите свою дебетовую карту в кредитку!\n"
-                                 "💸 Снимайте наличные, берите любые суммы в рамках лимита, возвращайте частями и пользуйтесь снова!\n\n"
-                                 "<b>Условия простые:</b>\n"
-                                 "🎁 Для новых клиентов первые 7 дней — бесплатно!\n"
-                                 "💸 Далее — всего 8 руб./день за каждую 1 000 ₽, которую перевели себе на карту.\n"
-                                 "📅 Тарификация ежедневная: не пользуетесь — не платите!\n"
-                                 "🟢 Всегда под рукой запас средств на любые случаи.\n\n"
-                                 "<b>Как получить лимит?</b>\n"
-                                 "🪪 Паспорт + дебетовая карта + короткая анкета за 5 минут.\n\n"
-                                 "<b>Условия кредитного лимита:</b>\n"
-                                 "💵 Сумма: до 30 000 ₽\n"
-                                 "📆 Срок лимита: до 30 дней с автопродлением\n"
-                                 "❌ Без поручителей, справок и залога\n\n"
-                                 "<b>Требования к клиенту:</b>\n"
-                                 "🔞 Возраст: 18–75 лет включительно\n"
-                                 "🇷🇺 Гражданство РФ\n",
-                            reply_markup=get_loan_keyboard(mfo_name),
-                            parse_mode='HTML'
-                        )
-                        await state.update_data(last_bot_message_id=msg.message_id)
-                    elif mfo_name == 'rocket':
-                        msg = await bot.send_message(
-                            chat_id=callback_query.message.chat.id,
-                            text="🚀 <b>РокетМЭН</b>\n\n"
-                                 "💵 Размер займа: от 3 000 до 30 000 ₽\n"
-                                 "📆 Срок займа: от 5 до 30 дней\n"
-                                 "💸 Процентная ставка: 0.8% в день\n",
-                            reply_markup=get_loan_keyboard(mfo_name),
-                            parse_mode='HTML'
-                        )
-                        await state.update_data(last_bot_message_id=msg.message_id)
-                    elif mfo_name == 'nebus':
-                        msg = await bot.send_message(
-                            chat_id=callback_query.message.chat.id,
-                            text="🌐 <b>Небус</b>\n\n"
-                                 "<b>Требования к заемщику:</b>\n"
-                                 "🔞 Возраст: от 18 до 88 лет\n"
-                                 "🪪 Паспорт РФ\n\n"
-                                 "<b>Условия получения займов:</b>\n"
-                                 "💵 Сумма: от 7 000 до 100 000 ₽\n"
-                                 "📆 Срок: от 7 до 365 дней\n"
-                                 "💸 Ставка: от 0,48% до 0,8% в день\n\n"
-                                 "⏱️ Срок рассмотрения: 15 минут\n",
-                            reply_markup=get_loan_keyboard(mfo_name),
-                            parse_mode='HTML'
-                        )
-                        await state.update_data(last_bot_message_id=msg.message_id)
-                    elif mfo_name == 'dobro':
-                        msg = await bot.send_message(
-                            chat_id=callback_query.message.chat.id,
-                            text="🤝 <b>Доброзайм</b>\n\n"
-                                 "🏢 Работает на территории РФ с 2011 года. Компания хорошо относится к своим клиентам, выдавая деньги в долг в разных ситуациях.\n\n"
-                                 "<b>Сумма займа:</b> от 1 000 до 100 000 ₽\n"
-                                 "<b>Срок займа:</b> от 4 до 364 дней\n"
-                                 "<b>Ставка:</b> от 0% до 1% в день\n"
-                                 "(под 0% новый и постоянный клиент может получить только на 7 дней)\n\n"
-                                 "<b>Требования к заемщику:</b>\n"
-                                 "🪪 Только паспорт РФ\n"
-                                 "🔞 Возраст: от 19 до 90 лет\n"
-                                 "❌ Без справок, поручителей и залога\n",
-                            reply_markup=get_loan_keyboard(mfo_name),
-                            parse_mode='HTML'
-                        )
-                        await state.update_data(last_bot_message_id=msg.message_id)
-                    elif mfo_name == 'finmoll':
-                        msg = await bot.send_message(
-                            chat_id=callback_query.message.chat.id,
-                            text="🏦 <b>ФИНМОЛЛ</b>\n\n"
-                                 "🌟 Наша миссия — предоставляем лучшие финансовые возможности для хороших людей. Быстро, удобно и доступно в шаге от Вас.\n\n"
-                                 "<b>Сумма займа:</b>\n"
-                                 "🆕 Для нового клиента: от 30 000 до 60 000 ₽\n"
-                                 "🔁 Для повторного клиента: от 30 000 до 200 000 ₽\n\n"
-                                 "<b>Срок займа:</b> до 52 недель (до 364 дней)\n"
-                                 "💳 Платежи: еженедельно\n"
-                                 "💸 Процентная ставка: от 215% до 250% годовых\n"
-                                 "💰 Полная стоимость займа: от 199,073% до 250%\n"
-                                 "❌ Без залога и поручительства\n\n"
-                                 "<b>Требования к заёмщику:</b>\n"
-                                 "🇷🇺 Гражданство РФ\n"
-                                 "🔞 Возраст: 18–70 лет (первичные), 18–75 лет (повторные)\n"
-                                 "💼 Постоянный источник дохода\n"
-                                 "🪪 Оформление по паспорту\n",
-                            reply_markup=get_loan_keyboard(mfo_name),
-                            parse_mode='HTML'
-                        )
-                        await state.update_data(last_bot_message_id=msg.message_id)
-            elif data.startswith('pts_'):
-                mfo_name = data
-                if mfo_name in ["pts_drive", "pts_kredi", "pts_cashdrive", "pts_sovcom"]:
-                    loan_keyboard = InlineKeyboardMarkup()
-                    loan_keyboard.add(InlineKeyboardButton("📝 Получить займ", callback_data=f"get_loan_{mfo_name}"))
-                    loan_keyboard.add(InlineKeyboardButton("◀️ Назад к списку кредиторов", callback_data="pts_5m"))
-                    if mfo_name == "pts_drive":
-                        text = (
-                            "💳 <b>Драйв</b> — онлайн на банковскую карту.\n\n"
-                            "🚗 <b>Обеспечение:</b>\n"
-                            "В качестве залога принимаются легковые и грузовые автомобили, спецтехника, водный транспорт, мототехника, автобусы. Передаваемое в залог ТС остается у Вас.\n\n"
-                            "📋 <b>Требования к транспортному средству:</b>\n"
-                            "• Рыночная стоимость ТС более 75 000 руб.\n"
-                            "• Регистрация ТС в РФ\n"
-                            "• VIN номер без дефектов\n"
-                            "• ТС не находится в угоне\n"
-                            "• ТС находится в собственности или с согласия на залог 3-го лица\n"
-                            "• Иномарки не старше 2005 года, отечественные 2010 года\n\n"
-                            "💰 <b>Процентная ставка:</b> от 2 до 7,4% в месяц\n"
-                            "⏳ <b>Срок:</b> 61 — 1094 дн.\n"
-                            "✅ Досрочное погашение без комиссий: Да\n"
-                            "🔄 Продление срока займа: Да"
-                        )
-                    elif mfo_name == "pts_kredi":
-                        text = (
-                            "🏦 <b>Креди</b> — онлайн-займы под залог легковых автомобилей и коммерческого транспорта.\n\n"
-                            "📑 Мы состоим в реестре Центрального Банка РФ и заключаем договоры в соответствии с законодательством.\n"
-                            "🚗 Автомобиль остается в вашей собственности.\n\n"
-                            "📝 <b>Для одобрения потребуется:</b> Паспорт гражданина РФ\n"
-                            "📄 <b>Для заключения договора и выдачи денег:</b> ПТС, СТС\n\n"
-                            "⏱️ Время рассмотрения заявки: 30 минут\n"
-                            "💵 Сумма: от 50 000 до 500 000 рублей\n"
-                            "⏳ Срок займа: от 3 мес до 4 лет, с шагом 1 мес.\n\n"
-                            "🚘 <b>Легковые автомобили категории В:</b>\n"
-                            "• Отечественные — не старше 7 лет\n"
-                            "• Иномарки — не старше 20 лет\n\n"
-                            "🚚 <b>Коммерческий транспорт и грузовые авто:</b>\n"
-                            "• Отечественные — не старше 10 лет\n"
-                            "• Иномарки — не старше 15 лет\n\n"
-                            "💳 <b>Способы получения займа:</b> На банковскую карту, СБП"
-                        )
-                    elif mfo_name == "pts_cashdrive":
-                        text = (
-                            "💸 <b>КэшДрайв</b>\n\n"
-                            "👤 <b>Требования к заёмщику:</b>\n"
-                            "• Гражданство РФ\n"
-                            "• Возраст от 21 до 70 лет\n\n"
-                            "💰 <b>Условия займа:</b>\n"
-                            "• Сумма от 5 000 до 250 000 рублей\n"
-                            "• Срок от 1 до 24 месяцев\n"
-                            "• Ставка от 20% годовых\n\n"
-                            "💳 <b>Способы получения:</b> Онлайн на банковскую карту"
-                        )
-                    elif mfo_name == "pts_sovcom":
-                        text = (
-                            "🏦 <b>Совком</b>\n\n"
-                            "ℹ️ <b>Информация о продукте:</b>\n"
-                            "• ПСК от 14,883 до 14,901%\n"
-                            "• Процентная ставка: 14,9% годовых\n"
-                            "• Сумма: от 150 000 до 15 000 000 руб.\n"
-                            "• Срок: от 12 до 60 месяцев\n\n"
-                            "🌟 <b>Преимущества:</b>\n"
-                            "• Онлайн заявка\n"
-                            "• Получение кредита день в день\n"
-                            "• Кредит на карту или курьером\n"
-                            "• Автомобиль остается у вас\n\n"
-                            "🏷️ <b>Требования к ТС:</b>\n"
-                            "• Не старше 24 лет включительно\n"
-                            "• Технически исправное\n"
-                            "• Не должно находиться в залоге, участвовать в программе автокредитования\n\n"
-                            "📄 <b>Документы для заемщика:</b>\n"
-                            "• Паспорт гражданина РФ\n"
-                            "• Один из документов: СНИЛС, водительское удостоверение\n"
-                            "• Свидетельство о регистрации ТС\n"
-                            "• Паспорт ТС\n"
-                            "• Страховой полис ОСАГО\n"
-                            "• Согласие супруга(-и)"
-                        )
-                    msg = await bot.send_message(
-                        chat_id=callback_query.message.chat.id,
-                        text=text,
-                        reply_markup=loan_keyboard,
-                        parse_mode='HTML'
-                    )
-                    await state.update_data(last_bot_message_id=msg.message_id)
-            elif data.startswith('get_loan_'):
-                mfo_name = data.replace('get_loan_', '')  # Получаем полное имя оператора
-                logger.info(f"Processing get_loan_ callback for {mfo_name}")
-                # Для ПТС-операторов показываем картинку, кнопку с внешней ссылкой и кнопку "Назад к списку кредиторов"
-                if mfo_name in ["pts_drive", "pts_kredi", "pts_cashdrive", "pts_sovcom"]:
-                    try:
-                        logger.info(f"Processing PTS operator: {mfo_name}")
-                        pts_links = {
-                            "pts_drive": "https://slds.pro/az72w",
-                            "pts_kredi": "https://slds.pro/vcdj7",
-                            "pts_cashdrive": "https://slds.pro/hxhbv",
-                            "pts_sovcom": "https://trk.ppdu.ru/click/ELxQqqRu?erid=Kra23xE7N"
-                        }
-                        url = pts_links.get(mfo_name)
-                        if not url:
-                            logger.error(f"URL not found for {mfo_name}")
-                            return
-
-                        logger.info(f"Creating keyboard for {mfo_name} with URL: {url}")
-                        action_keyboard = InlineKeyboardMarkup()
-                        action_keyboard.add(InlineKeyboardButton("✅ ПОЛУЧИТЬ ДЕНЬГИ ЗА ПОЛЧАСА!", url=url))
-                        action_keyboard.add(InlineKeyboardButton("◀️ Назад к списку кредиторов", callback_data="pts_5m"))
-
-                        image_extensions = ['jpg', 'jpeg', 'png']
-                        image_path = None
-                        for ext in image_extensions:
-                            path = f'images/{mfo_name}.{ext}'
-                            if os.path.exists(path):
-                                image_path = path
-                                logger.info(f"Found image at {path}")
-                                break
-
-                        try:
-                            if image_path:
-                                logger.info(f"Sending photo for {mfo_name}")
-                                with open(image_path, 'rb') as photo:
-                                    msg = await bot.send_photo(
-                                        chat_id=callback_query.message.chat.id,
-                                        photo=photo,
-                                        caption=f'Получите займ в {mfo_name.replace("pts_", "").capitalize()}',
-                                        reply_markup=action_keyboard
-                                    )
-                            else:
-                                logger.info(f"No image found for {mfo_name}, sending text message")
-                                msg = await bot.send_message(
-                                    chat_id=callback_query.message.chat.id,
-                                    text=f'Получите займ в {mfo_name.replace("pts_", "").capitalize()}',
-                                    reply_markup=action_keyboard
-                                )
-                            logger.info(f"Message sent successfully for {mfo_name}")
-                            await state.update_data(last_bot_message_id=msg.message_id)
-                        except Exception as e:
-                            logger.error(f"Error sending message/photo for {mfo_name}: {e}")
-                            # Пробуем отправить хотя бы текстовое сообщение
-                            try:
-                                logger.info(f"Attempting to send fallback message for {mfo_name}")
-                                msg = await bot.send_message(
-                                    chat_id=callback_query.message.chat.id,
-                                    text=f'Получите займ в {mfo_name.replace("pts_", "").capitalize()}',
-                                    reply_markup=action_keyboard
-                                )
-                                await state.update_data(last_bot_message_id=msg.message_id)
-                            except Exception as e:
-                                logger.error(f"Error sending fallback message for {mfo_name}: {e}")
-                    except Exception as e:
-                        logger.error(f"Error processing PTS operator {mfo_name}: {e}")
-                else:
-                    # Старое поведение для МФО
-                    link = mfo_links.get(mfo_name)
-                    image_extensions = ['jpg', 'jpeg', 'png']
-                    image_path = None
-                    for ext in image_extensions:
-                        path = f'images/{mfo_name}.{ext}'
-                        if os.path.exists(path):
-                            image_path = path
-                            break
-                    keyboard = InlineKeyboardMarkup()
-                    keyboard.add(InlineKeyboardButton(text='✅ ЗАБРАТЬ ДЕНЬГИ НА КАРТУ', url=link))
-                    keyboard.add(InlineKeyboardButton(text='◀️ Назад к списку МФО', callback_data='mfo_150k'))
-                    if image_path:
-                        with open(image_path, 'rb') as photo:
-                            msg = await bot.send_photo(
-                                chat_id=callback_query.message.chat.id,
-                                photo=photo,
-                                caption=f'Получите займ в {mfo_info[mfo_name][0]}',
-                                reply_markup=keyboard
-                            )
-                    else:
-                        msg = await bot.send_message(
-                            chat_id=callback_query.message.chat.id,
-                            text=f'Получите займ в {mfo_info[mfo_name][0]}',
-                            reply_markup=keyboard
-                        )
-                    await state.update_data(last_bot_message_id=msg.message_id)
-            elif data == 'back_to_main':
-                msg = await bot.send_message(
-                    chat_id=callback_query.message.chat.id,
-                    text="Выбери финпродукт, который тебя интересует:",
-                    reply_markup=get_main_menu()
-                )
-                await state.update_data(last_bot_message_id=msg.message_id)
-            elif data == 'pledge_50m':
-                add_stat_row(callback_query.from_user.id, callback_query.from_user.full_name, callback_query.from_user.username, 'pledge_50m')
-                keyboard = InlineKeyboardMarkup()
-                keyboard.add(InlineKeyboardButton("Оформить займ", url="https://t.me/Odobrenie41Bot"))
-                keyboard.add(InlineKeyboardButton("◀️ Назад", callback_data="back_to_main"))
-                msg = await bot.send_message(
-                    chat_id=callback_query.message.chat.id,
-                    text="🚀 Займы под залог недвижимости – выгодные условия от частного инвестора!\n\n"
-                         "Получите деньги быстро и без лишних сложностей, сохранив право пользоваться своей недвижимостью. Мы предлагаем индивидуальные условия кредитования с минимальной переплатой и гибким графиком погашения.\n\n"
-                         "🔹 Квартира, дом или коммерческая недвижимость в залоге – вы остаетесь собственником\n"
-                         "🔹 Минимум документов – решение в кратчайшие сроки\n"
-                         "🔹 Сделка без банков – быстро, конфиденциально, без бюрократии\n\n"
-                         "Решите финансовые вопросы с надежным частным инвестором – оставьте заявку и получите деньги уже сегодня!",
-                    reply_markup=keyboard
-                )
-                await state.update_data(last_bot_message_id=msg.message_id)
-            elif data == 'help':
-                await callback_query.message.answer(
-                    "ℹ️ Я бот для оформления займов под залог недвижимости. Вот что я могу для вас сделать:\n\n"
-                    "🔹 Оформить заявку – подберу лучшие условия от частных инвесторов\n"
-                    "🔹 Рассчитать сумму – помогу оценить вашу недвижимость и возможный займ\n"
-                    "🔹 Ответить на вопросы – расскажу о требованиях, сроках и документах\n"
-                    "🔹 Связать с инвестором – организую быструю и безопасную сделку\n\n"
-                    "📌 Чтобы начать, выберите нужную опцию в меню или напишите свой вопрос.\n"
-                    "📌Техподдержка и помощь с заявками: <a href='https://t.me/Odobrenie41Bot'>@support_finagr</a>",
-                    parse_mode='HTML'
-                )
-            elif data == 'back_to_start':
-                msg = await bot.send_message(
-                    chat_id=callback_query.message.chat.id,
-                    text=f"Привет, {callback_query.from_user.full_name}. Вы находитесь в Финансовом Агрегаторе.\n\n"
-                         "Мы собрали для вас лучшие финансовые решения с наиболее выгодными условиями, чтобы помочь вам в важных моментах. В нашем ассортименте:\n\n"
-                         "🔍 Займы от МФО без залога — быстро и удобно.\n"
-                         "🔍 Займы под залог авто или недвижимости — надежные решения для получения необходимой суммы.\n"
-                         "🔍 И другие финансовые инструменты с оптимальными условиями, чтобы каждый нашел подходящий вариант.\n\n"
-                         "Изучите доступные предложения и выберите то, что соответствует вашим потребностям. Мы здесь, чтобы помочь вам сделать правильный выбор!",
-                    reply_markup=get_start_menu()
-                )
-                await state.update_data(last_bot_message_id=msg.message_id)
-            elif data == 'get_pledge_loan':
-                msg = await bot.send_message(
-                    chat_id=callback_query.message.chat.id,
-                    text="📝 Для получения кредита под залог недвижимости:\n\n"
-                         "1. Нажмите на кнопку ниже\n"
-                         "2. Заполните анкету\n"
-                         "3. Загрузите документы на недвижимость\n"
-                         "4. Получите решение\n\n"
-                         "⚡️ Среднее время рассмотрения: 1-3 дня",
-                    reply_markup=get_pledge_keyboard()
-                )
-                await state.update_data(last_bot_message_id=msg.message_id)
-            await callback_query.answer()
+        await router.dispatch(callback_query, state)
     except Exception as e:
         logger.error(f"Error in callback handler: {e}")
         # Сохраняем событие, если не удалось ответить
@@ -663,10 +381,13 @@ async def help_command_handler(message: types.Message):
     if message.from_user.id in ADMIN_IDS:
         help_text = (
             "🔧 <b>Команды администратора:</b>\n\n"
-            "/sourcestats - Статистика по источникам трафика\n"
+            "/sourcestats [С ПО] - Статистика по источникам трафика (даты ГГГГ-ММ-ДД)\n"
             "/userstats ID - Статистика по конкретному пользователю\n"
-            "/getstats - Получить файл статистики\n"
-            "/getdb - Получить файл базы данных\n\n"
+            "/funnel [ИСТОЧНИК] [С ПО] - Воронка start → раздел → предложение → get_loan\n"
+            "/remindstats [ЧАСЫ] [С] - Возвраты и конверсии после напоминаний по неделям регистрации\n"
+            "/getstats [С ПО] - Файл статистики за период (по умолчанию 7 дней)\n"
+            "/getdb [таблицы] - Снимок базы данных (.db.gz)\n"
+            "/metrics - Внутренние счетчики бота\n\n"
             "📊 <b>Статистика включает:</b>\n"
             "• Количество переходов\n"
             "• Уникальных пользователей\n"
@@ -686,12 +407,40 @@ async def help_command_handler(message: types.Message):
     
     await message.answer(help_text, parse_mode='HTML')
 
+GETSTATS_DEFAULT_DAYS = 7
+
+def build_stats_export(date_from, date_to):
+    """Собирает gzip-CSV за период во временный файл"""
+    f = tempfile.TemporaryFile()
+    try:
+        csv_log.export(f, date_from, date_to)
+        f.seek(0)
+    except Exception:
+        f.close()
+        raise
+    return f
+
 @dp.message_handler(commands=['getstats'])
 async def send_stats_file(message: types.Message):
     if message.from_user.id in ADMIN_IDS:
         try:
-            with open('stats_log.csv', 'rb') as f:
-                await message.answer_document(types.InputFile(f, filename='stats_log.csv'))
+            # Необязательный диапазон дат: /getstats YYYY-MM-DD [YYYY-MM-DD]
+            args = message.get_args().split()
+            try:
+                dates = [datetime.strptime(arg, '%Y-%m-%d').strftime('%Y-%m-%d') for arg in args[:2]]
+            except ValueError:
+                await message.reply("Формат дат: /getstats ГГГГ-ММ-ДД [ГГГГ-ММ-ДД]")
+                return
+            if dates:
+                date_from, date_to = dates[0], dates[-1]
+            else:
+                today = datetime.now()
+                date_from = (today - timedelta(days=GETSTATS_DEFAULT_DAYS - 1)).strftime('%Y-%m-%d')
+                date_to = today.strftime('%Y-%m-%d')
+            f = await asyncio.get_running_loop().run_in_executor(None, build_stats_export, date_from, date_to)
+            with f:
+                await message.answer_document(
+                    types.InputFile(f, filename=f'stats_log_{date_from}_{date_to}.csv.gz'))
         except Exception as e:
             await message.reply(f'Ошибка при отправке файла: {e}')
     else:
@@ -701,18 +450,66 @@ async def send_stats_file(message: types.Message):
 async def send_db_file(message: types.Message):
     if message.from_user.id in ADMIN_IDS:
         try:
-            with open('stats.db', 'rb') as f:
-                await message.answer_document(types.InputFile(f, filename='stats.db'))
+            # Необязательный список таблиц (представления копируются как таблицы): /getdb stats_log users
+            tables = message.get_args().split()
+            path = await db_snapshots.get(tables)
+            name = '_'.join(sorted(set(tables))) if tables else 'stats'
+            await message.answer_document(types.InputFile(path, filename=f'{name}.db.gz'))
+        except ValueError as e:
+            await message.reply(f'{e}. Доступные таблицы: {", ".join(list_tables())}')
         except Exception as e:
             await message.reply(f'Ошибка при отправке файла: {e}')
     else:
         await message.reply('Нет доступа')
 
+@dp.message_handler(commands=['metrics'])
+async def send_metrics(message: types.Message):
+    if message.from_user.id in ADMIN_IDS:
+        metrics = {
+            'update_queue': update_queue.metrics(),
+            'dedup': deduplicator.metrics(),
+            'throttling': throttler.metrics(),
+            'stats_writer': stats_writer.metrics(),
+            'csv_log': csv_log.metrics(),
+            'db_snapshots': db_snapshots.metrics(),
+            'navigation': {
+                'paths': dict(navigation_paths),
+                'transitions': dict(navigation_transitions),
+            },
+            'media_cache': media_cache.metrics(),
+            'reminders': reminder_scheduler.metrics(),
+            'broadcast': broadcaster.metrics(),
+            'pending_replay': pending_replay.metrics(),
+            'pending_pruner': pending_pruner.metrics(),
+            'stats_archiver': stats_archiver.metrics(),
+            'funnel': funnel.metrics(),
+            'reminder_cohorts': reminder_cohorts.metrics(),
+            'fsm_storage': storage.metrics(),
+        }
+        metrics_message = "⚙️ <b>Метрики:</b>\n\n"
+        for name, values in metrics.items():
+            metrics_message += f"<b>{name}</b>\n"
+            for key, value in values.items():
+                metrics_message += f"• {key}: {value}\n"
+            metrics_message += "\n"
+        await message.reply(metrics_message, parse_mode='HTML')
+    else:
+        await message.reply('Нет доступа')
+
 @dp.message_handler(commands=['sourcestats'])
 async def send_source_stats(message: types.Message):
     if message.from_user.id in ADMIN_IDS:
         try:
-            stats = get_source_stats()
+            # Необязательный диапазон дат: /sourcestats YYYY-MM-DD [YYYY-MM-DD]
+            args = message.get_args().split()
+            try:
+                dates = [datetime.strptime(arg, '%Y-%m-%d').strftime('%Y-%m-%d') for arg in args[:2]]
+            except ValueError:
+                await message.reply("Формат дат: /sourcestats ГГГГ-ММ-ДД [ГГГГ-ММ-ДД]")
+                return
+            date_from = dates[0] if dates else None
+            date_to = dates[-1] if dates else None
+            stats = get_source_stats(date_from, date_to)
             
             if not stats:
                 await message.reply("Статистика по источникам пока пуста.")
@@ -720,6 +517,11 @@ async def send_source_stats(message: types.Message):
                 
             # Формируем сообщение со статистикой
             stats_message = "📊 <b>Статистика по источникам трафика:</b>\n\n"
+            if dates:
+                stats_message = (
+                    f"📊 <b>Статистика по источникам трафика за {date_from} — {date_to}:</b>\n"
+                    "(уникальные - новые пользователи источника за период)\n\n"
+                )
             
             for row in stats:
                 source = row['source']
@@ -744,6 +546,191 @@ async def send_source_stats(message: types.Message):
     else:
         await message.reply('Нет доступа')
 
+def format_duration(seconds):
+    """Длительность в секундах -> '2 ч 05 мин' / '7 мин' / '40 с'"""
+    if seconds is None:
+        return '—'
+    if seconds < 60:
+        return f"{seconds} с"
+    if seconds < 3600:
+        return f"{seconds // 60} мин"
+    return f"{seconds // 3600} ч {seconds % 3600 // 60:02d} мин"
+
+@dp.message_handler(commands=['funnel'])
+async def send_funnel(message: types.Message):
+    if message.from_user.id in ADMIN_IDS:
+        try:
+            # /funnel [ИСТОЧНИК] [YYYY-MM-DD [YYYY-MM-DD]]: без источника - по источникам,
+            # с источником - по дням; даты - дни первого касания
+            args = message.get_args().split()
+            source = None
+            if args and not args[0][:1].isdigit():
+                source = args.pop(0)
+            try:
+                dates = [datetime.strptime(arg, '%Y-%m-%d').strftime('%Y-%m-%d') for arg in args[:2]]
+            except ValueError:
+                await message.reply("Формат: /funnel [ИСТОЧНИК] [ГГГГ-ММ-ДД [ГГГГ-ММ-ДД]]")
+                return
+            date_from = dates[0] if dates else None
+            date_to = dates[-1] if dates else None
+            rows = await funnel.report(date_from, date_to, source)
+
+            if not rows:
+                await message.reply("Воронка пока пуста.")
+                return
+
+            title = f"📉 <b>Воронка{f' источника {source}' if source else ' по источникам'}"
+            if dates:
+                title += f" за {date_from} — {date_to}"
+            header = title + ":</b>\n(первое касание → раздел → предложение → get_loan)\n\n"
+            parts = []
+            for row in rows:
+                started = row['started']
+                rate = (row['get_loan'] / started * 100) if started > 0 else 0
+                parts.append(
+                    f"<b>{row['day'] if source else row['source']}</b>\n"
+                    f"👥 {started} → {row['category']} → {row['offer']} → ✅ {row['get_loan']} ({rate:.1f}%)\n"
+                    f"⏱ До get_loan: p50 {format_duration(row['p50_s'])}, p90 {format_duration(row['p90_s'])}\n\n"
+                )
+            for chunk in split_message(header, parts):
+                await message.reply(chunk, parse_mode='HTML')
+        except Exception as e:
+            logger.error(f"Error in funnel command: {e}")
+            await message.reply(f'Ошибка при построении воронки: {e}')
+    else:
+        await message.reply('Нет доступа')
+
+@dp.message_handler(commands=['remindstats'])
+async def send_reminder_cohorts(message: types.Message):
+    if message.from_user.id in ADMIN_IDS:
+        try:
+            # /remindstats [ЧАСЫ] [YYYY-MM-DD]: окно после напоминания и первая неделя когорт
+            args = message.get_args().split()
+            usage = (f"Формат: /remindstats [ЧАСЫ] [ГГГГ-ММ-ДД], "
+                     f"часы: {', '.join(map(str, REMINDER_COHORT_HOURS))}")
+            hours = REMINDER_COHORT_HOURS[0]
+            if args and args[0].isdigit():
+                hours = int(args.pop(0))
+            try:
+                week_from = datetime.strptime(args[0], '%Y-%m-%d') if args else None
+            except ValueError:
+                await message.reply(usage)
+                return
+            if hours not in REMINDER_COHORT_HOURS:
+                await message.reply(usage)
+                return
+            if week_from is not None:
+                # Когорта недели начинается с понедельника
+                week_from = (week_from - timedelta(days=week_from.weekday())).strftime('%Y-%m-%d')
+            weeks = await reminder_cohorts.report(hours, week_from)
+
+            if not weeks:
+                await message.reply("Данных по напоминаниям пока нет.")
+                return
+
+            header = f"🔔 <b>Напоминания: возврат и конверсия за {hours} ч после отправки</b>\n\n"
+            parts = []
+            for week, rows in weeks.items():
+                part = f"<b>Неделя с {week}</b>\n"
+                for row in rows:
+                    sent = row['sent']
+                    returned_rate = row['returned'] / sent * 100 if sent else 0
+                    converted_rate = row['converted'] / sent * 100 if sent else 0
+                    part += (f"День {row['stage']}: 📨 {sent} → "
+                             f"↩️ {row['returned']} ({returned_rate:.1f}%) → "
+                             f"✅ {row['converted']} ({converted_rate:.1f}%)\n")
+                parts.append(part + "\n")
+            for chunk in split_message(header, parts):
+                await message.reply(chunk, parse_mode='HTML')
+        except Exception as e:
+            logger.error(f"Error in remindstats command: {e}")
+            await message.reply(f'Ошибка при построении когорт напоминаний: {e}')
+    else:
+        await message.reply('Нет доступа')
+
+# Постраничный вывод /userstats: страница читается по курсору (timestamp, id),
+# курсор передается в callback_data кнопок "Новее"/"Старее"
+USER_STATS_PAGE_SIZE = 20
+MESSAGE_LIMIT = 4096
+
+def format_user_stats_row(row):
+    """Форматирует одну запись статистики пользователя"""
+    ts = row['timestamp']
+    # '%Y-%m-%d %H:%M:%S' -> '%d.%m.%Y %H:%M:%S' без разбора через strptime
+    timestamp = f"{ts[8:10]}.{ts[5:7]}.{ts[:4]}{ts[10:]}"
+    return (
+        f"🕒 {timestamp}\n"
+        f"📝 Действие: {row['action']}\n"
+        f"🔗 Источник: {row['source']}\n\n"
+    )
+
+def split_message(header, parts, limit=MESSAGE_LIMIT):
+    """Собирает части в сообщения не длиннее limit символов"""
+    chunks = []
+    current = header
+    for part in parts:
+        if current and len(current) + len(part) > limit:
+            chunks.append(current)
+            current = ''
+        current += part
+    if current:
+        chunks.append(current)
+    return chunks
+
+def user_stats_cursor_data(user_id, direction, row):
+    """callback_data кнопки перехода: us:<user_id>:<o|n>:<YYYYMMDDHHMMSS>:<id>"""
+    ts = row['timestamp']
+    compact = ts[:4] + ts[5:7] + ts[8:10] + ts[11:13] + ts[14:16] + ts[17:19]
+    return f"us:{user_id}:{direction}:{compact}:{row['id']}"
+
+def parse_user_stats_cursor(data):
+    """Разбирает суффикс callback_data после 'us:'"""
+    user_id, direction, compact, row_id = data.split(':')
+    ts = (f"{compact[:4]}-{compact[4:6]}-{compact[6:8]} "
+          f"{compact[8:10]}:{compact[10:12]}:{compact[12:14]}")
+    return int(user_id), direction, (ts, int(row_id))
+
+async def send_user_stats_page(chat_id, user_id, direction=None, cursor=None):
+    """Отправляет одну страницу статистики пользователя.
+
+    direction: None - самые новые записи, 'o' - старее курсора, 'n' - новее.
+    """
+    loop = asyncio.get_running_loop()
+    size = USER_STATS_PAGE_SIZE
+    if direction == 'n':
+        rows = await loop.run_in_executor(None, lambda: get_user_stats_page(user_id, size, after=cursor))
+        has_newer, has_older = len(rows) > size, True
+        rows = rows[-size:]
+    else:
+        before = cursor if direction == 'o' else None
+        rows = await loop.run_in_executor(None, lambda: get_user_stats_page(user_id, size, before=before))
+        has_newer, has_older = direction == 'o', len(rows) > size
+        rows = rows[:size]
+
+    if not rows:
+        await bot.send_message(chat_id, f"Статистика по пользователю {user_id} не найдена.")
+        return
+
+    header = f"📊 <b>Статистика пользователя {user_id}:</b>\n\n"
+    chunks = split_message(header, (format_user_stats_row(row) for row in rows))
+
+    buttons = []
+    if has_newer:
+        buttons.append(types.InlineKeyboardButton(
+            '◀️ Новее', callback_data=user_stats_cursor_data(user_id, 'n', rows[0])))
+    if has_older:
+        buttons.append(types.InlineKeyboardButton(
+            'Старее ▶️', callback_data=user_stats_cursor_data(user_id, 'o', rows[-1])))
+    keyboard = types.InlineKeyboardMarkup().row(*buttons) if buttons else None
+
+    for i, chunk in enumerate(chunks):
+        await bot.send_message(
+            chat_id,
+            chunk,
+            parse_mode='HTML',
+            reply_markup=keyboard if i == len(chunks) - 1 else None
+        )
+
 @dp.message_handler(commands=['userstats'])
 async def send_user_stats(message: types.Message):
     if message.from_user.id in ADMIN_IDS:
@@ -760,27 +747,7 @@ async def send_user_stats(message: types.Message):
                 await message.reply("ID пользователя должен быть числом")
                 return
                 
-            stats = get_user_stats(user_id)
-            
-            if not stats:
-                await message.reply(f"Статистика по пользователю {user_id} не найдена.")
-                return
-                
-            # Формируем сообщение со статистикой
-            stats_message = f"📊 <b>Статистика пользователя {user_id}:</b>\n\n"
-            
-            for row in stats:
-                action = row['action']
-                source = row['source']
-                timestamp = datetime.strptime(row['timestamp'], '%Y-%m-%d %H:%M:%S').strftime('%d.%m.%Y %H:%M:%S')
-                
-                stats_message += (
-                    f"🕒 {timestamp}\n"
-                    f"📝 Действие: {action}\n"
-                    f"🔗 Источник: {source}\n\n"
-                )
-            
-            await message.reply(stats_message, parse_mode='HTML')
+            await send_user_stats_page(message.chat.id, user_id)
             
         except Exception as e:
             logger.error(f"Error in userstats command: {e}")
@@ -788,143 +755,150 @@ async def send_user_stats(message: types.Message):
     else:
         await message.reply('Нет доступа')
 
-async def send_reminders():
-    """Отправляет напоминания пользователям"""
-    error_count = 0
-    max_errors = 3
-    
-    while True:
-        try:
-            # Получаем пользователей для напоминаний
-            users = get_users_for_reminder()
-            
-            # Отправляем напоминания через 1 день
-            for user in users['day_1']:
-                try:
-                    await bot.send_message(
-                        chat_id=user['user_id'],
-                        text="👋 Приветствую! Прошло уже 24 часа с момента нашего знакомства.\n\n"
-                             "Не упустите возможность получить займ на выгодных условиях.\n"
-                             "Выберите подходящий вариант в меню бота!",
-                        reply_markup=get_main_menu()
-                    )
-                    mark_reminder_sent(user['user_id'], '1')
-                except Exception as e:
-                    logger.error(f"Error sending 1-day reminder to user {user['user_id']}: {e}")
-            
-            # Отправляем напоминания через 3 дня
-            for user in users['day_3']:
-                try:
-                    await bot.send_message(
-                        chat_id=user['user_id'],
-                        text="👋 Снова здравствуйте! Прошло 3 дня с момента нашего знакомства.\n\n"
-                             "Напоминаем о наших выгодных предложениях:\n"
-                             "• Первый займ под 0%\n"
-                             "• Решение за 15 минут\n"
-                             "• Минимум документов\n\n"
-                             "Выберите подходящий вариант в меню бота!",
-                        reply_markup=get_main_menu()
-                    )
-                    mark_reminder_sent(user['user_id'], '3')
-                except Exception as e:
-                    logger.error(f"Error sending 3-day reminder to user {user['user_id']}: {e}")
-            
-            # Отправляем напоминания через 10 дней
-            for user in users['day_10']:
-                try:
-                    await bot.send_message(
-                        chat_id=user['user_id'],
-                        text="👋 Добрый день! Напоминаю вам, что специально для вас, мы собрали лучшие предложения на рынке финансирования:\n\n"
-                             "• Сниженные ставки\n"
-                             "• Увеличенные лимиты\n"
-                             "• Персональные условия\n\n"
-                             "Выберите подходящий вариант в меню бота!",
-                        reply_markup=get_main_menu()
-                    )
-                    mark_reminder_sent(user['user_id'], '10')
-                except Exception as e:
-                    logger.error(f"Error sending 10-day reminder to user {user['user_id']}: {e}")
-            
-            # Сбрасываем счетчик ошибок при успешном выполнении
-            error_count = 0
-            
-            # Проверяем каждые 6 часов
-            await asyncio.sleep(6 * 60 * 60)
-            
-        except Exception as e:
-            error_count += 1
-            logger.error(f"Error in send_reminders: {e}")
-            
-            if error_count >= max_errors:
-                logger.critical(f"Too many errors in send_reminders ({error_count}). Restarting...")
-                # Перезапускаем бота
-                await setup_webhook()
-                error_count = 0
-            
-            # Ждем 5 минут перед следующей попыткой
-            await asyncio.sleep(300)
+async def user_stats_page_callback(callback_query: types.CallbackQuery, state: FSMContext, data: str):
+    """Кнопки "Новее"/"Старее" под статистикой пользователя"""
+    if callback_query.from_user.id not in ADMIN_IDS:
+        await callback_query.answer('Нет доступа')
+        return
+    try:
+        user_id, direction, cursor = parse_user_stats_cursor(data)
+    except ValueError:
+        logger.warning(f"Bad userstats cursor: {data}")
+        await callback_query.answer()
+        return
+    await callback_query.answer()
+    await send_user_stats_page(callback_query.message.chat.id, user_id, direction, cursor)
+
+router.add_prefix('us:', user_stats_page_callback)
+
+# Тексты напоминаний по стадиям (дней после первого взаимодействия)
+REMINDER_TEXTS = {
+    1: "👋 Приветствую! Прошло уже 24 часа с момента нашего знакомства.\n\n"
+       "Не упустите возможность получить займ на выгодных условиях.\n"
+       "Выберите подходящий вариант в меню бота!",
+    3: "👋 Снова здравствуйте! Прошло 3 дня с момента нашего знакомства.\n\n"
+       "Напоминаем о наших выгодных предложениях:\n"
+       "• Первый займ под 0%\n"
+       "• Решение за 15 минут\n"
+       "• Минимум документов\n\n"
+       "Выберите подходящий вариант в меню бота!",
+    10: "👋 Добрый день! Напоминаю вам, что специально для вас, мы собрали лучшие предложения на рынке финансирования:\n\n"
+        "• Сниженные ставки\n"
+        "• Увеличенные лимиты\n"
+        "• Персональные условия\n\n"
+        "Выберите подходящий вариант в меню бота!",
+}
 
-async def process_pending_events():
-    """Обрабатывает неотвеченные события при запуске бота"""
-    events = get_unprocessed_pending_events()
-    for event in events:
-        try:
-            user_id = event['user_id']
-            event_type = event['event_type']
-            event_data = event['event_data']
-            # Универсальная обработка событий
-            if event_type == 'start':
-                await bot.send_message(
-                    chat_id=user_id,
-                    text="Привет! Вы запускали бота, когда он был недоступен. Сейчас бот снова работает!\n\n"
-                         "Мы собрали для вас лучшие финансовые решения с наиболее выгодными условиями. Выберите подходящий вариант в меню бота!",
-                    reply_markup=get_start_menu()
-                )
-            elif event_type == 'callback':
-                # Можно доработать под разные callback, пока просто уведомление
-                await bot.send_message(
-                    chat_id=user_id,
-                    text="Бот был временно недоступен. Пожалуйста, повторите ваш запрос — сейчас всё работает!"
-                )
-            elif event_type == 'message':
-                await bot.send_message(
-                    chat_id=user_id,
-                    text="Бот был временно недоступен. Пожалуйста, повторите ваш запрос — сейчас всё работает!"
-                )
-            # Можно добавить обработку других типов событий
-            mark_pending_event_processed(event['id'])
-        except Exception as e:
-            logger.error(f"Ошибка при обработке pending event {event['id']}: {e}")
+async def send_reminder(user_id, stage):
+    """Отправляет пользователю напоминание нужной стадии"""
+    await bot.send_message(
+        chat_id=user_id,
+        text=REMINDER_TEXTS[stage],
+        reply_markup=catalog.keyboard('main')
+    )
+
+# Планировщик напоминаний по индексу next_reminder_at
+reminder_scheduler = ReminderScheduler(send_reminder, broadcaster)
+
+async def send_pending_notice(user_id, event_type):
+    """Уведомляет пользователя, что бот снова работает (по неотвеченному событию)"""
+    if event_type == 'start':
+        await bot.send_message(
+            chat_id=user_id,
+            text="Привет! Вы запускали бота, когда он был недоступен. Сейчас бот снова работает!\n\n"
+                 "Мы собрали для вас лучшие финансовые решения с наиболее выгодными условиями. Выберите подходящий вариант в меню бота!",
+            reply_markup=catalog.keyboard('start')
+        )
+    else:
+        # callback, message и другие типы - пока просто уведомление
+        await bot.send_message(
+            chat_id=user_id,
+            text="Бот был временно недоступен. Пожалуйста, повторите ваш запрос — сейчас всё работает!"
+        )
+
+# Неотвеченные события отправляются в фоне после запуска
+pending_replay = PendingReplay(send_pending_notice, broadcaster)
+
+# Очистка старых обработанных событий (PENDING_EVENTS_ARCHIVE_DIR - архивировать перед удалением)
+pending_pruner = PendingEventsPruner(
+    retention_days=int(os.getenv('PENDING_EVENTS_RETENTION_DAYS', 30)),
+    archive_dir=os.getenv('PENDING_EVENTS_ARCHIVE_DIR')
+)
+
+# Закрытые месяцы статистики выносятся в сжатые архивы
+stats_archiver = StatsArchiver()
 
 async def on_startup(dp):
-    """Действия при запуске бота"""
-    # Создаем таблицу при запуске
-    create_table()
-    await setup_webhook()
-    # Запускаем проверку состояния вебхука и отправку напоминаний в фоновом режиме
+    """Действия при запуске бота: только то, что нужно для обработки первого update'а"""
+    # Схема проверяется одним запросом, CREATE выполняются только на новой или устаревшей базе
+    ensure_schema()
+    csv_log.open()
+    stats_writer.start()
+    storage.start()
+    deduplicator.load()
+    deduplicator.start()
+    update_queue.start()
+
+def start_background_work():
+    """Фоновые задачи; запускаются, когда сервер уже принимает вебхуки"""
+    # Установка и проверка вебхука (сетевые запросы к Telegram) тоже идут в фоне
     asyncio.create_task(check_webhook_health())
-    asyncio.create_task(send_reminders())
+    asyncio.create_task(reminder_scheduler.run())
     # Обрабатываем неотвеченные события
-    await process_pending_events()
+    pending_replay.start()
+    asyncio.create_task(pending_pruner.run())
+    asyncio.create_task(stats_archiver.run())
+    asyncio.create_task(funnel.run())
+    asyncio.create_task(reminder_cohorts.run())
+    asyncio.create_task(migrate_stats_in_background())
+    asyncio.create_task(seal_csv_in_background())
 
 async def on_shutdown(dp):
     """Действия при остановке бота"""
     global bot_is_running
     bot_is_running = False
-    await bot.delete_webhook()
-    logger.info("Webhook удален")
+    # Вебхук не удаляем: Telegram копит update'ы, пока сервис остановлен,
+    # и доставляет их после запуска (повторы отбрасывает deduplicator)
+    # Дообрабатываем уже принятые update'ы
+    await update_queue.stop()
+    await deduplicator.close()
+    # Дописываем накопленную статистику и состояния FSM перед выходом
+    await stats_writer.stop()
+    csv_log.close()
+    await dp.storage.close()
+    close_db_connections()
+    session = await bot.get_session()
+    await session.close()
+
+async def serve(port):
+    """Запускает вебхук-сервер и работает до SIGTERM/SIGINT.
+
+    До открытия порта выполняется только on_startup (без сетевых запросов
+    к Telegram), поэтому update, разбудивший сервис после простоя,
+    принимается сразу. Вебхук и фоновые задачи запускаются после того,
+    как сервер начал слушать порт.
+    """
+    app = web.Application()
+    app.router.add_route('*', WEBHOOK_PATH, update_queue.request_handler)
+    app[BOT_DISPATCHER_KEY] = dp
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await on_startup(dp)
+    await web.TCPSite(runner, host='0.0.0.0', port=port).start()
+    logger.info(f"Webhook server listening on port {port}")
+    start_background_work()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        # Сначала перестаем принимать запросы, затем дообрабатываем принятое
+        await runner.cleanup()
+        await on_shutdown(dp)
 
 if __name__ == '__main__':
-    # Создаем таблицу при запуске скрипта
-    create_table()
-    
-    port = int(os.getenv('PORT', 10000))
-    executor.start_webhook(
-        dispatcher=dp,
-        webhook_path=WEBHOOK_PATH,
-        on_startup=on_startup,
-        on_shutdown=on_shutdown,
-        skip_updates=True,
-        host='0.0.0.0',
-        port=port
-    )
\ No newline at end of file
+    # Цикл по умолчанию: очереди и блокировки компонентов созданы при импорте и привязаны к нему (Python 3.9)
+    asyncio.get_event_loop().run_until_complete(serve(int(os.getenv('PORT', 10000))))
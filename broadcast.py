@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import time
+
+from aiogram.utils.exceptions import ChatNotFound, RetryAfter, Unauthorized, UserDeactivated
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Глобальный лимит запросов: rate токенов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Приостанавливает выдачу токенов (после RetryAfter от Telegram)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        """Ждет, пока не освободится токен"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class BroadcastResult:
+    """Итог рассылки: списки (chat_id, payload) по исходу отправки"""
+
+    def __init__(self):
+        self.sent = []
+        self.blocked = []
+        self.failed = []
+
+
+class Broadcaster:
+    """Рассылка сообщений с ограничением параллельности и частоты.
+
+    Глобальный token bucket держит общую скорость (по умолчанию 30 msg/s),
+    а per_chat_interval не дает писать в один чат чаще раза в секунду.
+    На RetryAfter вся рассылка ставится на паузу и сообщение повторяется.
+    Пользователи, заблокировавшие бота или удалившие аккаунт, попадают в
+    result.blocked, чтобы вызывающий код мог исключить их из рассылок.
+    """
+
+    def __init__(self, rate=30, per_chat_interval=1.0, concurrency=20, max_retries=3):
+        self.bucket = TokenBucket(rate)
+        self.per_chat_interval = per_chat_interval
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self._chat_next = {}
+
+        # Счетчики для мониторинга
+        self.in_progress = 0
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.deactivated = 0
+        self.retries = 0
+        self.last_run_sent = 0
+        self.last_run_seconds = 0.0
+
+    async def _wait_chat(self, chat_id):
+        now = time.monotonic()
+        next_at = self._chat_next.get(chat_id, 0)
+        self._chat_next[chat_id] = max(now, next_at) + self.per_chat_interval
+        if next_at > now:
+            await asyncio.sleep(next_at - now)
+        if len(self._chat_next) > 10000:
+            # Чистим устаревшие записи, чтобы словарь не рос бесконечно
+            self._chat_next = {chat: at for chat, at in self._chat_next.items() if at > now}
+
+    async def send(self, chat_id, send, payload=None):
+        """Выполняет send(chat_id, payload) с учетом лимитов и RetryAfter"""
+        for attempt in range(self.max_retries + 1):
+            await self._wait_chat(chat_id)
+            await self.bucket.acquire()
+            try:
+                return await send(chat_id, payload)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                logger.warning(f"Flood control, pausing broadcast for {e.timeout}s")
+                self.bucket.pause(e.timeout)
+
+    async def broadcast(self, items, send):
+        """Рассылает items - последовательность (chat_id, payload) - через send(chat_id, payload)"""
+        result = BroadcastResult()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        started = time.monotonic()
+
+        async def worker(chat_id, payload):
+            async with semaphore:
+                self.in_progress += 1
+                try:
+                    await self.send(chat_id, send, payload)
+                    result.sent.append((chat_id, payload))
+                    self.sent += 1
+                except (Unauthorized, ChatNotFound) as e:
+                    if isinstance(e, UserDeactivated):
+                        self.deactivated += 1
+                    else:
+                        self.blocked += 1
+                    result.blocked.append((chat_id, payload))
+                    logger.info(f"Chat {chat_id} is unavailable: {e}")
+                except Exception as e:
+                    result.failed.append((chat_id, payload))
+                    self.failed += 1
+                    logger.error(f"Error sending broadcast message to {chat_id}: {e}")
+                finally:
+                    self.in_progress -= 1
+                    self.queued -= 1
+
+        items = list(items)
+        self.queued += len(items)
+        await asyncio.gather(*(worker(chat_id, payload) for chat_id, payload in items))
+        self.last_run_sent = len(result.sent)
+        self.last_run_seconds = time.monotonic() - started
+        logger.info(f"Broadcast finished: {len(result.sent)} sent, {len(result.blocked)} blocked, "
+                    f"{len(result.failed)} failed in {self.last_run_seconds:.1f}s")
+        return result
+
+    def metrics(self):
+        """Возвращает прогресс, пропускную способность и счетчики ошибок"""
+        return {
+            'queued': self.queued,
+            'in_progress': self.in_progress,
+            'sent': self.sent,
+            'failed': self.failed,
+            'blocked': self.blocked,
+            'deactivated': self.deactivated,
+            'retries': self.retries,
+            'last_run_msg_per_s': round(self.last_run_sent / self.last_run_seconds, 1) if self.last_run_seconds else 0.0,
+        }
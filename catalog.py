@@ -0,0 +1,136 @@
+import json
+import logging
+from collections import namedtuple
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+CATALOG_FILE = 'offers.json'
+
+# Шаги воронки для отслеживаемых действий
+FUNNEL_CATEGORY = 'category'
+FUNNEL_OFFER = 'offer'
+FUNNEL_GET_LOAN = 'get_loan'
+
+# Готовый к отправке экран: текст, parse_mode, изображение и клавиатура,
+# уже сериализованная в JSON (aiogram передает строку в API как есть).
+# track - имя действия для статистики или None.
+Screen = namedtuple('Screen', ['key', 'text', 'parse_mode', 'image', 'reply_markup', 'track', 'personalized'])
+
+
+def serialize_keyboard(rows):
+    """Сериализует inline-клавиатуру (список рядов кнопок) в JSON-строку"""
+    return json.dumps({'inline_keyboard': rows}, ensure_ascii=False, separators=(',', ':'))
+
+
+class Catalog:
+    """Каталог предложений и меню, собранный один раз из offers.json.
+
+    Для каждого callback_data заранее готовится Screen, поэтому
+    хендлеру остается только найти его в словаре.
+    """
+
+    def __init__(self, data):
+        self.keyboards = {}
+        self.screens = {}
+        self.offers = {}
+        # Действие статистики -> шаг воронки
+        self.funnel_steps = {}
+
+        for name, rows in data.get('keyboards', {}).items():
+            self.keyboards[name] = serialize_keyboard(rows)
+
+        for key, screen in data.get('screens', {}).items():
+            self._add_screen(
+                key,
+                screen['text'],
+                screen.get('parse_mode'),
+                None,
+                self.keyboards[screen['keyboard']] if 'keyboard' in screen else None,
+                key if screen.get('track') else None
+            )
+            if screen.get('track'):
+                # Отдельные отслеживаемые экраны - разделы (например, залог недвижимости)
+                self.funnel_steps[key] = FUNNEL_CATEGORY
+
+        categories = data.get('categories', {})
+        menus = {name: [] for name in categories}
+        for offer in data.get('offers', []):
+            category = categories[offer['category']]
+            offer_id = offer['id']
+            details_key = category['offer_prefix'] + offer_id
+            self.offers[offer_id] = offer
+            menus[offer['category']].append([{'text': offer['button'], 'callback_data': details_key}])
+
+            # Карточка предложения
+            self._add_screen(
+                details_key,
+                offer['text'],
+                offer.get('parse_mode'),
+                None,
+                serialize_keyboard([
+                    [{'text': category['details_button'], 'callback_data': f'get_loan_{offer_id}'}],
+                    [{'text': category['details_back'], 'callback_data': category['menu']}],
+                ]),
+                details_key
+            )
+            self.funnel_steps[details_key] = FUNNEL_OFFER
+            # Экран перехода к кредитору: картинка и внешняя ссылка
+            self._add_screen(
+                f'get_loan_{offer_id}',
+                category['link_caption'].format(title=offer['title']),
+                None,
+                offer.get('image', offer_id),
+                serialize_keyboard([
+                    [{'text': category['link_button'], 'url': offer['link']}],
+                    [{'text': category['link_back'], 'callback_data': category['menu']}],
+                ]),
+                f'get_loan_{offer_id}'
+            )
+            self.funnel_steps[f'get_loan_{offer_id}'] = FUNNEL_GET_LOAN
+
+        # Меню категорий собираются из списка предложений
+        for name, category in categories.items():
+            self._add_screen(
+                category['menu'],
+                category['text'],
+                category.get('parse_mode'),
+                None,
+                serialize_keyboard(menus[name] + [[category['menu_back']]]),
+                category['menu'] if category.get('track') else None
+            )
+            self.funnel_steps[category['menu']] = FUNNEL_CATEGORY
+
+    def _add_screen(self, key, text, parse_mode, image, reply_markup, track):
+        if key in self.screens:
+            raise ValueError(f"Duplicate screen in catalog: {key}")
+        self.screens[key] = Screen(key, text, parse_mode, image, reply_markup, track, '{full_name}' in text)
+
+    def screen(self, key):
+        """Возвращает экран по callback_data или None"""
+        return self.screens.get(key)
+
+    def funnel_step(self, action):
+        """Возвращает шаг воронки для действия статистики или None"""
+        if action.startswith('get_loan_'):
+            # Кнопки предложений, которых уже нет в каталоге, тоже конверсии
+            return FUNNEL_GET_LOAN
+        return self.funnel_steps.get(action)
+
+    def keyboard(self, name):
+        """Возвращает сериализованную клавиатуру по имени"""
+        return self.keyboards[name]
+
+    def render(self, screen, full_name=''):
+        """Возвращает текст экрана с подставленным именем пользователя"""
+        if screen.personalized:
+            return screen.text.replace('{full_name}', full_name or '')
+        return screen.text
+
+
+def load_catalog(path=CATALOG_FILE):
+    """Загружает каталог предложений из JSON-файла"""
+    with open(path, encoding='utf-8') as f:
+        catalog = Catalog(json.load(f))
+    logger.info(f"Catalog loaded: {len(catalog.offers)} offers, {len(catalog.screens)} screens")
+    return catalog
@@ -0,0 +1,68 @@
+import asyncio
+import logging
+import time
+
+import db
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+
+class ReminderCohortTracker:
+    """Эффективность напоминаний по неделе первого взаимодействия.
+
+    Для каждой отправки из журнала reminder_sends проверяется, вернулся
+    ли пользователь (любое событие) и дошел ли до get_loan в течение
+    N часов (db.REMINDER_COHORT_HOURS). Когорты обновляются инкрементально
+    по водяному знаку (db.update_reminder_cohorts) раз в interval секунд
+    и перед каждым отчетом.
+    """
+
+    def __init__(self, interval=3600):
+        self.interval = interval
+        self._lock = asyncio.Lock()
+
+        # Счетчики для мониторинга
+        self.runs = 0
+        self.sends_processed = 0
+        self.last_run_s = 0.0
+
+    async def update(self):
+        """Дообрабатывает отправки с закрывшимся окном; возвращает их число"""
+        async with self._lock:
+            started = time.perf_counter()
+            processed = await asyncio.get_running_loop().run_in_executor(None, db.update_reminder_cohorts)
+            self.runs += 1
+            self.sends_processed += processed
+            self.last_run_s = round(time.perf_counter() - started, 2)
+            if processed:
+                logger.info(f"Reminder cohorts updated with {processed} sends in {self.last_run_s}s")
+            return processed
+
+    async def run(self):
+        """Основной цикл: обновление по расписанию"""
+        while True:
+            try:
+                await self.update()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error updating reminder cohorts: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def report(self, hours, week_from=None):
+        """Возвращает {неделя: [строки по стадиям]} для окна hours часов"""
+        await self.update()
+        rows = await asyncio.get_running_loop().run_in_executor(None, db.get_reminder_cohorts, hours, week_from)
+        weeks = {}
+        for row in rows:
+            weeks.setdefault(row['week'], []).append(dict(row))
+        return weeks
+
+    def metrics(self):
+        """Возвращает число обработанных отправок"""
+        return {
+            'runs': self.runs,
+            'sends_processed': self.sends_processed,
+            'last_run_s': self.last_run_s,
+        }
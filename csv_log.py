@@ -0,0 +1,251 @@
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import shutil
+import threading
+from datetime import datetime
+
+from db import CSV_FILE, CSV_HEADER
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+
+class CsvEventLog:
+    """Зеркало статистики в CSV с ротацией в gzip-сегменты.
+
+    Строки дописываются в открытый файл current.csv. При превышении
+    max_bytes или смене дня текущий файл сжимается в сегмент
+    stats_<день>_<номер>.csv.gz, а сегмент записывается в manifest.json
+    с диапазоном дат. Сегменты хранятся без заголовка, поэтому выгрузка
+    за период - это склейка gzip-потоков подходящих сегментов без распаковки.
+
+    Остатки прошлого запуска (current.csv и старый stats_log.csv) при
+    open() только откладываются, а сжимаются в seal_leftovers() в фоне;
+    до этого выгрузка фильтрует их построчно.
+    """
+
+    def __init__(self, directory='stats_csv', max_bytes=5 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.current_path = os.path.join(directory, 'current.csv')
+        self.manifest_path = os.path.join(directory, 'manifest.json')
+        self._lock = threading.Lock()
+        self._file = None
+        self._writer = None
+        self._day = None
+        self._rows = 0
+        self.segments = []
+        # Незапечатанные остатки прошлого запуска: (путь, пропустить заголовок)
+        self._leftovers = []
+
+        # Счетчики для мониторинга
+        self.written = 0
+        self.rotations = 0
+
+    def open(self):
+        """Подготавливает каталог: загружает манифест и откладывает остатки прошлого запуска.
+
+        Вызывается до открытия порта, поэтому файлы здесь не читаются:
+        current.csv только переименовывается, чтобы новые строки не
+        затерли его, а сжатие выполняет seal_leftovers().
+        """
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            try:
+                with open(self.manifest_path, encoding='utf-8') as f:
+                    self.segments = json.load(f)['segments']
+            except FileNotFoundError:
+                self.segments = []
+            # Старый неротируемый stats_log.csv становится первым сегментом
+            self._leftovers = [(CSV_FILE, True)] if os.path.exists(CSV_FILE) else []
+            # Остатки, которые не успели запечатать до прошлой остановки
+            for name in sorted(os.listdir(self.directory)):
+                if name.startswith('unsealed_') and name.endswith('.csv'):
+                    self._leftovers.append((os.path.join(self.directory, name), False))
+            if os.path.exists(self.current_path):
+                path = os.path.join(self.directory, f'unsealed_{datetime.now():%Y%m%d%H%M%S%f}.csv')
+                os.replace(self.current_path, path)
+                self._leftovers.append((path, False))
+
+    def seal_leftovers(self):
+        """Запечатывает остатки прошлого запуска; вызывается из потока пула после старта.
+
+        Файлы читаются и сжимаются без блокировки, под ней только
+        обновляется манифест. Возвращает число запечатанных файлов.
+        """
+        with self._lock:
+            leftovers = list(self._leftovers)
+        for path, skip_header in leftovers:
+            # Старый файл мог охватывать несколько дней - такой сегмент при
+            # выгрузке фильтруется построчно
+            self._seal_file(path, 'legacy' if skip_header else 'current', skip_header)
+        return len(leftovers)
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def write_rows(self, rows):
+        """Дописывает строки (user_id, full_name, username, action, source, created_at)"""
+        with self._lock:
+            # Размер проверяем раз на пачку: tell() у текстового файла не бесплатен
+            if self._file is not None and self._file.tell() >= self.max_bytes:
+                self._rotate(self._day)
+            for user_id, full_name, username, action, source, created_at in rows:
+                timestamp = datetime.fromtimestamp(created_at).isoformat()
+                day = timestamp[:10]
+                if self._file is None or day != self._day:
+                    self._rotate(day)
+                self._writer.writerow([user_id, full_name, username, action, source, timestamp])
+                self._rows += 1
+                self.written += 1
+            if self._file:
+                self._file.flush()
+
+    def _rotate(self, day):
+        if self._file:
+            self._file.close()
+            self._file = None
+            if self._rows:
+                self._seal(self.current_path, self._day, self._day, self._day, self._rows)
+        else:
+            os.makedirs(self.directory, exist_ok=True)
+        self._file = open(self.current_path, 'w', newline='', encoding='utf-8', buffering=64 * 1024)
+        self._writer = csv.writer(self._file)
+        self._day = day
+        self._rows = 0
+
+    def _seal_file(self, path, label, skip_header=False):
+        """Запечатывает остаток, диапазон дат которого неизвестен, не держа блокировку"""
+        first = last = None
+        rows = 0
+        with open(path, newline='', encoding='utf-8') as f:
+            reader = csv.reader(f)
+            if skip_header:
+                next(reader, None)
+            for row in reader:
+                if len(row) < len(CSV_HEADER):
+                    continue
+                first = first or row[5][:10]
+                last = row[5][:10]
+                rows += 1
+        tmp_path = os.path.join(self.directory, os.path.basename(path) + '.gz.tmp')
+        if rows:
+            self._compress(path, tmp_path, skip_header)
+        # Сегмент появляется в манифесте одновременно с исчезновением остатка,
+        # чтобы выгрузка не взяла одни и те же строки дважды
+        with self._lock:
+            if rows:
+                self._add_segment(tmp_path, first if first == last else label, first, last, rows)
+            self._leftovers.remove((path, skip_header))
+        os.remove(path)
+
+    def _seal(self, path, name_day, first, last, rows):
+        tmp_path = path + '.gz.tmp'
+        self._compress(path, tmp_path)
+        self._add_segment(tmp_path, name_day, first, last, rows)
+        os.remove(path)
+
+    @staticmethod
+    def _compress(path, gz_path, skip_header=False):
+        with open(path, 'rb') as src, gzip.open(gz_path, 'wb') as dst:
+            if skip_header:
+                src.readline()
+            shutil.copyfileobj(src, dst)
+
+    def _add_segment(self, gz_path, name_day, first, last, rows):
+        """Переименовывает сжатый файл в очередной сегмент дня и пишет манифест; под блокировкой"""
+        number = sum(1 for segment in self.segments if segment['file'].startswith(f'stats_{name_day}_'))
+        name = f'stats_{name_day}_{number:03d}.csv.gz'
+        os.replace(gz_path, os.path.join(self.directory, name))
+        self.segments.append({'file': name, 'first': first, 'last': last, 'rows': rows})
+        self._save_manifest()
+        self.rotations += 1
+        logger.info(f"CSV segment {name} sealed ({rows} rows)")
+
+    def _save_manifest(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'segments': self.segments}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+    def export(self, out, date_from, date_to):
+        """Пишет в out gzip-CSV за даты [date_from, date_to] (строки 'YYYY-MM-DD').
+
+        Сегменты целиком внутри периода копируются как есть, пограничные
+        многодневные сегменты, незапечатанные остатки и текущий файл
+        фильтруются построчно. Под блокировкой берется только список
+        сегментов и открываются изменяемые файлы (текущий - с его размером
+        на этот момент), сама выгрузка идет без нее и не задерживает запись.
+        Возвращает число затронутых сегментов.
+        """
+        files = []
+        try:
+            with self._lock:
+                if self._file:
+                    self._file.flush()
+                segments = [s for s in self.segments if s['last'] >= date_from and s['first'] <= date_to]
+                # Открытый файл остается читаемым, даже если его запечатают и удалят во время выгрузки
+                for path, skip_header in self._leftovers:
+                    files.append((open(path, 'rb'), None))
+                if self._rows and date_from <= self._day <= date_to:
+                    f = open(self.current_path, 'rb')
+                    files.append((f, os.fstat(f.fileno()).st_size))
+
+            self._write_member(out, [CSV_HEADER])
+            for segment in segments:
+                path = os.path.join(self.directory, segment['file'])
+                if segment['first'] >= date_from and segment['last'] <= date_to:
+                    with open(path, 'rb') as f:
+                        shutil.copyfileobj(f, out)
+                else:
+                    with gzip.open(path, 'rt', newline='', encoding='utf-8') as f:
+                        self._write_member(out, self._filter(f, date_from, date_to))
+            for f, size in files:
+                self._write_member(out, self._filter(self._lines(f, size), date_from, date_to))
+            return len(segments) + len(files)
+        finally:
+            for f, size in files:
+                f.close()
+
+    @staticmethod
+    def _lines(f, size=None):
+        """Строки бинарного файла в пределах первых size байт (недописанный хвост не читается)"""
+        while size is None or size > 0:
+            line = f.readline(-1 if size is None else size)
+            if not line:
+                return
+            if size is not None:
+                size -= len(line)
+            yield line.decode('utf-8')
+
+    @staticmethod
+    def _filter(f, date_from, date_to):
+        for row in csv.reader(f):
+            if len(row) >= len(CSV_HEADER) and date_from <= row[5][:10] <= date_to:
+                yield row
+
+    @staticmethod
+    def _write_member(out, rows):
+        # Каждый фрагмент - отдельный gzip-поток, их конкатенация тоже валидный gzip
+        with gzip.GzipFile(fileobj=out, mode='wb') as gz:
+            text = io.TextIOWrapper(gz, encoding='utf-8', newline='')
+            csv.writer(text).writerows(rows)
+            text.flush()
+            text.detach()
+
+    def metrics(self):
+        """Возвращает число сегментов и записанных строк"""
+        return {
+            'segments': len(self.segments),
+            'current_rows': self._rows,
+            'leftovers': len(self._leftovers),
+            'written': self.written,
+            'rotations': self.rotations,
+        }
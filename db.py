@@ -1,8 +1,18 @@
+import calendar
+import os
+import shutil
 import sqlite3
+import tempfile
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
 from datetime import datetime
-import csv
-import os
+from itertools import islice
+import gzip
+import json
 import logging
+import threading
+import time
+from urllib.parse import quote
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
@@ -10,36 +20,663 @@ logger = logging.getLogger(__name__)
 CSV_FILE = 'stats_log.csv'
 CSV_HEADER = ['user_id', 'full_name', 'username', 'action', 'source', 'timestamp']
 
+DB_FILE = 'stats.db'
+# Каталог сжатых архивов закрытых месяцев статистики
+ARCHIVE_DIR = 'stats_archive'
+
+# Настройки SQLite для долгоживущих соединений
+BUSY_TIMEOUT_MS = 5000
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}',
+    'PRAGMA mmap_size=67108864',
+    'PRAGMA cache_size=-16000',
+    'PRAGMA temp_store=MEMORY',
+)
+
+class ConnectionManager:
+    """Держит долгоживущие соединения с базой данных.
+
+    Каждый поток (event loop и потоки пула executor'а) получает свое
+    соединение, которое открывается один раз и переиспользуется вместе
+    с кешем подготовленных запросов sqlite3.
+    """
+
+    def __init__(self, path=DB_FILE, cached_statements=256):
+        self.path = path
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def get(self):
+        """Возвращает соединение текущего потока, открывая его при необходимости"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.path,
+                timeout=BUSY_TIMEOUT_MS / 1000,
+                cached_statements=self.cached_statements,
+                check_same_thread=False,
+                uri=True
+            )
+            conn.row_factory = sqlite3.Row
+            for pragma in PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def close_all(self):
+        """Закрывает все открытые соединения (при остановке бота)"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as e:
+                logger.error(f"Error closing database connection: {e}")
+        self._local = threading.local()
+
+connections = ConnectionManager()
+
+class ArchiveCache:
+    """Распакованные копии архивов статистики для чтения.
+
+    Архив месяца (gzip-файл sqlite) распаковывается во временный каталог
+    при первом обращении и дальше подключается через ATTACH только для
+    чтения. Держится не больше size копий, самая давно не
+    использованная удаляется.
+    """
+
+    def __init__(self, size=12):
+        self.size = size
+        self._dir = None
+        self._paths = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Счетчики для мониторинга
+        self.hits = 0
+        self.extractions = 0
+
+    def path(self, month, archive_path):
+        """Возвращает путь к распакованной копии архива месяца"""
+        with self._lock:
+            path = self._paths.get(month)
+            if path is not None and os.path.exists(path):
+                self._paths.move_to_end(month)
+                self.hits += 1
+                return path
+            if self._dir is None:
+                self._dir = tempfile.mkdtemp(prefix='stats_archive_')
+            path = os.path.join(self._dir, f'events_{month}.db')
+            with gzip.open(archive_path, 'rb') as src, open(path + '.tmp', 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.chmod(path + '.tmp', 0o444)
+            os.replace(path + '.tmp', path)
+            self._paths[month] = path
+            self.extractions += 1
+            while len(self._paths) > self.size:
+                _, old = self._paths.popitem(last=False)
+                self._remove(old)
+            return path
+
+    def invalidate(self, month):
+        """Забывает копию месяца (архив был пересобран)"""
+        with self._lock:
+            path = self._paths.pop(month, None)
+            if path:
+                self._remove(path)
+
+    def clear(self):
+        """Удаляет все распакованные копии"""
+        with self._lock:
+            self._paths.clear()
+            if self._dir:
+                shutil.rmtree(self._dir, ignore_errors=True)
+                self._dir = None
+
+    @staticmethod
+    def _remove(path):
+        # Уже подключенные соединения продолжают читать открытый файл
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning(f"Error removing archive copy {path}: {e}")
+
+    def metrics(self):
+        """Возвращает число распаковок и попаданий в кеш"""
+        return {
+            'extracted': len(self._paths),
+            'hits': self.hits,
+            'extractions': self.extractions,
+        }
+
+archives = ArchiveCache()
+
 def get_db_connection():
-    """Создает и возвращает соединение с базой данных"""
+    """Возвращает долгоживущее соединение с базой данных для текущего потока"""
     try:
-        conn = sqlite3.connect('stats.db')
-        conn.row_factory = sqlite3.Row
-        return conn
+        return connections.get()
     except Exception as e:
         logger.error(f"Error connecting to database: {e}")
         raise
 
+def close_db_connections():
+    """Закрывает все соединения с базой данных"""
+    connections.close_all()
+    archives.clear()
+    logger.info("Database connections closed")
+
+def list_tables():
+    """Возвращает имена пользовательских таблиц и представлений базы"""
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite_%' ORDER BY name")
+    return [row['name'] for row in c.fetchall()]
+
+def backup_database(path, tables=None):
+    """Делает согласованный снимок базы в файл path.
+
+    Без tables база копируется через VACUUM INTO в одной читающей
+    транзакции: в WAL она не блокирует пишущих, а их запись не
+    перезапускает копирование (как у пошагового backup API). С tables
+    копируются только указанные таблицы (со схемой и индексами) тоже в
+    одной читающей транзакции. Представления (например, stats_log)
+    копируются как таблицы с их текущим содержимым: таблиц, на которые
+    они ссылаются, в снимке может не быть. Вызывается из потока пула,
+    поэтому открывает собственные соединения.
+    """
+    if tables:
+        unknown = set(tables) - set(list_tables())
+        if unknown:
+            raise ValueError(f"Unknown tables: {', '.join(sorted(unknown))}")
+    src = sqlite3.connect(DB_FILE, timeout=BUSY_TIMEOUT_MS / 1000)
+    dst = None
+    try:
+        if not tables:
+            src.execute('VACUUM INTO ?', (path,))
+            return
+        dst = sqlite3.connect(path, uri=True)
+        placeholders = ','.join('?' * len(tables))
+        schema = src.execute(f'''
+            SELECT type, sql FROM sqlite_master
+            WHERE tbl_name IN ({placeholders}) AND sql IS NOT NULL AND type != 'view'
+            ORDER BY type = 'index'
+        ''', list(tables)).fetchall()
+        views = {row[0] for row in src.execute(
+            f"SELECT name FROM sqlite_master WHERE type = 'view' AND name IN ({placeholders})", list(tables))}
+        src.close()
+        src = None
+        for _, sql in schema:
+            dst.execute(sql)
+        dst.commit()
+        # Все таблицы читаются в одной транзакции - снимок согласован
+        dst.execute('ATTACH DATABASE ? AS live', (f'file:{DB_FILE}?mode=ro',))
+        dst.execute('BEGIN')
+        for table in tables:
+            if table in views:
+                dst.execute(f'CREATE TABLE main."{table}" AS SELECT * FROM live."{table}"')
+            else:
+                dst.execute(f'INSERT INTO main."{table}" SELECT * FROM live."{table}"')
+        dst.commit()
+        dst.execute('DETACH DATABASE live')
+    except Exception as e:
+        logger.error(f"Error making database snapshot: {e}")
+        raise
+    finally:
+        if src is not None:
+            src.close()
+        if dst is not None:
+            dst.close()
+
+# Через сколько дней после первого взаимодействия отправляются напоминания
+REMINDER_DAYS = (1, 3, 10)
+
+def migrate_reminder_schedule(c):
+    """Добавляет в user_first_interaction стадию и время следующего напоминания.
+
+    Для существующих пользователей значения вычисляются по флагам
+    reminder_N_sent и времени первого взаимодействия.
+    """
+    columns = {row[1] for row in c.execute('PRAGMA table_info(user_first_interaction)')}
+    if 'next_reminder_at' in columns:
+        return
+    c.execute('ALTER TABLE user_first_interaction ADD COLUMN reminder_stage INTEGER DEFAULT 0')
+    c.execute('ALTER TABLE user_first_interaction ADD COLUMN next_reminder_at INTEGER')
+    c.execute('''UPDATE user_first_interaction
+                 SET reminder_stage = CASE
+                         WHEN reminder_10_sent THEN 10
+                         WHEN reminder_3_sent THEN 3
+                         WHEN reminder_1_sent THEN 1
+                         ELSE 0
+                     END''')
+    c.execute('''UPDATE user_first_interaction
+                 SET next_reminder_at = CAST(strftime('%s', first_interaction_time,
+                     CASE reminder_stage
+                         WHEN 0 THEN '+1 days'
+                         WHEN 1 THEN '+3 days'
+                         WHEN 3 THEN '+10 days'
+                     END) AS INTEGER)''')
+    logger.info("Migrated user_first_interaction to indexed reminder schedule")
+
+def migrate_blocked_users(c):
+    """Добавляет в user_first_interaction отметку о блокировке бота пользователем"""
+    columns = {row[1] for row in c.execute('PRAGMA table_info(user_first_interaction)')}
+    if 'blocked' not in columns:
+        c.execute('ALTER TABLE user_first_interaction ADD COLUMN blocked BOOLEAN DEFAULT 0')
+        logger.info("Added blocked column to user_first_interaction")
+
+# Строки в формате stats_log поверх нормализованных таблиц; {events} - таблица
+# текущего раздела или архива месяца
+STATS_LOG_SELECT = '''
+    SELECT e.id AS id, e.user_id AS user_id, u.full_name AS full_name, u.username AS username,
+           a.name AS action, s.name AS source, datetime(e.ts, 'unixepoch') AS timestamp
+    FROM {events} e
+    JOIN actions a ON a.id = e.action_id
+    JOIN sources s ON s.id = e.source_id
+    LEFT JOIN users u ON u.user_id = e.user_id
+'''
+# Представление stats_log в прежнем формате (текущий раздел)
+STATS_LOG_VIEW = STATS_LOG_SELECT.format(events='events')
+# Пока перенос не завершен, еще не перенесенные строки видны через stats_log_legacy
+STATS_LOG_MIGRATION_VIEW = STATS_LOG_VIEW + '''
+    UNION ALL
+    SELECT id, user_id, full_name, username, action, source, timestamp FROM stats_log_legacy
+'''
+# Индекс истории пользователя в stats_log_legacy на время переноса (/userstats)
+LEGACY_HISTORY_INDEX = 'idx_stats_log_legacy_user ON stats_log_legacy(user_id, timestamp, id)'
+# Есть ли stats_log_legacy: None - еще не проверяли; сбрасывается при ее удалении
+_legacy_stats_exists = None
+
+def has_legacy_stats(c):
+    """Проверяет наличие stats_log_legacy один раз за процесс, а не на каждый запрос"""
+    global _legacy_stats_exists
+    if _legacy_stats_exists is None:
+        _legacy_stats_exists = c.execute("SELECT 1 FROM sqlite_master WHERE name = 'stats_log_legacy'").fetchone() is not None
+    return _legacy_stats_exists
+
+# Индекс истории пользователя; тот же индекс строится в архивах месяцев
+EVENTS_HISTORY_INDEX = 'idx_events_user_history ON events(user_id, ts, id, action_id, source_id)'
+
+def migrate_events_autoincrement(c):
+    """Пересоздает events с AUTOINCREMENT.
+
+    Без него SQLite выдает id удаленных строк повторно: после выноса
+    месяца в архив новые события получали id ниже водяных знаков
+    (update_funnel, iter_stat_rows) и пропускались. Счетчик sqlite_sequence
+    начинается выше всех уже выданных id - в events, архивах и воронке.
+    Пересборка идет в одной транзакции: при обрыве на середине остается
+    прежняя events вместе с представлением stats_log.
+    """
+    sql = c.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'events'").fetchone()[0]
+    if 'AUTOINCREMENT' in sql.upper():
+        return
+    conn = c.connection
+    # sqlite3 сам не открывает транзакцию для DDL - открываем ее явно
+    if conn.in_transaction:
+        conn.commit()
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        _rebuild_events_autoincrement(c)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    logger.info("Rebuilt events with AUTOINCREMENT")
+
+def _rebuild_events_autoincrement(c):
+    # Представление ссылается на events и пересоздается в migrate_stats_log_schema
+    c.execute('DROP VIEW IF EXISTS stats_log')
+    c.execute('DROP TABLE IF EXISTS events_autoincrement')
+    c.execute('''CREATE TABLE events_autoincrement
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER NOT NULL,
+                  action_id INTEGER NOT NULL,
+                  source_id INTEGER NOT NULL,
+                  ts INTEGER NOT NULL)''')
+    c.execute('''INSERT INTO events_autoincrement (id, user_id, action_id, source_id, ts)
+                 SELECT id, user_id, action_id, source_id, ts FROM events''')
+    c.execute('DROP TABLE events')
+    c.execute('ALTER TABLE events_autoincrement RENAME TO events')
+    c.execute(f'CREATE INDEX IF NOT EXISTS {EVENTS_HISTORY_INDEX}')
+    last_ids = [c.execute('SELECT MAX(id) FROM events').fetchone()[0],
+                c.execute('SELECT MAX(max_id) FROM stats_archives').fetchone()[0]]
+    if c.execute("SELECT 1 FROM sqlite_master WHERE name = 'bot_state'").fetchone():
+        row = c.execute('SELECT value FROM bot_state WHERE key = ?', (FUNNEL_WATERMARK_KEY,)).fetchone()
+        last_ids.append(int(row[0]) if row else None)
+    c.execute("DELETE FROM sqlite_sequence WHERE name = 'events'")
+    c.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('events', ?)",
+              (max([last_id for last_id in last_ids if last_id is not None], default=0),))
+
+def migrate_stats_log_schema(c):
+    """Переводит старую таблицу stats_log на нормализованную схему.
+
+    Таблица переименовывается в stats_log_legacy, а stats_log становится
+    представлением, объединяющим events и еще не перенесенные строки.
+    Сами строки переносятся пачками в фоне (migrate_legacy_stats), поэтому
+    запуск бота не ждет миграции.
+    """
+    global _legacy_stats_exists
+    _legacy_stats_exists = None
+    row = c.execute("SELECT type FROM sqlite_master WHERE name = 'stats_log'").fetchone()
+    if row and row[0] == 'table':
+        c.execute('ALTER TABLE stats_log RENAME TO stats_log_legacy')
+        # Индексы старой таблицы только замедляют удаление перенесенных строк
+        for index in ('idx_user_id', 'idx_action', 'idx_source', 'idx_user_timestamp'):
+            c.execute(f'DROP INDEX IF EXISTS {index}')
+        # Последняя строка переносится сразу, чтобы новые события получали id больше старых
+        move_legacy_stats(c, c.execute('SELECT MAX(id) FROM stats_log_legacy').fetchone()[0], None)
+        logger.info("stats_log renamed to stats_log_legacy, migrating rows in background")
+        row = None
+    if row is None:
+        legacy = c.execute("SELECT 1 FROM sqlite_master WHERE name = 'stats_log_legacy'").fetchone()
+        c.execute(f'CREATE VIEW stats_log AS {STATS_LOG_MIGRATION_VIEW if legacy else STATS_LOG_VIEW}')
+
+def move_legacy_stats(c, first_id, last_id):
+    """Переносит строки stats_log_legacy с id в [first_id, last_id] в events"""
+    if first_id is None:
+        return 0
+    last_id = first_id if last_id is None else last_id
+    bounds = (first_id, last_id)
+    c.execute('''INSERT OR IGNORE INTO actions (name)
+                 SELECT DISTINCT COALESCE(action, '') FROM stats_log_legacy WHERE id BETWEEN ? AND ?''', bounds)
+    c.execute('''INSERT OR IGNORE INTO sources (name)
+                 SELECT DISTINCT COALESCE(source, 'direct') FROM stats_log_legacy WHERE id BETWEEN ? AND ?''', bounds)
+    # Имя пользователя берется из его самой поздней строки (голые столбцы при MAX(id));
+    # более новые данные, уже записанные ботом, не затираются
+    c.execute('''INSERT INTO users (user_id, full_name, username, updated_at)
+                 SELECT user_id, full_name, username, ts FROM (
+                     SELECT user_id, full_name, username,
+                            CAST(strftime('%s', timestamp) AS INTEGER) AS ts, MAX(id)
+                     FROM stats_log_legacy
+                     WHERE id BETWEEN ? AND ? AND user_id IS NOT NULL
+                     GROUP BY user_id
+                 ) WHERE true
+                 ON CONFLICT (user_id) DO UPDATE SET
+                     full_name = excluded.full_name,
+                     username = excluded.username,
+                     updated_at = excluded.updated_at
+                 WHERE excluded.updated_at > COALESCE(users.updated_at, 0)''', bounds)
+    c.execute('''INSERT OR IGNORE INTO events (id, user_id, action_id, source_id, ts)
+                 SELECT l.id, COALESCE(l.user_id, 0), a.id, s.id,
+                        COALESCE(CAST(strftime('%s', l.timestamp) AS INTEGER), 0)
+                 FROM stats_log_legacy l
+                 JOIN actions a ON a.name = COALESCE(l.action, '')
+                 JOIN sources s ON s.name = COALESCE(l.source, 'direct')
+                 WHERE l.id BETWEEN ? AND ?''', bounds)
+    c.execute('DELETE FROM stats_log_legacy WHERE id BETWEEN ? AND ?', bounds)
+    return c.rowcount
+
+def migrate_legacy_stats(chunk_size=5000, pause=0.01):
+    """Переносит stats_log_legacy в events пачками по chunk_size строк.
+
+    Каждая пачка - отдельная короткая транзакция, между пачками пауза,
+    чтобы запись статистики из бота не ждала. В конце старая таблица
+    удаляется, представление stats_log пересоздается без нее, а место
+    возвращается через incremental_vacuum. Возвращает отчет о переносе.
+    """
+    global _legacy_stats_exists
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        if not c.execute("SELECT 1 FROM sqlite_master WHERE name = 'stats_log_legacy'").fetchone():
+            return None
+        # История пользователя читается из stats_log_legacy, пока идет перенос
+        c.execute(f'CREATE INDEX IF NOT EXISTS {LEGACY_HISTORY_INDEX}')
+        conn.commit()
+        started = time.perf_counter()
+        page_size = c.execute('PRAGMA page_size').fetchone()[0]
+        pages_before = c.execute('PRAGMA page_count').fetchone()[0]
+        moved = 0
+        while True:
+            row = c.execute('SELECT MIN(id) FROM stats_log_legacy').fetchone()
+            if row[0] is None:
+                break
+            moved += move_legacy_stats(c, row[0], row[0] + chunk_size - 1)
+            conn.commit()
+            time.sleep(pause)
+        c.execute('DROP VIEW IF EXISTS stats_log')
+        c.execute(f'CREATE VIEW stats_log AS {STATS_LOG_VIEW}')
+        c.execute('DROP TABLE stats_log_legacy')
+        conn.commit()
+        _legacy_stats_exists = False
+        conn.executescript('PRAGMA incremental_vacuum')
+        pages_after = c.execute('PRAGMA page_count').fetchone()[0]
+        report = {
+            'rows_moved': moved,
+            'seconds': round(time.perf_counter() - started, 2),
+            'size_before': pages_before * page_size,
+            'size_after': pages_after * page_size,
+        }
+        logger.info(f"stats_log migration finished: {report}")
+        return report
+    except Exception as e:
+        logger.error(f"Error migrating stats_log: {e}")
+        if conn:
+            conn.rollback()
+        raise
+
+def _month_bounds(month):
+    """'YYYY-MM' -> (начало месяца, начало следующего) в unix-времени UTC"""
+    year, mon = map(int, month.split('-'))
+    start = calendar.timegm((year, mon, 1, 0, 0, 0))
+    year, mon = (year + 1, 1) if mon == 12 else (year, mon + 1)
+    return start, calendar.timegm((year, mon, 1, 0, 0, 0))
+
+def archived_months(ts_from=None, ts_to=None):
+    """Возвращает архивные месяцы, пересекающиеся с [ts_from, ts_to), от старых к новым"""
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute('''SELECT month FROM stats_archives
+                 WHERE start_ts < ? AND end_ts > ?
+                 ORDER BY start_ts''',
+              (ts_to if ts_to is not None else 2 ** 62, ts_from if ts_from is not None else 0))
+    return [row['month'] for row in c.fetchall()]
+
+@contextmanager
+def attached_archive(conn, month):
+    """Подключает архив месяца к соединению как схему archive (только чтение)"""
+    row = conn.execute('SELECT path FROM stats_archives WHERE month = ?', (month,)).fetchone()
+    path = archives.path(month, row['path'])
+    conn.execute('ATTACH DATABASE ? AS archive', (f'file:{quote(path)}?mode=ro&immutable=1',))
+    try:
+        yield
+    finally:
+        conn.execute('DETACH DATABASE archive')
+
+def stats_partition_rows(c, query, params, month=None):
+    """Выполняет query над текущим разделом events (month=None) или архивом месяца.
+
+    {events} в тексте запроса заменяется таблицей нужного раздела.
+    """
+    if month is None:
+        return c.execute(query.format(events='main.events'), params).fetchall()
+    with attached_archive(c.connection, month):
+        return c.execute(query.format(events='archive.events'), params).fetchall()
+
+def seal_stats_month(conn, month, archive_dir):
+    """Переносит строки events за месяц в его архив; возвращает (строк перенесено, размер архива)"""
+    start, end = _month_bounds(month)
+    c = conn.cursor()
+    row = c.execute('SELECT path FROM stats_archives WHERE month = ?', (month,)).fetchone()
+    path = row['path'] if row else os.path.join(archive_dir, f'events_{month}.db.gz')
+    work = path[:-len('.gz')] + '.tmp'
+    if os.path.exists(work):
+        os.remove(work)
+    if row:
+        # Опоздавшие строки уже закрытого месяца дописываются к его архиву
+        with gzip.open(path, 'rb') as src, open(work, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+
+    c.execute('ATTACH DATABASE ? AS seal', (work,))
+    try:
+        c.execute('''CREATE TABLE IF NOT EXISTS seal.events
+                     (id INTEGER PRIMARY KEY,
+                      user_id INTEGER NOT NULL,
+                      action_id INTEGER NOT NULL,
+                      source_id INTEGER NOT NULL,
+                      ts INTEGER NOT NULL)''')
+        c.execute('''INSERT OR IGNORE INTO seal.events (id, user_id, action_id, source_id, ts)
+                     SELECT id, user_id, action_id, source_id, ts FROM main.events
+                     WHERE ts >= ? AND ts < ?''', (start, end))
+        moved = c.rowcount
+        conn.commit()
+        # Индекс архива строится один раз и нужен только для чтения истории
+        c.execute(f'CREATE INDEX IF NOT EXISTS seal.{EVENTS_HISTORY_INDEX}')
+        rows, min_id, max_id = c.execute('SELECT COUNT(*), MIN(id), MAX(id) FROM seal.events').fetchone()
+        conn.commit()
+        c.execute('VACUUM seal')
+    finally:
+        c.execute('DETACH DATABASE seal')
+
+    with open(work, 'rb') as src, gzip.open(path + '.tmp', 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.replace(path + '.tmp', path)
+    os.remove(work)
+    size = os.path.getsize(path)
+
+    # Новые строки получают id больше уже существующих, поэтому все строки
+    # месяца с id <= max_id попали в архив. Запись в stats_archives и удаление
+    # идут одной транзакцией: читатели видят строку либо в events, либо в архиве
+    c.execute('''INSERT INTO stats_archives (month, path, start_ts, end_ts, rows, min_id, max_id, bytes, sealed_at)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                 ON CONFLICT (month) DO UPDATE SET
+                     rows = excluded.rows,
+                     min_id = excluded.min_id,
+                     max_id = excluded.max_id,
+                     bytes = excluded.bytes,
+                     sealed_at = excluded.sealed_at''',
+              (month, path, start, end, rows, min_id, max_id, size, int(time.time())))
+    c.execute('DELETE FROM events WHERE id BETWEEN ? AND ? AND ts >= ? AND ts < ?', (min_id, max_id, start, end))
+    conn.commit()
+    archives.invalidate(month)
+    return moved, size
+
+def seal_stats_months(archive_dir=ARCHIVE_DIR, grace_days=1):
+    """Выносит закрытые месяцы из events в сжатые архивы только для чтения.
+
+    Месяц закрыт, если он закончился больше grace_days дней назад. Его
+    строки копируются в отдельный файл sqlite с индексом для чтения,
+    файл сжимается в events_YYYY-MM.db.gz, а строки удаляются из events:
+    в текущем разделе и его индексе остаются только свежие события.
+    Опоздавшие строки закрытого месяца дописываются в архив при следующем
+    запуске. Возвращает отчет о перенесенных строках и размерах.
+    """
+    conn = None
+    report = {'months': [], 'rows_archived': 0, 'archive_bytes': 0, 'bytes_reclaimed': 0}
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        # Перенос старой таблицы вставляет строки с прежними id - ждем его окончания
+        if c.execute("SELECT 1 FROM sqlite_master WHERE name = 'stats_log_legacy'").fetchone():
+            logger.info("Stats sealing postponed until stats_log migration finishes")
+            return report
+        cutoff = _month_bounds(time.strftime('%Y-%m', time.gmtime(time.time() - grace_days * 86400)))[0]
+        c.execute("SELECT DISTINCT strftime('%Y-%m', ts, 'unixepoch') FROM events WHERE ts < ?", (cutoff,))
+        months = [row[0] for row in c.fetchall()]
+        if not months:
+            return report
+        os.makedirs(archive_dir, exist_ok=True)
+        page_size = c.execute('PRAGMA page_size').fetchone()[0]
+        pages_before = c.execute('PRAGMA page_count').fetchone()[0]
+        for month in sorted(months):
+            moved, size = seal_stats_month(conn, month, archive_dir)
+            report['months'].append(month)
+            report['rows_archived'] += moved
+            report['archive_bytes'] += size
+            logger.info(f"Stats for {month} sealed: {moved} rows, archive {size} bytes")
+        conn.executescript('PRAGMA incremental_vacuum')
+        pages_after = c.execute('PRAGMA page_count').fetchone()[0]
+        report['bytes_reclaimed'] = (pages_before - pages_after) * page_size
+        return report
+    except Exception as e:
+        logger.error(f"Error sealing stats months: {e}")
+        if conn:
+            conn.rollback()
+        raise
+
+def migrate_auto_vacuum(c):
+    """Включает auto_vacuum=INCREMENTAL, чтобы очистка могла возвращать место.
+
+    На новой базе режим применяется сразу, на существующей - после
+    однократного VACUUM (файл перестраивается целиком).
+    """
+    if c.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        return
+    c.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    c.execute('VACUUM')
+    logger.info("Database switched to auto_vacuum=INCREMENTAL")
+
+# Версия схемы: увеличивается при каждом изменении create_table
+SCHEMA_VERSION = 2
+
+def ensure_schema():
+    """Создает или обновляет схему, только если ее версия в базе устарела.
+
+    На уже созданной базе это один запрос к schema_version вместо всех
+    CREATE и проверок миграций create_table. Возвращает True, если
+    create_table выполнялась.
+    """
+    conn = get_db_connection()
+    try:
+        row = conn.execute('SELECT version FROM schema_version').fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    if row is not None and row['version'] >= SCHEMA_VERSION:
+        return False
+    create_table()
+    return True
+
 def create_table():
     """Создает таблицу stats_log, если она не существует"""
     try:
         conn = get_db_connection()
         c = conn.cursor()
+        migrate_auto_vacuum(c)
         
-        # Создаем таблицу с правильной структурой
-        c.execute('''CREATE TABLE IF NOT EXISTS stats_log
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      user_id INTEGER,
+        # Нормализованная статистика: словари действий и источников,
+        # пользователи и узкая таблица событий с целочисленными ключами
+        c.execute('''CREATE TABLE IF NOT EXISTS users
+                     (user_id INTEGER PRIMARY KEY,
                       full_name TEXT,
                       username TEXT,
-                      action TEXT,
-                      source TEXT,
-                      timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
-        
-        # Создаем индексы для оптимизации запросов
-        c.execute('CREATE INDEX IF NOT EXISTS idx_user_id ON stats_log(user_id)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_action ON stats_log(action)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_source ON stats_log(source)')
+                      updated_at INTEGER)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS actions
+                     (id INTEGER PRIMARY KEY,
+                      name TEXT NOT NULL UNIQUE)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS sources
+                     (id INTEGER PRIMARY KEY,
+                      name TEXT NOT NULL UNIQUE)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS events
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      user_id INTEGER NOT NULL,
+                      action_id INTEGER NOT NULL,
+                      source_id INTEGER NOT NULL,
+                      ts INTEGER NOT NULL)''')
+        # Покрывающий индекс истории пользователя: (ts, id) задает порядок
+        # страниц, action_id и source_id читаются из индекса без обращения к таблице.
+        # events - текущий раздел, закрытые месяцы выносятся в архивы (seal_stats_months)
+        c.execute('DROP INDEX IF EXISTS idx_events_user_ts')
+        c.execute(f'CREATE INDEX IF NOT EXISTS {EVENTS_HISTORY_INDEX}')
+        c.execute('''CREATE TABLE IF NOT EXISTS stats_archives
+                     (month TEXT PRIMARY KEY,
+                      path TEXT NOT NULL,
+                      start_ts INTEGER NOT NULL,
+                      end_ts INTEGER NOT NULL,
+                      rows INTEGER,
+                      min_id INTEGER,
+                      max_id INTEGER,
+                      bytes INTEGER,
+                      sealed_at INTEGER)''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_stats_archives_range ON stats_archives(start_ts, end_ts, month)')
+        # id событий не должны повторяться после выноса месяцев в архив
+        migrate_events_autoincrement(c)
+        # stats_log - представление поверх events (старая таблица переносится в фоне)
+        migrate_stats_log_schema(c)
         
         # Создаем таблицу для хранения времени первого взаимодействия
         c.execute('''CREATE TABLE IF NOT EXISTS user_first_interaction
@@ -47,7 +684,15 @@ def create_table():
                       first_interaction_time DATETIME DEFAULT CURRENT_TIMESTAMP,
                       reminder_1_sent BOOLEAN DEFAULT 0,
                       reminder_3_sent BOOLEAN DEFAULT 0,
-                      reminder_10_sent BOOLEAN DEFAULT 0)''')
+                      reminder_10_sent BOOLEAN DEFAULT 0,
+                      reminder_stage INTEGER DEFAULT 0,
+                      next_reminder_at INTEGER,
+                      blocked BOOLEAN DEFAULT 0)''')
+        migrate_reminder_schedule(c)
+        migrate_blocked_users(c)
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_next_reminder_at
+                     ON user_first_interaction(next_reminder_at)
+                     WHERE next_reminder_at IS NOT NULL''')
         
         # Таблица для хранения неотвеченных событий
         c.execute('''CREATE TABLE IF NOT EXISTS pending_events (
@@ -58,192 +703,918 @@ def create_table():
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
             processed BOOLEAN DEFAULT 0
         )''')
-        
+        # Частичный индекс: в нем только неотвеченные события, которых обычно мало
+        c.execute('CREATE INDEX IF NOT EXISTS idx_pending_unprocessed ON pending_events(id) WHERE processed = 0')
+        # Для очистки старых обработанных событий
+        c.execute('CREATE INDEX IF NOT EXISTS idx_pending_processed_created ON pending_events(created_at) WHERE processed = 1')
+
+        # Предагрегированная статистика по источникам для /sourcestats
+        c.execute('''CREATE TABLE IF NOT EXISTS source_daily_stats (
+            source TEXT,
+            day TEXT,
+            total INTEGER DEFAULT 0,
+            conversions INTEGER DEFAULT 0,
+            new_users INTEGER DEFAULT 0,
+            PRIMARY KEY (source, day)
+        ) WITHOUT ROWID''')
+        c.execute('''CREATE TABLE IF NOT EXISTS source_users (
+            source TEXT,
+            user_id INTEGER,
+            first_day TEXT,
+            PRIMARY KEY (source, user_id)
+        ) WITHOUT ROWID''')
+        c.execute('''CREATE TABLE IF NOT EXISTS source_totals (
+            source TEXT PRIMARY KEY,
+            total INTEGER DEFAULT 0,
+            unique_users INTEGER DEFAULT 0,
+            conversions INTEGER DEFAULT 0
+        )''')
+        # /sourcestats без дат читается из этого индекса уже в нужном порядке
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_source_totals_total
+                     ON source_totals(total, source, unique_users, conversions)''')
+
+        # Воронка по источнику первого касания (update_funnel): состояние
+        # пользователя и дневные счетчики когорт по дню первого касания
+        c.execute('''CREATE TABLE IF NOT EXISTS funnel_users (
+            user_id INTEGER PRIMARY KEY,
+            source TEXT,
+            day TEXT,
+            first_ts INTEGER,
+            category_ts INTEGER,
+            offer_ts INTEGER,
+            get_loan_ts INTEGER,
+            convert_seconds INTEGER
+        )''')
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_funnel_converted
+                     ON funnel_users(day, source, convert_seconds)
+                     WHERE convert_seconds IS NOT NULL''')
+        c.execute('''CREATE TABLE IF NOT EXISTS funnel_daily (
+            day TEXT,
+            source TEXT,
+            started INTEGER DEFAULT 0,
+            category INTEGER DEFAULT 0,
+            offer INTEGER DEFAULT 0,
+            get_loan INTEGER DEFAULT 0,
+            PRIMARY KEY (day, source)
+        ) WITHOUT ROWID''')
+
+        # Журнал отправленных напоминаний и когорты их эффективности
+        # (update_reminder_cohorts) по неделе первого взаимодействия
+        c.execute('''CREATE TABLE IF NOT EXISTS reminder_sends (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            stage INTEGER NOT NULL,
+            sent_at INTEGER NOT NULL
+        )''')
+        c.execute('''CREATE TABLE IF NOT EXISTS reminder_cohorts (
+            hours INTEGER,
+            week TEXT,
+            stage INTEGER,
+            sent INTEGER DEFAULT 0,
+            returned INTEGER DEFAULT 0,
+            converted INTEGER DEFAULT 0,
+            PRIMARY KEY (hours, week, stage)
+        ) WITHOUT ROWID''')
+
+        # Кеш file_id загруженных в Telegram изображений
+        c.execute('''CREATE TABLE IF NOT EXISTS media_cache (
+            path TEXT PRIMARY KEY,
+            file_hash TEXT,
+            file_id TEXT,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )''')
+
+        # Состояния FSM (aiogram), переживающие перезапуск
+        c.execute('''CREATE TABLE IF NOT EXISTS fsm_storage (
+            chat TEXT,
+            user TEXT,
+            state TEXT,
+            data TEXT,
+            bucket TEXT,
+            PRIMARY KEY (chat, user)
+        ) WITHOUT ROWID''')
+
+        # Служебные значения бота (например, последний обработанный update_id)
+        c.execute('''CREATE TABLE IF NOT EXISTS bot_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )''')
+
+        conn.commit()
+
+        # Первый запуск с агрегатами на существующей базе - заполняем их из истории
+        c.execute('SELECT EXISTS (SELECT 1 FROM source_totals), EXISTS (SELECT 1 FROM stats_log)')
+        has_totals, has_stats = c.fetchone()
+        if has_stats and not has_totals:
+            rebuild_source_aggregates()
+
+        # Версия записывается последней: прерванное создание схемы повторится при следующем запуске
+        c.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+        c.execute('DELETE FROM schema_version')
+        c.execute('INSERT INTO schema_version (version) VALUES (?)', (SCHEMA_VERSION,))
         conn.commit()
         
-        # Создаём CSV с заголовком, если его нет
-        if not os.path.exists(CSV_FILE):
-            with open(CSV_FILE, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                writer.writerow(CSV_HEADER)
-            logger.info("Created new CSV file with headers")
-            
         logger.info("Database table and indexes created successfully")
     except Exception as e:
         logger.error(f"Error creating table: {e}")
         raise
-    finally:
-        if conn:
-            conn.close()
 
 def add_stat_row(user_id, full_name, username, action, source='direct'):
     """Добавляет строку статистики в базу данных и CSV файл"""
+    add_stat_rows([(user_id, full_name, username, action, source, time.time())])
+
+# Кеш словарей actions/sources: имя -> id
+_dictionary_ids = {'actions': {}, 'sources': {}}
+# Последние записанные (full_name, username), чтобы не обновлять users без изменений
+_known_users = {}
+KNOWN_USERS_LIMIT = 100000
+
+def dictionary_ids(c, table, names):
+    """Возвращает кеш {имя: id} словаря actions/sources, добавляя новые имена"""
+    cache = _dictionary_ids[table]
+    missing = set(names) - cache.keys()
+    if missing:
+        c.executemany(f'INSERT OR IGNORE INTO {table} (name) VALUES (?)', [(name,) for name in missing])
+        for name in missing:
+            cache[name] = c.execute(f'SELECT id FROM {table} WHERE name = ?', (name,)).fetchone()[0]
+    return cache
+
+def add_stat_rows(rows):
+    """Добавляет пачку строк статистики одной транзакцией.
+
+    rows - последовательность кортежей
+    (user_id, full_name, username, action, source, created_at),
+    где created_at - unix-время события.
+    """
+    if not rows:
+        return
     conn = None
     try:
         conn = get_db_connection()
         c = conn.cursor()
         
-        # Добавляем запись в базу данных
-        c.execute('''INSERT INTO stats_log (user_id, full_name, username, action, source)
-                     VALUES (?, ?, ?, ?, ?)''',
-                  (user_id, full_name, username, action, source))
+        rows = [(user_id, full_name, username, action, source if source is not None else 'direct', created_at)
+                for user_id, full_name, username, action, source, created_at in rows]
+        # Время события фиксируется при постановке в очередь, а не при записи
+        stat_rows = [(user_id, full_name, username, action, source,
+                      datetime.utcfromtimestamp(created_at).strftime('%Y-%m-%d %H:%M:%S'))
+                     for user_id, full_name, username, action, source, created_at in rows]
+        action_ids = dictionary_ids(c, 'actions', {row[3] for row in stat_rows})
+        source_ids = dictionary_ids(c, 'sources', {row[4] for row in stat_rows})
+
+        # users обновляется только при смене имени или username
+        changed = {}
+        for user_id, full_name, username, _, _, created_at in rows:
+            if _known_users.get(user_id) != (full_name, username):
+                changed[user_id] = (user_id, full_name, username, int(created_at))
+        c.executemany('''INSERT INTO users (user_id, full_name, username, updated_at)
+                         VALUES (?, ?, ?, ?)
+                         ON CONFLICT (user_id) DO UPDATE SET
+                             full_name = excluded.full_name,
+                             username = excluded.username,
+                             updated_at = excluded.updated_at
+                         WHERE users.full_name IS NOT excluded.full_name
+                            OR users.username IS NOT excluded.username''', changed.values())
+
+        c.executemany('''INSERT INTO events (user_id, action_id, source_id, ts) VALUES (?, ?, ?, ?)''',
+                      [(user_id, action_ids[action], source_ids[source], int(created_at))
+                       for user_id, _, _, action, source, created_at in rows])
+        # Агрегаты для /sourcestats обновляются в той же транзакции
+        update_source_aggregates(c, stat_rows)
         conn.commit()
-        
-        # Запись в CSV
-        try:
-            with open(CSV_FILE, 'a', newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                writer.writerow([user_id, full_name, username, action, source, datetime.now().isoformat()])
-        except Exception as e:
-            logger.error(f"Error writing to CSV: {e}")
-            # Продолжаем работу даже если не удалось записать в CSV
+
+        if len(_known_users) > KNOWN_USERS_LIMIT:
+            _known_users.clear()
+        for user_id, full_name, username, _ in changed.values():
+            _known_users[user_id] = (full_name, username)
             
     except Exception as e:
-        logger.error(f"Error adding stat row: {e}")
+        logger.error(f"Error adding stat rows: {e}")
         if conn:
             conn.rollback()
+        # Новые имена словарей могли не сохраниться - перечитаем их из базы
+        for cache in _dictionary_ids.values():
+            cache.clear()
         raise
-    finally:
-        if conn:
-            conn.close()
 
-def get_source_stats():
-    """Получает статистику по источникам"""
+def update_source_aggregates(c, stat_rows):
+    """Инкрементально обновляет агрегаты по источникам для новых строк статистики.
+
+    stat_rows - кортежи (user_id, full_name, username, action, source, timestamp).
+    """
+    daily = {}
+    first_seen = {}
+    for user_id, _, _, action, source, timestamp in stat_rows:
+        day = timestamp[:10]
+        counters = daily.setdefault((source, day), [0, 0, 0])
+        counters[0] += 1
+        if action.startswith('get_loan_'):
+            counters[1] += 1
+        first_seen.setdefault((source, user_id), day)
+
+    # Новый уникальный пользователь источника засчитывается в день первого события
+    for (source, user_id), day in first_seen.items():
+        c.execute('''INSERT OR IGNORE INTO source_users (source, user_id, first_day) VALUES (?, ?, ?)''',
+                  (source, user_id, day))
+        if c.rowcount:
+            daily[(source, day)][2] += 1
+
+    c.executemany('''INSERT INTO source_daily_stats (source, day, total, conversions, new_users)
+                     VALUES (?, ?, ?, ?, ?)
+                     ON CONFLICT (source, day) DO UPDATE SET
+                         total = total + excluded.total,
+                         conversions = conversions + excluded.conversions,
+                         new_users = new_users + excluded.new_users''',
+                  [(source, day, total, conversions, new_users)
+                   for (source, day), (total, conversions, new_users) in daily.items()])
+
+    totals = {}
+    for (source, _), (total, conversions, new_users) in daily.items():
+        counters = totals.setdefault(source, [0, 0, 0])
+        counters[0] += total
+        counters[1] += new_users
+        counters[2] += conversions
+    c.executemany('''INSERT INTO source_totals (source, total, unique_users, conversions)
+                     VALUES (?, ?, ?, ?)
+                     ON CONFLICT (source) DO UPDATE SET
+                         total = total + excluded.total,
+                         unique_users = unique_users + excluded.unique_users,
+                         conversions = conversions + excluded.conversions''',
+                  [(source, total, unique_users, conversions)
+                   for source, (total, unique_users, conversions) in totals.items()])
+
+def aggregate_stats_rows(c, relation, users_table='source_users', daily_table='source_daily_stats'):
+    """Добавляет в агрегаты по источникам строки relation (stats_log или архив месяца)"""
+    c.execute(f'''
+        INSERT INTO {users_table} (source, user_id, first_day)
+        SELECT COALESCE(source, 'direct'), user_id, MIN(date(timestamp))
+        FROM {relation}
+        WHERE true
+        GROUP BY COALESCE(source, 'direct'), user_id
+        ON CONFLICT (source, user_id) DO UPDATE SET first_day = MIN(first_day, excluded.first_day)
+    ''')
+    c.execute(f'''
+        INSERT INTO {daily_table} (source, day, total, conversions, new_users)
+        SELECT COALESCE(source, 'direct'), date(timestamp), COUNT(*),
+               SUM(CASE WHEN action LIKE 'get_loan_%' THEN 1 ELSE 0 END), 0
+        FROM {relation}
+        WHERE true
+        GROUP BY COALESCE(source, 'direct'), date(timestamp)
+        ON CONFLICT (source, day) DO UPDATE SET
+            total = total + excluded.total,
+            conversions = conversions + excluded.conversions
+    ''')
+
+def rebuild_source_aggregates():
+    """Пересобирает агрегаты по источникам из stats_log и архивов (backfill).
+
+    Архивы подключаются по одному, поэтому их агрегаты сначала копятся
+    во временных таблицах; сами агрегаты заменяются одной транзакцией.
+    """
     conn = None
     try:
         conn = get_db_connection()
         c = conn.cursor()
-        
+        c.execute('''CREATE TEMP TABLE IF NOT EXISTS rebuild_source_users
+                     (source TEXT, user_id INTEGER, first_day TEXT, PRIMARY KEY (source, user_id))''')
+        c.execute('''CREATE TEMP TABLE IF NOT EXISTS rebuild_source_daily_stats
+                     (source TEXT, day TEXT, total INTEGER, conversions INTEGER, new_users INTEGER,
+                      PRIMARY KEY (source, day))''')
+        c.execute('DELETE FROM temp.rebuild_source_users')
+        c.execute('DELETE FROM temp.rebuild_source_daily_stats')
+        conn.commit()
+        for month in archived_months():
+            with attached_archive(conn, month):
+                aggregate_stats_rows(c, f"({STATS_LOG_SELECT.format(events='archive.events')})",
+                                     'temp.rebuild_source_users', 'temp.rebuild_source_daily_stats')
+                conn.commit()
+
+        c.execute('DELETE FROM source_users')
+        c.execute('DELETE FROM source_daily_stats')
+        c.execute('DELETE FROM source_totals')
+        c.execute('INSERT INTO source_users SELECT * FROM temp.rebuild_source_users')
+        c.execute('INSERT INTO source_daily_stats SELECT * FROM temp.rebuild_source_daily_stats')
+        aggregate_stats_rows(c, 'stats_log')
+        c.execute('''
+            UPDATE source_daily_stats
+            SET new_users = (SELECT COUNT(*) FROM source_users u
+                             WHERE u.source = source_daily_stats.source
+                             AND u.first_day = source_daily_stats.day)
+        ''')
         c.execute('''
-            SELECT source, 
-                   COUNT(*) as total_users,
-                   COUNT(DISTINCT user_id) as unique_users,
-                   SUM(CASE WHEN action LIKE 'get_loan_%' THEN 1 ELSE 0 END) as conversions
-            FROM stats_log 
+            INSERT INTO source_totals (source, total, unique_users, conversions)
+            SELECT source, SUM(total), SUM(new_users), SUM(conversions)
+            FROM source_daily_stats
             GROUP BY source
-            ORDER BY total_users DESC
         ''')
+        conn.commit()
+        c.execute('SELECT COUNT(*) FROM source_daily_stats')
+        days = c.fetchone()[0]
+        logger.info(f"Source aggregates rebuilt: {days} source/day rows")
+        return days
+    except Exception as e:
+        logger.error(f"Error rebuilding source aggregates: {e}")
+        if conn:
+            conn.rollback()
+        raise
+
+def get_source_stats(date_from=None, date_to=None):
+    """Получает статистику по источникам из предагрегированных таблиц.
+
+    Без дат ответ берется из source_totals и не зависит от объема истории.
+    С диапазоном дат (YYYY-MM-DD, включительно) суммируются дневные агрегаты,
+    а unique_users - это пользователи, впервые пришедшие из источника в этом диапазоне.
+    Агрегаты не удаляются при архивации месяцев, поэтому любой диапазон
+    отвечается без чтения архивов.
+    """
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        
+        if date_from is None and date_to is None:
+            c.execute('''
+                SELECT source, total as total_users, unique_users, conversions
+                FROM source_totals
+                ORDER BY total_users DESC
+            ''')
+        else:
+            # Для каждого источника читается только диапазон дней из первичного
+            # ключа (source, day); строк в ответе столько же, сколько источников,
+            # поэтому сортировка по сумме делается в Python
+            c.execute('''
+                SELECT t.source AS source,
+                       SUM(d.total) as total_users,
+                       SUM(d.new_users) as unique_users,
+                       SUM(d.conversions) as conversions
+                FROM source_totals t
+                JOIN source_daily_stats d ON d.source = t.source AND d.day BETWEEN ? AND ?
+                GROUP BY t.source
+            ''', (date_from or '0000-00-00', date_to or '9999-99-99'))
+            return sorted(c.fetchall(), key=lambda row: row['total_users'], reverse=True)
         
         return c.fetchall()
     except Exception as e:
         logger.error(f"Error getting source stats: {e}")
         return []
-    finally:
-        if conn:
-            conn.close()
 
-def get_user_stats(user_id):
-    """Получает статистику по конкретному пользователю"""
+def _day_range(date_from=None, date_to=None):
+    """Диапазон дат YYYY-MM-DD (включительно) -> [ts_from, ts_to) в unix-времени"""
+    ts_from = _epoch(f'{date_from} 00:00:00') if date_from else 0
+    ts_to = _epoch(f'{date_to} 00:00:00') + 86400 if date_to else 2 ** 62
+    return ts_from, ts_to
+
+def legacy_user_rows(c, user_id, condition='', params=(), order='DESC', limit=-1):
+    """Строки пользователя из stats_log_legacy, пока идет ее перенос (иначе пусто).
+
+    Читается до events: строка, перенесенная между двумя запросами,
+    попадет в оба результата (одинаковый id) и не потеряется.
+    """
+    if not has_legacy_stats(c):
+        return []
+    c.execute(f'''SELECT id, COALESCE(action, '') AS action, COALESCE(source, 'direct') AS source, timestamp
+                  FROM stats_log_legacy
+                  WHERE user_id = ? {condition}
+                  ORDER BY timestamp {order}, id {order}
+                  LIMIT ?''', (user_id, *params, limit))
+    return c.fetchall()
+
+def _merge_legacy(rows, legacy):
+    """Добавляет к строкам events еще не перенесенные строки stats_log_legacy"""
+    moved = {row['id'] for row in rows}
+    return rows + [row for row in legacy if row['id'] not in moved]
+
+def get_user_stats(user_id, date_from=None, date_to=None):
+    """Получает статистику по конкретному пользователю.
+
+    date_from/date_to (YYYY-MM-DD, включительно) ограничивают период;
+    закрытые месяцы этого периода читаются из архивов.
+    """
     conn = None
     try:
         conn = get_db_connection()
         c = conn.cursor()
         
-        c.execute('''
-            SELECT action, source, timestamp
-            FROM stats_log
-            WHERE user_id = ?
-            ORDER BY timestamp DESC
-        ''', (user_id,))
-        
-        return c.fetchall()
+        ts_from, ts_to = _day_range(date_from, date_to)
+        # Граница - строка, а не число: столбец timestamp старой таблицы с числовой аффинностью
+        legacy = legacy_user_rows(c, user_id, 'AND timestamp >= ? AND timestamp < ?',
+                                  (date_from or '', f'{date_to or "9999-12-31"} 24:00:00'))
+        query = '''
+            SELECT e.id AS id, a.name AS action, s.name AS source, datetime(e.ts, 'unixepoch') AS timestamp
+            FROM {events} e
+            JOIN actions a ON a.id = e.action_id
+            JOIN sources s ON s.id = e.source_id
+            WHERE e.user_id = ? AND e.ts >= ? AND e.ts < ?
+            ORDER BY e.ts DESC
+        '''
+        params = (user_id, ts_from, ts_to)
+        rows = _merge_legacy(stats_partition_rows(c, query, params), legacy)
+        for month in archived_months(ts_from, ts_to):
+            rows += stats_partition_rows(c, query, params, month)
+        rows.sort(key=lambda row: row['timestamp'], reverse=True)
+        return rows
     except Exception as e:
         logger.error(f"Error getting user stats: {e}")
         return []
+
+def _epoch(timestamp):
+    """'YYYY-MM-DD HH:MM:SS' (UTC) -> unix-время"""
+    return calendar.timegm(time.strptime(timestamp, '%Y-%m-%d %H:%M:%S'))
+
+def get_user_stats_page(user_id, limit=20, before=None, after=None):
+    """Получает страницу статистики пользователя по курсору (keyset-пагинация).
+
+    before/after - курсор (timestamp, id): строки старше или новее курсора.
+    Возвращает до limit + 1 строк от новых к старым; лишняя строка
+    показывает, что в выбранном направлении есть еще записи. Когда
+    текущего раздела не хватает, страница дочитывается из архивов.
+    """
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        
+        query = '''
+            SELECT e.id AS id, a.name AS action, s.name AS source,
+                   datetime(e.ts, 'unixepoch') AS timestamp
+            FROM {{events}} e
+            JOIN actions a ON a.id = e.action_id
+            JOIN sources s ON s.id = e.source_id
+            WHERE e.user_id = ? {condition}
+            ORDER BY e.ts {order}, e.id {order}
+            LIMIT ?
+        '''
+        if after is not None:
+            ascending = True
+            legacy = legacy_user_rows(c, user_id, 'AND (timestamp, id) > (?, ?)', after, 'ASC', limit + 1)
+            query = query.format(condition='AND (e.ts, e.id) > (?, ?)', order='ASC')
+            params = (user_id, _epoch(after[0]), after[1], limit + 1)
+            months = archived_months(ts_from=params[1])
+        else:
+            ascending = False
+            if before is not None:
+                legacy = legacy_user_rows(c, user_id, 'AND (timestamp, id) < (?, ?)', before, 'DESC', limit + 1)
+                query = query.format(condition='AND (e.ts, e.id) < (?, ?)', order='DESC')
+                params = (user_id, _epoch(before[0]), before[1], limit + 1)
+                months = archived_months(ts_to=params[1] + 1)
+            else:
+                legacy = legacy_user_rows(c, user_id, limit=limit + 1)
+                query = query.format(condition='', order='DESC')
+                params = (user_id, limit + 1)
+                months = archived_months()
+            months.reverse()
+
+        def key(row):
+            return row['timestamp'], row['id']
+
+        rows = _merge_legacy(stats_partition_rows(c, query, params), legacy)
+        for month in months:
+            # Месяцы архивов не пересекаются: если limit + 1 ближайших строк
+            # найдены и все ближе к курсору, чем этот месяц, дальше читать не нужно
+            if len(rows) > limit:
+                rows.sort(key=key, reverse=not ascending)
+                start, end = _month_bounds(month)
+                boundary = _epoch(rows[limit]['timestamp'])
+                if boundary < start if ascending else boundary >= end:
+                    break
+            rows += stats_partition_rows(c, query, params, month)
+        rows.sort(key=key, reverse=not ascending)
+        rows = rows[:limit + 1]
+        if ascending:
+            rows.reverse()
+        return rows
+    except Exception as e:
+        logger.error(f"Error getting user stats page: {e}")
+        return []
+
+def iter_stat_rows(after_id=0, chunk_size=5000):
+    """Потоково читает stats_log с id > after_id по возрастанию id.
+
+    Опоздавшие строки дописываются в архив своего месяца, поэтому диапазоны
+    id архивов и текущего раздела перекрываются, и по разделам подряд id
+    не возрастают (водяной знак по последней строке пропускал бы строки).
+    Поэтому чтение идет окнами по chunk_size id: в окне собираются строки
+    текущего раздела и всех архивов, чей диапазон id его задевает. id
+    уникальны, поэтому в памяти не больше chunk_size строк.
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        while True:
+            # Сначала текущий раздел, затем архивы: строка, которую между
+            # запросами вынесли в архив, найдется там (дубли отсеиваются по id)
+            # MIN берется по таблицам, а не по представлению: через JOIN
+            # sqlite не сводит его к одному шагу по первичному ключу
+            starts = [c.execute('SELECT MIN(id) FROM events WHERE id > ?', (after_id,)).fetchone()[0]]
+            if has_legacy_stats(c):
+                starts.append(c.execute('SELECT MIN(id) FROM stats_log_legacy WHERE id > ?', (after_id,)).fetchone()[0])
+            c.execute('SELECT MAX(COALESCE(min_id, 0), ?) FROM stats_archives WHERE max_id > ?',
+                      (after_id + 1, after_id))
+            starts += [row[0] for row in c.fetchall()]
+            starts = [start for start in starts if start is not None]
+            if not starts:
+                return
+            first_id = min(starts)
+            last_id = first_id + chunk_size - 1
+
+            c.execute('''
+                SELECT id, user_id, full_name, username, action, source, timestamp
+                FROM stats_log
+                WHERE id BETWEEN ? AND ?
+            ''', (first_id, last_id))
+            rows = {row['id']: row for row in c.fetchall()}
+            c.execute('''SELECT month FROM stats_archives
+                         WHERE max_id >= ? AND COALESCE(min_id, 0) <= ?
+                         ORDER BY month''', (first_id, last_id))
+            for month in [row['month'] for row in c.fetchall()]:
+                with attached_archive(conn, month):
+                    archive = conn.cursor()
+                    try:
+                        archive.execute(STATS_LOG_SELECT.format(events='archive.events') +
+                                        ' WHERE e.id BETWEEN ? AND ?', (first_id, last_id))
+                        for row in archive.fetchall():
+                            rows.setdefault(row['id'], row)
+                    finally:
+                        # Курсор закрывается до DETACH, иначе архив занят
+                        archive.close()
+            for row_id in sorted(rows):
+                yield rows[row_id]
+            after_id = last_id
+    except Exception as e:
+        logger.error(f"Error reading stats_log: {e}")
+        raise
     finally:
+        c.close()
+
+# Шаги воронки после первого касания; у каждого шага - столбцы
+# <шаг>_ts в funnel_users и <шаг> в funnel_daily
+FUNNEL_STEPS = ('category', 'offer', 'get_loan')
+FUNNEL_WATERMARK_KEY = 'funnel_last_event_id'
+
+def update_funnel(step_of, chunk_size=5000):
+    """Дообрабатывает воронку событиями после сохраненного водяного знака.
+
+    step_of(action) возвращает шаг из FUNNEL_STEPS или None. Источник и
+    день пользователя берутся из его первого события (первое касание);
+    для каждого шага запоминается время первого достижения, а дневные
+    счетчики когорты увеличиваются на новых пользователей и шаги.
+    События читаются пачками (вместе с архивами), каждая пачка и
+    водяной знак сохраняются одной транзакцией. Возвращает число событий.
+    """
+    conn = None
+    processed = 0
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        after_id = int(get_bot_state(FUNNEL_WATERMARK_KEY, 0))
+        while True:
+            rows_iter = iter_stat_rows(after_id, chunk_size)
+            try:
+                rows = list(islice(rows_iter, chunk_size))
+            finally:
+                rows_iter.close()
+            if not rows:
+                break
+
+            user_ids = list({row['user_id'] for row in rows})
+            placeholders = ','.join('?' * len(user_ids))
+            c.execute(f'SELECT * FROM funnel_users WHERE user_id IN ({placeholders})', user_ids)
+            users = {row['user_id']: dict(row) for row in c.fetchall()}
+            changed = set()
+            daily = defaultdict(lambda: dict.fromkeys(('started',) + FUNNEL_STEPS, 0))
+            for row in rows:
+                ts = _epoch(row['timestamp'])
+                user = users.get(row['user_id'])
+                if user is None:
+                    user = users[row['user_id']] = {
+                        'user_id': row['user_id'], 'source': row['source'] or 'direct',
+                        'day': row['timestamp'][:10], 'first_ts': ts, 'category_ts': None,
+                        'offer_ts': None, 'get_loan_ts': None, 'convert_seconds': None,
+                    }
+                    daily[(user['day'], user['source'])]['started'] += 1
+                    changed.add(row['user_id'])
+                step = step_of(row['action'])
+                if step is None or user[f'{step}_ts'] is not None:
+                    continue
+                user[f'{step}_ts'] = ts
+                if step == 'get_loan':
+                    user['convert_seconds'] = max(ts - user['first_ts'], 0)
+                daily[(user['day'], user['source'])][step] += 1
+                changed.add(row['user_id'])
+
+            c.executemany('''INSERT OR REPLACE INTO funnel_users
+                             (user_id, source, day, first_ts, category_ts, offer_ts, get_loan_ts, convert_seconds)
+                             VALUES (:user_id, :source, :day, :first_ts, :category_ts, :offer_ts,
+                                     :get_loan_ts, :convert_seconds)''',
+                          [users[user_id] for user_id in changed])
+            c.executemany('''INSERT INTO funnel_daily (day, source, started, category, offer, get_loan)
+                             VALUES (:day, :source, :started, :category, :offer, :get_loan)
+                             ON CONFLICT (day, source) DO UPDATE SET
+                                 started = started + excluded.started,
+                                 category = category + excluded.category,
+                                 offer = offer + excluded.offer,
+                                 get_loan = get_loan + excluded.get_loan''',
+                          [dict(counters, day=day, source=source) for (day, source), counters in daily.items()])
+            # iter_stat_rows отдает строки по возрастанию id во всех разделах
+            after_id = rows[-1]['id']
+            c.execute('''INSERT INTO bot_state (key, value) VALUES (?, ?)
+                         ON CONFLICT(key) DO UPDATE SET value = excluded.value''',
+                      (FUNNEL_WATERMARK_KEY, str(after_id)))
+            conn.commit()
+            processed += len(rows)
+        return processed
+    except Exception as e:
+        logger.error(f"Error updating funnel: {e}")
         if conn:
-            conn.close()
+            conn.rollback()
+        raise
+
+def get_funnel_days(date_from=None, date_to=None, source=None):
+    """Дневные счетчики воронки за период (YYYY-MM-DD, включительно), по дням"""
+    conn = get_db_connection()
+    c = conn.cursor()
+    query = '''SELECT day, source, started, category, offer, get_loan
+               FROM funnel_daily
+               WHERE day BETWEEN ? AND ? {condition}
+               ORDER BY day'''
+    params = [date_from or '0000-00-00', date_to or '9999-99-99']
+    if source is not None:
+        params.append(source)
+    c.execute(query.format(condition='AND source = ?' if source is not None else ''), params)
+    return c.fetchall()
+
+def get_funnel_convert_times(date_from=None, date_to=None, source=None):
+    """Время от первого касания до get_loan (секунды) у сконвертировавшихся за период"""
+    conn = get_db_connection()
+    c = conn.cursor()
+    query = '''SELECT day, source, convert_seconds
+               FROM funnel_users
+               WHERE convert_seconds IS NOT NULL AND day BETWEEN ? AND ? {condition}'''
+    params = [date_from or '0000-00-00', date_to or '9999-99-99']
+    if source is not None:
+        params.append(source)
+    c.execute(query.format(condition='AND source = ?' if source is not None else ''), params)
+    return c.fetchall()
 
 def add_user_first_interaction(user_id):
-    """Добавляет или обновляет время первого взаимодействия пользователя"""
+    """Добавляет время первого взаимодействия пользователя.
+
+    Возвращает время первого напоминания (unix-время), если пользователь
+    новый. Пользователю, который заблокировал бота и снова пришел в /start,
+    возвращаются напоминания со следующей стадии (не раньше чем через
+    REMINDER_DAYS[0] дней) - возвращается ее срок. Иначе None.
+    """
     conn = None
     try:
         conn = get_db_connection()
         c = conn.cursor()
         
-        # Проверяем, существует ли запись для пользователя
-        c.execute('SELECT user_id FROM user_first_interaction WHERE user_id = ?', (user_id,))
-        if not c.fetchone():
-            # Если записи нет, создаем новую
-            c.execute('INSERT INTO user_first_interaction (user_id) VALUES (?)', (user_id,))
-            conn.commit()
+        # Вставляем запись только для нового пользователя и сразу планируем первое напоминание
+        next_reminder_at = int(time.time()) + REMINDER_DAYS[0] * 86400
+        c.execute('''INSERT OR IGNORE INTO user_first_interaction (user_id, next_reminder_at)
+                     VALUES (?, ?)''', (user_id, next_reminder_at))
+        conn.commit()
+        if c.rowcount:
             logger.info(f"Added first interaction time for user {user_id}")
+            return next_reminder_at
+
+        c.execute('''SELECT CAST(strftime('%s', first_interaction_time) AS INTEGER) AS first_interaction_at,
+                            reminder_stage
+                     FROM user_first_interaction
+                     WHERE user_id = ? AND blocked = 1''', (user_id,))
+        row = c.fetchone()
+        if row is None:
+            return None
+        later = [day for day in REMINDER_DAYS if day > row['reminder_stage']]
+        next_reminder_at = max(row['first_interaction_at'] + later[0] * 86400, next_reminder_at) if later else None
+        c.execute('UPDATE user_first_interaction SET blocked = 0, next_reminder_at = ? WHERE user_id = ?',
+                  (next_reminder_at, user_id))
+        conn.commit()
+        logger.info(f"User {user_id} is back after blocking the bot, reminders resumed")
+        return next_reminder_at
     except Exception as e:
         logger.error(f"Error adding user first interaction: {e}")
         if conn:
             conn.rollback()
         raise
-    finally:
-        if conn:
-            conn.close()
 
-def get_users_for_reminder():
-    """Получает список пользователей, которым нужно отправить напоминание"""
+def get_due_reminders(until, limit=500):
+    """Получает пользователей, у которых следующее напоминание наступает до until (unix-время)"""
     conn = None
     try:
         conn = get_db_connection()
         c = conn.cursor()
         
-        current_time = datetime.now()
-        
-        # Получаем пользователей, которым нужно отправить напоминание через 1 день
-        c.execute('''
-            SELECT user_id, first_interaction_time 
-            FROM user_first_interaction 
-            WHERE reminder_1_sent = 0 
-            AND datetime(first_interaction_time, '+1 day') <= datetime(?)
-        ''', (current_time,))
-        day_1_users = c.fetchall()
-        
-        # Получаем пользователей, которым нужно отправить напоминание через 3 дня
+        # Запрос идет по индексу idx_next_reminder_at
         c.execute('''
-            SELECT user_id, first_interaction_time 
-            FROM user_first_interaction 
-            WHERE reminder_3_sent = 0 
-            AND datetime(first_interaction_time, '+3 days') <= datetime(?)
-        ''', (current_time,))
-        day_3_users = c.fetchall()
-        
-        # Получаем пользователей, которым нужно отправить напоминание через 10 дней
-        c.execute('''
-            SELECT user_id, first_interaction_time 
-            FROM user_first_interaction 
-            WHERE reminder_10_sent = 0 
-            AND datetime(first_interaction_time, '+10 days') <= datetime(?)
-        ''', (current_time,))
-        day_10_users = c.fetchall()
-        
-        return {
-            'day_1': day_1_users,
-            'day_3': day_3_users,
-            'day_10': day_10_users
-        }
+            SELECT user_id, CAST(strftime('%s', first_interaction_time) AS INTEGER) AS first_interaction_at,
+                   reminder_stage, next_reminder_at
+            FROM user_first_interaction
+            WHERE next_reminder_at <= ?
+            ORDER BY next_reminder_at
+            LIMIT ?
+        ''', (until, limit))
+        return c.fetchall()
     except Exception as e:
-        logger.error(f"Error getting users for reminder: {e}")
-        return {'day_1': [], 'day_3': [], 'day_10': []}
-    finally:
-        if conn:
-            conn.close()
+        logger.error(f"Error getting due reminders: {e}")
+        return []
+
+def get_reminder_states(user_ids):
+    """Получает текущую стадию и срок напоминания для списка пользователей"""
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        placeholders = ','.join('?' * len(user_ids))
+        c.execute(f'''
+            SELECT user_id, CAST(strftime('%s', first_interaction_time) AS INTEGER) AS first_interaction_at,
+                   reminder_stage, next_reminder_at
+            FROM user_first_interaction
+            WHERE user_id IN ({placeholders})
+        ''', list(user_ids))
+        return c.fetchall()
+    except Exception as e:
+        logger.error(f"Error getting reminder states: {e}")
+        return []
 
 def mark_reminder_sent(user_id, reminder_type):
-    """Отмечает, что напоминание было отправлено"""
+    """Отмечает, что напоминание было отправлено, и планирует следующее"""
+    mark_reminders_sent([(user_id, reminder_type)])
+
+def mark_reminders_sent(reminders, sent_at=None):
+    """Отмечает пачку отправленных напоминаний одной транзакцией.
+
+    reminders - последовательность пар (user_id, стадия). Каждая отправка
+    записывается в журнал reminder_sends со временем sent_at (unix-время).
+    """
+    if not reminders:
+        return
     conn = None
     try:
         conn = get_db_connection()
         c = conn.cursor()
         
-        column = f'reminder_{reminder_type}_sent'
-        c.execute(f'UPDATE user_first_interaction SET {column} = 1 WHERE user_id = ?', (user_id,))
+        sent_at = int(time.time()) if sent_at is None else int(sent_at)
+        c.executemany('INSERT INTO reminder_sends (user_id, stage, sent_at) VALUES (?, ?, ?)',
+                      [(user_id, int(reminder_type), sent_at) for user_id, reminder_type in reminders])
+        by_stage = {}
+        for user_id, reminder_type in reminders:
+            by_stage.setdefault(int(reminder_type), []).append(user_id)
+        for stage, user_ids in by_stage.items():
+            column = f'reminder_{stage}_sent'
+            later = [day for day in REMINDER_DAYS if day > stage]
+            # Следующее напоминание отсчитывается от первого взаимодействия
+            c.executemany(f'''UPDATE user_first_interaction
+                              SET {column} = 1,
+                                  reminder_stage = ?,
+                                  next_reminder_at = CAST(strftime('%s', first_interaction_time, ?) AS INTEGER)
+                              WHERE user_id = ?''',
+                          [(stage, f'+{later[0]} days' if later else None, user_id) for user_id in user_ids])
         conn.commit()
-        logger.info(f"Marked {reminder_type} day reminder as sent for user {user_id}")
+        logger.info(f"Marked {len(reminders)} reminders as sent")
     except Exception as e:
         logger.error(f"Error marking reminder as sent: {e}")
         if conn:
             conn.rollback()
         raise
-    finally:
+
+def reschedule_reminders(schedule):
+    """Переносит напоминания пачкой; schedule - пары (user_id, next_reminder_at)"""
+    if not schedule:
+        return
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.executemany('UPDATE user_first_interaction SET next_reminder_at = ? WHERE user_id = ?',
+                      [(next_reminder_at, user_id) for user_id, next_reminder_at in schedule])
+        conn.commit()
+    except Exception as e:
+        logger.error(f"Error rescheduling reminder: {e}")
+        if conn:
+            conn.rollback()
+        raise
+
+def mark_users_blocked(user_ids):
+    """Отмечает пользователей, заблокировавших бота: напоминания им больше не планируются"""
+    if not user_ids:
+        return
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.executemany('UPDATE user_first_interaction SET blocked = 1, next_reminder_at = NULL WHERE user_id = ?',
+                      [(user_id,) for user_id in user_ids])
+        conn.commit()
+        logger.info(f"Marked {len(user_ids)} users as blocked")
+    except Exception as e:
+        logger.error(f"Error marking users as blocked: {e}")
+        if conn:
+            conn.rollback()
+        raise
+
+# Окна (в часах) когорт напоминаний: вернулся ли пользователь и дошел ли до get_loan
+REMINDER_COHORT_HOURS = (24, 72)
+REMINDER_COHORTS_WATERMARK_KEY = 'reminder_cohorts_last_send_id'
+
+def _week_start(ts):
+    """Unix-время -> понедельник его недели (YYYY-MM-DD, UTC)"""
+    day = ts // 86400
+    # 1970-01-01 - четверг
+    return time.strftime('%Y-%m-%d', time.gmtime((day - (day + 3) % 7) * 86400))
+
+def reminder_response(c, user_id, ts_from, ts_to):
+    """Первое событие и первая конверсия пользователя в [ts_from, ts_to) (вместе с архивами)"""
+    query = '''
+        SELECT MIN(e.ts) AS returned_ts,
+               MIN(CASE WHEN a.name LIKE 'get_loan_%' THEN e.ts END) AS converted_ts
+        FROM {events} e
+        JOIN actions a ON a.id = e.action_id
+        WHERE e.user_id = ? AND e.ts >= ? AND e.ts < ?
+    '''
+    params = (user_id, ts_from, ts_to)
+    rows = stats_partition_rows(c, query, params)
+    for month in archived_months(ts_from, ts_to):
+        rows += stats_partition_rows(c, query, params, month)
+    returned = [row['returned_ts'] for row in rows if row['returned_ts'] is not None]
+    converted = [row['converted_ts'] for row in rows if row['converted_ts'] is not None]
+    return min(returned, default=None), min(converted, default=None)
+
+def update_reminder_cohorts(hours=REMINDER_COHORT_HOURS, now=None, chunk_size=1000):
+    """Дообрабатывает когорты напоминаний отправками после водяного знака.
+
+    Отправка учитывается, когда закрылось самое длинное окно из hours:
+    для каждого окна N часов считается, вернулся ли пользователь (любое
+    событие) и сконвертировался ли (get_loan_*) в течение N часов после
+    напоминания. Счетчики копятся по (окно, неделя первого взаимодействия,
+    стадия); каждая пачка и водяной знак сохраняются одной транзакцией,
+    поэтому уже учтенные отправки повторно не читаются. Возвращает число
+    обработанных отправок.
+    """
+    conn = None
+    processed = 0
+    now = int(time.time()) if now is None else int(now)
+    longest = max(hours) * 3600
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        after_id = int(get_bot_state(REMINDER_COHORTS_WATERMARK_KEY, 0))
+        while True:
+            c.execute('''SELECT s.id, s.user_id, s.stage, s.sent_at,
+                                CAST(strftime('%s', u.first_interaction_time) AS INTEGER) AS first_at
+                         FROM reminder_sends s
+                         LEFT JOIN user_first_interaction u ON u.user_id = s.user_id
+                         WHERE s.id > ?
+                         ORDER BY s.id
+                         LIMIT ?''', (after_id, chunk_size))
+            sends = c.fetchall()
+            # id отправок растут вместе с sent_at: первая незакрытая отправка завершает проход
+            sends = sends[:next((i for i, send in enumerate(sends) if send['sent_at'] + longest > now), len(sends))]
+            if not sends:
+                break
+
+            cohorts = defaultdict(lambda: [0, 0, 0])
+            for send in sends:
+                returned_ts, converted_ts = reminder_response(
+                    c, send['user_id'], send['sent_at'], send['sent_at'] + longest)
+                first_at = send['first_at'] or send['sent_at'] - send['stage'] * 86400
+                week = _week_start(first_at)
+                for window in hours:
+                    until = send['sent_at'] + window * 3600
+                    counters = cohorts[(window, week, send['stage'])]
+                    counters[0] += 1
+                    counters[1] += returned_ts is not None and returned_ts < until
+                    counters[2] += converted_ts is not None and converted_ts < until
+
+            c.executemany('''INSERT INTO reminder_cohorts (hours, week, stage, sent, returned, converted)
+                             VALUES (?, ?, ?, ?, ?, ?)
+                             ON CONFLICT (hours, week, stage) DO UPDATE SET
+                                 sent = sent + excluded.sent,
+                                 returned = returned + excluded.returned,
+                                 converted = converted + excluded.converted''',
+                          [key + tuple(counters) for key, counters in cohorts.items()])
+            after_id = sends[-1]['id']
+            c.execute('''INSERT INTO bot_state (key, value) VALUES (?, ?)
+                         ON CONFLICT(key) DO UPDATE SET value = excluded.value''',
+                      (REMINDER_COHORTS_WATERMARK_KEY, str(after_id)))
+            conn.commit()
+            processed += len(sends)
+        return processed
+    except Exception as e:
+        logger.error(f"Error updating reminder cohorts: {e}")
         if conn:
-            conn.close()
+            conn.rollback()
+        raise
+
+def get_reminder_cohorts(hours, week_from=None):
+    """Когорты напоминаний для окна hours: строки (week, stage, sent, returned, converted)"""
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute('''SELECT week, stage, sent, returned, converted
+                 FROM reminder_cohorts
+                 WHERE hours = ? AND week >= ?
+                 ORDER BY week, stage''', (hours, week_from or '0000-00-00'))
+    return c.fetchall()
 
 # Добавить неотвеченное событие
 def add_pending_event(user_id, event_type, event_data):
@@ -260,39 +1631,190 @@ def add_pending_event(user_id, event_type, event_data):
         if conn:
             conn.rollback()
         raise
-    finally:
-        if conn:
-            conn.close()
 
-# Получить все неотвеченные события
-def get_unprocessed_pending_events():
+# Получить неотвеченные события
+def get_unprocessed_pending_events(after_id=0, limit=None):
+    """Возвращает неотвеченные события с id > after_id по возрастанию id.
+
+    С limit события читаются пачками: следующая пачка начинается после
+    последнего id предыдущей. blocked - пользователь заблокировал бота.
+    """
     conn = None
     try:
         conn = get_db_connection()
         c = conn.cursor()
-        c.execute('''SELECT * FROM pending_events WHERE processed = 0 ORDER BY created_at ASC''')
+        c.execute('''
+            SELECT p.id, p.user_id, p.event_type, p.event_data, p.created_at,
+                   COALESCE(u.blocked, 0) AS blocked
+            FROM pending_events p
+            LEFT JOIN user_first_interaction u ON u.user_id = p.user_id
+            WHERE p.processed = 0 AND p.id > ?
+            ORDER BY p.id
+            LIMIT ?
+        ''', (after_id, -1 if limit is None else limit))
         return c.fetchall()
     except Exception as e:
         logger.error(f"Error getting pending events: {e}")
         return []
-    finally:
-        if conn:
-            conn.close()
 
 # Отметить событие как обработанное
 def mark_pending_event_processed(event_id):
+    mark_pending_events_processed([event_id])
+
+def mark_pending_events_processed(event_ids):
+    """Отмечает пачку событий обработанными одной транзакцией"""
+    if not event_ids:
+        return
     conn = None
     try:
         conn = get_db_connection()
         c = conn.cursor()
-        c.execute('''UPDATE pending_events SET processed = 1 WHERE id = ?''', (event_id,))
+        c.executemany('''UPDATE pending_events SET processed = 1 WHERE id = ?''',
+                      [(event_id,) for event_id in event_ids])
         conn.commit()
-        logger.info(f"Pending event {event_id} marked as processed")
+        logger.info(f"{len(event_ids)} pending events marked as processed")
     except Exception as e:
-        logger.error(f"Error marking pending event as processed: {e}")
+        logger.error(f"Error marking pending events as processed: {e}")
+        if conn:
+            conn.rollback()
+        raise
+
+def prune_pending_events(retention_days, archive_path=None, chunk_size=5000):
+    """Удаляет обработанные события старше retention_days дней.
+
+    Если задан archive_path, удаляемые строки сначала дописываются туда
+    в gzip JSONL. Удаление идет пачками по chunk_size, чтобы не держать
+    блокировку записи долго; затем освободившиеся страницы возвращаются
+    через incremental_vacuum. Возвращает число строк и освобожденные байты.
+    """
+    conn = None
+    removed = 0
+    archive = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        page_size = c.execute('PRAGMA page_size').fetchone()[0]
+        pages_before = c.execute('PRAGMA page_count').fetchone()[0]
+        if archive_path:
+            archive = gzip.open(archive_path, 'at', encoding='utf-8')
+        cutoff = f'-{int(retention_days)} days'
+        while True:
+            c.execute('''
+                SELECT id, user_id, event_type, event_data, created_at
+                FROM pending_events
+                WHERE processed = 1 AND created_at < datetime('now', ?)
+                ORDER BY created_at
+                LIMIT ?
+            ''', (cutoff, chunk_size))
+            rows = c.fetchall()
+            if not rows:
+                break
+            if archive:
+                archive.writelines(json.dumps(dict(row), ensure_ascii=False) + '\n' for row in rows)
+                archive.flush()
+            c.executemany('DELETE FROM pending_events WHERE id = ?', [(row['id'],) for row in rows])
+            conn.commit()
+            removed += len(rows)
+        # Возвращаем свободные страницы в файловую систему; executescript
+        # выполняет прагму до конца (execute освобождает одну страницу за шаг)
+        conn.executescript('PRAGMA incremental_vacuum')
+        pages_after = c.execute('PRAGMA page_count').fetchone()[0]
+        return {'rows_removed': removed, 'bytes_reclaimed': (pages_before - pages_after) * page_size}
+    except Exception as e:
+        logger.error(f"Error pruning pending events: {e}")
         if conn:
             conn.rollback()
         raise
     finally:
+        if archive:
+            archive.close()
+
+# Получить сохраненные file_id изображений
+def get_media_cache():
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('''SELECT path, file_hash, file_id FROM media_cache''')
+        return c.fetchall()
+    except Exception as e:
+        logger.error(f"Error getting media cache: {e}")
+        return []
+
+# Сохранить file_id изображения вместе с хешем файла
+def save_media_file_id(path, file_hash, file_id):
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('''INSERT OR REPLACE INTO media_cache (path, file_hash, file_id, updated_at)
+                     VALUES (?, ?, ?, CURRENT_TIMESTAMP)''',
+                  (path, file_hash, file_id))
+        conn.commit()
+        logger.info(f"Media file_id saved for {path}")
+    except Exception as e:
+        logger.error(f"Error saving media file_id: {e}")
         if conn:
-            conn.close()
+            conn.rollback()
+        raise
+
+# Получить сохраненное состояние FSM пользователя
+def get_fsm_record(chat, user):
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('''SELECT state, data, bucket FROM fsm_storage WHERE chat = ? AND user = ?''', (chat, user))
+        return c.fetchone()
+    except Exception as e:
+        logger.error(f"Error getting FSM record: {e}")
+        raise
+
+# Сохранить пачку состояний FSM; пустые записи удаляются
+def save_fsm_records(records):
+    if not records:
+        return
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        empty = [(chat, user) for chat, user, state, data, bucket in records
+                 if state is None and data == '{}' and bucket == '{}']
+        filled = [record for record in records
+                  if not (record[2] is None and record[3] == '{}' and record[4] == '{}')]
+        c.executemany('''DELETE FROM fsm_storage WHERE chat = ? AND user = ?''', empty)
+        c.executemany('''INSERT OR REPLACE INTO fsm_storage (chat, user, state, data, bucket)
+                         VALUES (?, ?, ?, ?, ?)''', filled)
+        conn.commit()
+    except Exception as e:
+        logger.error(f"Error saving FSM records: {e}")
+        if conn:
+            conn.rollback()
+        raise
+
+# Служебные значения бота
+def get_bot_state(key, default=None):
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('''SELECT value FROM bot_state WHERE key = ?''', (key,))
+        row = c.fetchone()
+        return row['value'] if row else default
+    except Exception as e:
+        logger.error(f"Error getting bot state {key}: {e}")
+        return default
+
+def set_bot_state(key, value):
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('''INSERT INTO bot_state (key, value) VALUES (?, ?)
+                     ON CONFLICT(key) DO UPDATE SET value = excluded.value''', (key, str(value)))
+        conn.commit()
+    except Exception as e:
+        logger.error(f"Error saving bot state {key}: {e}")
+        if conn:
+            conn.rollback()
+        raise
@@ -0,0 +1,80 @@
+import asyncio
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import db
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+
+class SnapshotCache:
+    """Сжатые снимки базы для /getdb с кешированием на ttl секунд.
+
+    Снимок делается через db.backup_database в пуле потоков и сжимается
+    gzip'ом. Повторные запросы того же набора таблиц в пределах ttl
+    получают готовый файл, одновременные запросы ждут одну сборку.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._dir = None
+        self._snapshots = {}
+        self._locks = {}
+
+        # Счетчики для мониторинга
+        self.hits = 0
+        self.builds = 0
+        self.last_build_ms = 0.0
+        self.last_size = 0
+
+    def _build(self, key, tables):
+        if self._dir is None:
+            self._dir = tempfile.mkdtemp(prefix='db_snapshots_')
+        name = '_'.join(key) if key else 'full'
+        db_path = os.path.join(self._dir, f'{name}.db')
+        gz_path = db_path + '.gz'
+        if os.path.exists(db_path):
+            os.remove(db_path)
+        try:
+            db.backup_database(db_path, tables)
+            with open(db_path, 'rb') as src, gzip.open(gz_path + '.tmp', 'wb', compresslevel=6) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.replace(gz_path + '.tmp', gz_path)
+        finally:
+            if os.path.exists(db_path):
+                os.remove(db_path)
+        return gz_path
+
+    async def get(self, tables=None):
+        """Возвращает путь к сжатому снимку (всей базы или только tables)"""
+        key = tuple(sorted(set(tables))) if tables else ()
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            cached = self._snapshots.get(key)
+            if cached and time.monotonic() - cached[0] < self.ttl and os.path.exists(cached[1]):
+                self.hits += 1
+                return cached[1]
+            started = time.perf_counter()
+            path = await asyncio.get_running_loop().run_in_executor(None, self._build, key, key or None)
+            self.builds += 1
+            self.last_build_ms = (time.perf_counter() - started) * 1000
+            self.last_size = os.path.getsize(path)
+            self._snapshots[key] = (time.monotonic(), path)
+            logger.info(f"Database snapshot {os.path.basename(path)} built in {self.last_build_ms:.0f} ms, "
+                        f"{self.last_size} bytes")
+            return path
+
+    def metrics(self):
+        """Возвращает счетчики кеша снимков"""
+        return {
+            'cached': len(self._snapshots),
+            'hits': self.hits,
+            'builds': self.builds,
+            'last_build_ms': round(self.last_build_ms, 1),
+            'last_size': self.last_size,
+        }
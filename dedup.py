@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import time
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+import db
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+HIGH_WATER_MARK_KEY = 'last_update_id'
+HIGH_WATER_MARK_SAVED_AT_KEY = 'last_update_id_saved_at'
+
+
+class UpdateDeduplicator(BaseMiddleware):
+    """Отбрасывает повторно доставленные Telegram update'ы до диспетчеризации.
+
+    Последние capacity значений update_id хранятся в кольцевом буфере
+    и множестве: проверка и вставка - O(1), самый старый id вытесняется
+    при заполнении буфера. Максимальный update_id (high-water mark)
+    периодически сохраняется в bot_state, поэтому после перезапуска
+    повторы уже обработанных до остановки update'ов тоже отбрасываются.
+    Сохраненная отметка действует только restart_window id вниз и только
+    если она моложе max_age секунд: после долгого простоя Telegram
+    начинает update_id со случайного значения, и старая отметка
+    отбрасывала бы все новые update'ы.
+    """
+
+    def __init__(self, capacity=10000, persist=True, flush_interval=5.0, restart_window=100000, max_age=86400):
+        super().__init__()
+        self.capacity = capacity
+        self.persist = persist
+        self.flush_interval = flush_interval
+        self.restart_window = restart_window
+        self.max_age = max_age
+        self._ring = [None] * capacity
+        self._pos = 0
+        self._seen = set()
+        self._task = None
+        self.high_water_mark = 0
+        self._saved_mark = 0
+        self._restart_mark = 0
+
+        # Счетчики для мониторинга
+        self.passed = 0
+        self.duplicates = 0
+        self.stale = 0
+
+    def load(self):
+        """Загружает сохраненный high-water mark"""
+        if self.persist:
+            mark = int(db.get_bot_state(HIGH_WATER_MARK_KEY, 0))
+            saved_at = int(db.get_bot_state(HIGH_WATER_MARK_SAVED_AT_KEY, 0))
+            if time.time() - saved_at > self.max_age:
+                # Отметка устарела: Telegram хранит недоставленные update'ы не дольше суток
+                logger.info(f"Update high-water mark {mark} is stale, ignoring it")
+                mark = 0
+            self.high_water_mark = self._saved_mark = self._restart_mark = mark
+
+    def start(self):
+        """Запускает фоновое сохранение high-water mark"""
+        if self.persist and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error saving update high-water mark: {e}")
+
+    async def flush(self):
+        mark = self.high_water_mark
+        if not self.persist or mark == self._saved_mark:
+            return
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, db.set_bot_state, HIGH_WATER_MARK_KEY, mark)
+        await loop.run_in_executor(None, db.set_bot_state, HIGH_WATER_MARK_SAVED_AT_KEY, int(time.time()))
+        self._saved_mark = mark
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def seen(self, update_id):
+        """Проверяет update_id и запоминает его; True - это повтор"""
+        if update_id in self._seen:
+            self.duplicates += 1
+            return True
+        if self._restart_mark - self.restart_window < update_id <= self._restart_mark:
+            # Обработан до перезапуска
+            self.stale += 1
+            return True
+        old = self._ring[self._pos]
+        if old is not None:
+            self._seen.discard(old)
+        self._ring[self._pos] = update_id
+        self._pos = (self._pos + 1) % self.capacity
+        self._seen.add(update_id)
+        if update_id > self.high_water_mark:
+            self.high_water_mark = update_id
+        self.passed += 1
+        return False
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        if self.seen(update.update_id):
+            logger.info(f"Duplicate update {update.update_id} dropped")
+            raise CancelHandler()
+
+    def metrics(self):
+        """Возвращает счетчики отброшенных повторов"""
+        return {
+            'passed': self.passed,
+            'duplicates': self.duplicates,
+            'stale': self.stale,
+            'high_water_mark': self.high_water_mark,
+        }
@@ -1,16 +1,101 @@
-import sqlite3
-import pandas as pd
+"""Инкрементальная выгрузка stats_log в сжатый CSV или JSONL.
 
-conn = sqlite3.connect('stats.db')
+Таблица читается потоково по курсору, в памяти держится одна пачка строк.
+Последний выгруженный id сохраняется в файле-метке, поэтому следующий
+запуск выгружает только новые строки.
 
-# Экспорт всей статистики
-df = pd.read_sql_query("SELECT * FROM stats", conn)
-df.to_excel('stats_export.xlsx', index=False)
+Запуск:
+    python export_stats.py [--format csv|jsonl] [--full]
+"""
+import argparse
+import csv
+import gzip
+import json
+import os
+from collections import Counter
 
-# Подсчёт количества нажатий кнопок
-counts = df['action'].value_counts()
-print('Общее количество нажатий каждой кнопки:')
-print(counts)
+from db import CSV_HEADER, close_db_connections, iter_stat_rows
 
-# Количество нажатий кнопки старт
-print('Общее количество нажатий кнопки старт:', counts.get('start', 0)) 
\ No newline at end of file
+FIELDS = ['id'] + CSV_HEADER
+WATERMARK_FILE = 'stats_export.watermark'
+
+
+def read_watermark(path):
+    """Возвращает последний выгруженный id (0, если выгрузок еще не было)"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            return int(json.load(f)['last_id'])
+    except FileNotFoundError:
+        return 0
+
+
+def write_watermark(path, last_id):
+    # Записываем через временный файл, чтобы метка не оказалась битой
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'last_id': last_id}, f)
+    os.replace(tmp_path, path)
+
+
+def export(rows, out, fmt):
+    """Пишет строки в out и считает нажатия по action за тот же проход"""
+    counts = Counter()
+    first_id = last_id = None
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(FIELDS)
+        write = writer.writerow
+    else:
+        def write(values):
+            out.write(json.dumps(dict(zip(FIELDS, values)), ensure_ascii=False) + '\n')
+    for row in rows:
+        values = tuple(row)
+        write(values)
+        counts[row['action']] += 1
+        if first_id is None:
+            first_id = row['id']
+        last_id = row['id']
+    return counts, first_id, last_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Выгрузка статистики из stats_log')
+    parser.add_argument('--format', choices=('csv', 'jsonl'), default='csv')
+    parser.add_argument('--output-dir', default='.')
+    parser.add_argument('--watermark', default=WATERMARK_FILE,
+                        help='файл с последним выгруженным id')
+    parser.add_argument('--full', action='store_true',
+                        help='выгрузить всю таблицу, игнорируя метку')
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    args = parser.parse_args()
+
+    after_id = 0 if args.full else read_watermark(args.watermark)
+    partial_path = os.path.join(args.output_dir, f'stats_export.partial.{args.format}.gz')
+    try:
+        with gzip.open(partial_path, 'wt', encoding='utf-8', newline='') as out:
+            counts, first_id, last_id = export(iter_stat_rows(after_id, args.chunk_size), out, args.format)
+    finally:
+        close_db_connections()
+
+    if last_id is None:
+        os.remove(partial_path)
+        print(f'Новых записей нет (последний выгруженный id: {after_id})')
+        return
+
+    path = os.path.join(args.output_dir, f'stats_export_{first_id}-{last_id}.{args.format}.gz')
+    os.replace(partial_path, path)
+    # Метку двигаем только после того, как файл выгрузки записан целиком
+    write_watermark(args.watermark, max(last_id, after_id))
+    print(f'Выгружено {sum(counts.values())} записей в {path}')
+
+    # Подсчёт количества нажатий кнопок
+    print('Количество нажатий каждой кнопки:')
+    for action, count in counts.most_common():
+        print(f'{action}: {count}')
+
+    # Количество нажатий кнопки старт
+    print('Количество нажатий кнопки старт:', counts.get('start', 0))
+
+
+if __name__ == '__main__':
+    main()
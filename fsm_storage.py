@@ -0,0 +1,211 @@
+import asyncio
+import copy
+import json
+import logging
+import typing
+from collections import OrderedDict
+
+from aiogram.dispatcher.storage import BaseStorage
+
+import db
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+
+def _empty_record():
+    return {'state': None, 'data': {}, 'bucket': {}}
+
+
+class SQLiteStorage(BaseStorage):
+    """Хранилище состояний FSM в sqlite с LRU-кешем в памяти.
+
+    Горячие пользователи обслуживаются из кеша, промах читает запись из
+    таблицы fsm_storage. Изменения помечаются "грязными" и сбрасываются
+    фоновой задачей раз в flush_interval секунд одной транзакцией, поэтому
+    несколько обновлений одного пользователя между сбросами дают одну запись.
+    Вытесняются только записи, уже сохраненные в базе: грязные и те, что
+    сейчас пишутся, остаются в кеше.
+    """
+
+    def __init__(self, max_cached=10000, flush_interval=1.0):
+        self.max_cached = max_cached
+        self.flush_interval = flush_interval
+        self._cache = OrderedDict()
+        self._dirty = set()
+        # Ключи, которые пишутся в базу прямо сейчас: до коммита их нельзя вытеснять
+        self._flushing = set()
+        self._task = None
+        self._stop = None
+
+        # Счетчики для мониторинга
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.written = 0
+        self.evictions = 0
+
+    def start(self):
+        """Запускает фоновый сброс изменений в базу"""
+        if self._task is None or self._task.done():
+            self._stop = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while not self._stop.is_set():
+            try:
+                await asyncio.wait_for(self._stop.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing FSM storage: {e}")
+
+    async def flush(self):
+        """Записывает накопленные изменения в базу"""
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        self._flushing |= dirty
+        records = []
+        for key in dirty:
+            record = self._cache.get(key)
+            if record is None:
+                continue
+            records.append((key[0], key[1], record['state'],
+                            json.dumps(record['data'], ensure_ascii=False),
+                            json.dumps(record['bucket'], ensure_ascii=False)))
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, db.save_fsm_records, records)
+        except Exception:
+            # Не потеряем изменения: попробуем записать их при следующем сбросе
+            self._dirty |= dirty
+            raise
+        finally:
+            self._flushing -= dirty
+        self.flushes += 1
+        self.written += len(records)
+        self._evict()
+
+    async def close(self):
+        # Задачу не отменяем: отмена не прерывает запись в потоке пула, а ключи
+        # уже вынуты из _dirty. Цикл останавливается сам после текущего сброса
+        if self._task:
+            self._stop.set()
+            await self._task
+            self._task = None
+        await self.flush()
+        self._cache.clear()
+
+    async def wait_closed(self):
+        pass
+
+    def _evict(self):
+        # Вытесняем только записи, уже сохраненные в базе
+        while len(self._cache) > self.max_cached:
+            for key in self._cache:
+                if key not in self._dirty and key not in self._flushing:
+                    del self._cache[key]
+                    self.evictions += 1
+                    break
+            else:
+                break
+
+    def _record(self, chat, user):
+        key = tuple(map(str, self.check_address(chat=chat, user=user)))
+        record = self._cache.get(key)
+        if record is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return key, record
+        self.misses += 1
+        row = db.get_fsm_record(*key)
+        if row:
+            record = {'state': row['state'], 'data': json.loads(row['data']), 'bucket': json.loads(row['bucket'])}
+        else:
+            record = _empty_record()
+        self._cache[key] = record
+        self._evict()
+        return key, record
+
+    def _touch(self, key):
+        self._dirty.add(key)
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        _, record = self._record(chat, user)
+        state = record['state']
+        return state if state is not None else self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[str] = None) -> typing.Dict:
+        _, record = self._record(chat, user)
+        return copy.deepcopy(record['data'])
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        key, record = self._record(chat, user)
+        record['data'].update(data or {}, **kwargs)
+        self._touch(key)
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        key, record = self._record(chat, user)
+        record['state'] = self.resolve_state(state)
+        self._touch(key)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        key, record = self._record(chat, user)
+        record['data'] = copy.deepcopy(data or {})
+        self._touch(key)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        _, record = self._record(chat, user)
+        return copy.deepcopy(record['bucket'])
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        key, record = self._record(chat, user)
+        record['bucket'] = copy.deepcopy(bucket or {})
+        self._touch(key)
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        key, record = self._record(chat, user)
+        record['bucket'].update(bucket or {}, **kwargs)
+        self._touch(key)
+
+    def metrics(self):
+        """Возвращает счетчики кеша и сброса в базу"""
+        return {
+            'cached': len(self._cache),
+            'dirty': len(self._dirty),
+            'flushing': len(self._flushing),
+            'hits': self.hits,
+            'misses': self.misses,
+            'flushes': self.flushes,
+            'written': self.written,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import time
+
+import db
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+
+def percentile(values, p):
+    """Перцентиль p (0..1) отсортированного списка (ближайший ранг)"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class FunnelTracker:
+    """Воронка start -> category -> offer -> get_loan по источнику первого касания.
+
+    События относятся к источнику первого события пользователя, а не
+    к source конкретной строки (после /start действия пишутся как direct).
+    Воронка обновляется инкрементально по водяному знаку (db.update_funnel):
+    раз в interval секунд и перед каждым отчетом. Шаги определяются по
+    каталогу (Catalog.funnel_step).
+    """
+
+    def __init__(self, catalog, interval=300):
+        self.catalog = catalog
+        self.interval = interval
+        self._lock = asyncio.Lock()
+
+        # Счетчики для мониторинга
+        self.runs = 0
+        self.events_processed = 0
+        self.last_run_s = 0.0
+
+    async def update(self):
+        """Дообрабатывает новые события; возвращает их число"""
+        async with self._lock:
+            started = time.perf_counter()
+            processed = await asyncio.get_running_loop().run_in_executor(
+                None, db.update_funnel, self.catalog.funnel_step)
+            self.runs += 1
+            self.events_processed += processed
+            self.last_run_s = round(time.perf_counter() - started, 2)
+            if processed:
+                logger.info(f"Funnel updated with {processed} events in {self.last_run_s}s")
+            return processed
+
+    async def run(self):
+        """Основной цикл: обновление по расписанию"""
+        while True:
+            try:
+                await self.update()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error updating funnel: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def report(self, date_from=None, date_to=None, source=None):
+        """Возвращает строки воронки за период когорт (YYYY-MM-DD, включительно).
+
+        Без source - строка на источник, с source - строка на день этого
+        источника. В строке: счетчики шагов и перцентили времени до get_loan.
+        """
+        await self.update()
+        loop = asyncio.get_running_loop()
+        days = await loop.run_in_executor(None, db.get_funnel_days, date_from, date_to, source)
+        times = await loop.run_in_executor(None, db.get_funnel_convert_times, date_from, date_to, source)
+
+        key = 'day' if source is not None else 'source'
+        rows = {}
+        for day in days:
+            row = rows.setdefault(day[key], dict.fromkeys(('started',) + db.FUNNEL_STEPS, 0))
+            for step in ('started',) + db.FUNNEL_STEPS:
+                row[step] += day[step]
+        seconds = {}
+        for item in times:
+            seconds.setdefault(item[key], []).append(item['convert_seconds'])
+        for name, row in rows.items():
+            values = sorted(seconds.get(name, []))
+            row[key] = name
+            row['p50_s'] = percentile(values, 0.5)
+            row['p90_s'] = percentile(values, 0.9)
+        if source is not None:
+            return [rows[name] for name in sorted(rows)]
+        return sorted(rows.values(), key=lambda row: row['started'], reverse=True)
+
+    def metrics(self):
+        """Возвращает число обработанных событий"""
+        return {
+            'runs': self.runs,
+            'events_processed': self.events_processed,
+            'last_run_s': self.last_run_s,
+        }
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+
+import db
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+
+class PendingEventsPruner:
+    """Периодическая очистка обработанных pending_events.
+
+    Раз в interval секунд удаляет события старше retention_days дней
+    (при заданном archive_dir - с архивацией в gzip JSONL по месяцам)
+    и возвращает место через incremental_vacuum. Работа идет в пуле
+    потоков, поэтому хендлеры не блокируются.
+    """
+
+    def __init__(self, retention_days=30, archive_dir=None, interval=24 * 3600, initial_delay=600):
+        self.retention_days = retention_days
+        self.archive_dir = archive_dir
+        self.interval = interval
+        self.initial_delay = initial_delay
+
+        # Счетчики для мониторинга
+        self.runs = 0
+        self.rows_removed = 0
+        self.bytes_reclaimed = 0
+        self.last_report = None
+
+    async def prune(self):
+        """Выполняет одну очистку и возвращает отчет"""
+        archive_path = None
+        if self.archive_dir:
+            os.makedirs(self.archive_dir, exist_ok=True)
+            archive_path = os.path.join(self.archive_dir, f"pending_events_{datetime.now():%Y-%m}.jsonl.gz")
+        started = time.perf_counter()
+        report = await asyncio.get_running_loop().run_in_executor(
+            None, db.prune_pending_events, self.retention_days, archive_path)
+        report['seconds'] = round(time.perf_counter() - started, 2)
+        self.runs += 1
+        self.rows_removed += report['rows_removed']
+        self.bytes_reclaimed += report['bytes_reclaimed']
+        self.last_report = report
+        logger.info(f"Pending events pruned: {report['rows_removed']} rows removed, "
+                    f"{report['bytes_reclaimed']} bytes reclaimed in {report['seconds']}s")
+        return report
+
+    async def run(self):
+        """Основной цикл: очистка по расписанию"""
+        await asyncio.sleep(self.initial_delay)
+        while True:
+            try:
+                await self.prune()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error in pending events pruner: {e}")
+            await asyncio.sleep(self.interval)
+
+    def metrics(self):
+        """Возвращает итоги очисток"""
+        return {
+            'retention_days': self.retention_days,
+            'runs': self.runs,
+            'rows_removed': self.rows_removed,
+            'bytes_reclaimed': self.bytes_reclaimed,
+            'last_report': self.last_report,
+        }
+
+
+class StatsArchiver:
+    """Периодическая архивация закрытых месяцев статистики.
+
+    Раз в interval секунд выносит из events месяцы, закончившиеся больше
+    grace_days дней назад, в сжатые архивы (db.seal_stats_months).
+    Работа идет в пуле потоков.
+    """
+
+    def __init__(self, archive_dir=db.ARCHIVE_DIR, grace_days=1, interval=24 * 3600, initial_delay=900):
+        self.archive_dir = archive_dir
+        self.grace_days = grace_days
+        self.interval = interval
+        self.initial_delay = initial_delay
+
+        # Счетчики для мониторинга
+        self.runs = 0
+        self.months_sealed = 0
+        self.rows_archived = 0
+        self.last_report = None
+
+    async def seal(self):
+        """Выполняет одну архивацию и возвращает отчет"""
+        started = time.perf_counter()
+        report = await asyncio.get_running_loop().run_in_executor(
+            None, db.seal_stats_months, self.archive_dir, self.grace_days)
+        report['seconds'] = round(time.perf_counter() - started, 2)
+        self.runs += 1
+        self.months_sealed += len(report['months'])
+        self.rows_archived += report['rows_archived']
+        self.last_report = report
+        if report['months']:
+            logger.info(f"Stats archived: {', '.join(report['months'])}, {report['rows_archived']} rows, "
+                        f"{report['bytes_reclaimed']} bytes reclaimed in {report['seconds']}s")
+        return report
+
+    async def run(self):
+        """Основной цикл: архивация по расписанию"""
+        await asyncio.sleep(self.initial_delay)
+        while True:
+            try:
+                await self.seal()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error in stats archiver: {e}")
+            await asyncio.sleep(self.interval)
+
+    def metrics(self):
+        """Возвращает итоги архиваций и кеш распакованных архивов"""
+        return {
+            'runs': self.runs,
+            'months_sealed': self.months_sealed,
+            'rows_archived': self.rows_archived,
+            'last_report': self.last_report,
+            **db.archives.metrics(),
+        }
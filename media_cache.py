@@ -0,0 +1,134 @@
+import hashlib
+import logging
+import os
+
+from aiogram import types
+from aiogram.utils.exceptions import BadRequest, MessageNotModified
+
+import db
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+IMAGE_DIR = 'images'
+IMAGE_EXTENSIONS = ('jpg', 'jpeg', 'png')
+
+
+class MediaCache:
+    """Кеш Telegram file_id для изображений предложений.
+
+    Каждое изображение загружается в Telegram один раз, полученный file_id
+    сохраняется в sqlite вместе с sha256 файла и дальше фото отправляется
+    по file_id. Если содержимое файла изменилось, хеш не совпадет и
+    изображение будет загружено заново.
+    """
+
+    def __init__(self, image_dir=IMAGE_DIR):
+        self.image_dir = image_dir
+        self._paths = {}
+        self._hashes = {}
+        self._file_ids = None
+
+        # Счетчики для мониторинга
+        self.hits = 0
+        self.uploads = 0
+        self.invalidations = 0
+
+    def find_image(self, name):
+        """Возвращает путь к изображению предложения (поиск выполняется один раз)"""
+        if name not in self._paths:
+            self._paths[name] = None
+            for ext in IMAGE_EXTENSIONS:
+                path = os.path.join(self.image_dir, f'{name}.{ext}')
+                if os.path.exists(path):
+                    self._paths[name] = path
+                    break
+        return self._paths[name]
+
+    def _file_hash(self, path):
+        # Пересчитываем хеш только если изменились размер или время модификации
+        st = os.stat(path)
+        key = (st.st_mtime_ns, st.st_size)
+        cached = self._hashes.get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+        with open(path, 'rb') as f:
+            file_hash = hashlib.sha256(f.read()).hexdigest()
+        self._hashes[path] = (key, file_hash)
+        return file_hash
+
+    def _load(self):
+        if self._file_ids is None:
+            self._file_ids = {row['path']: (row['file_hash'], row['file_id']) for row in db.get_media_cache()}
+        return self._file_ids
+
+    async def _deliver(self, name, request):
+        """Выполняет request(photo) по file_id из кеша, при необходимости загружая файл.
+
+        Возвращает None, если изображения для предложения нет.
+        """
+        path = self.find_image(name)
+        if not path:
+            return None
+
+        file_hash = self._file_hash(path)
+        cached = self._load().get(path)
+        if cached and cached[0] == file_hash:
+            try:
+                msg = await request(cached[1])
+                self.hits += 1
+                return msg
+            except MessageNotModified:
+                raise
+            except BadRequest as e:
+                # file_id больше не действителен - загружаем файл заново
+                logger.warning(f"Cached file_id for {path} rejected: {e}")
+                self.invalidations += 1
+        elif cached:
+            logger.info(f"Image {path} changed, uploading it again")
+            self.invalidations += 1
+
+        with open(path, 'rb') as photo:
+            msg = await request(photo)
+        self.uploads += 1
+        file_id = msg.photo[-1].file_id
+        self._file_ids[path] = (file_hash, file_id)
+        try:
+            db.save_media_file_id(path, file_hash, file_id)
+        except Exception as e:
+            logger.error(f"Error saving file_id for {path}: {e}")
+        return msg
+
+    async def send_photo(self, bot, chat_id, name, caption=None, reply_markup=None, parse_mode=None):
+        """Отправляет изображение предложения, по возможности по file_id.
+
+        Возвращает None, если изображения для предложения нет.
+        """
+        return await self._deliver(name, lambda photo: bot.send_photo(
+            chat_id=chat_id,
+            photo=photo,
+            caption=caption,
+            reply_markup=reply_markup,
+            parse_mode=parse_mode
+        ))
+
+    async def edit_photo(self, bot, chat_id, message_id, name, caption=None, reply_markup=None, parse_mode=None):
+        """Заменяет фото и подпись в существующем сообщении (edit_message_media).
+
+        Возвращает None, если изображения для предложения нет.
+        """
+        return await self._deliver(name, lambda photo: bot.edit_message_media(
+            media=types.InputMediaPhoto(media=photo, caption=caption, parse_mode=parse_mode),
+            chat_id=chat_id,
+            message_id=message_id,
+            reply_markup=reply_markup
+        ))
+
+    def metrics(self):
+        """Возвращает счетчики попаданий в кеш и загрузок"""
+        return {
+            'cached_images': len(self._file_ids or {}),
+            'hits': self.hits,
+            'uploads': self.uploads,
+            'invalidations': self.invalidations,
+        }
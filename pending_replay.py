@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import time
+
+import db
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+
+class PendingReplay:
+    """Фоновая отправка уведомлений по неотвеченным событиям (pending_events).
+
+    События читаются пачками по batch_size по возрастанию id. Несколько
+    событий одного пользователя сворачиваются в одно сообщение (в том числе
+    между пачками), пользователи, заблокировавшие бота, пропускаются.
+    send - корутина send(user_id, event_type); сообщения рассылаются через
+    broadcaster, а отметки processed ставятся одной транзакцией на пачку.
+    """
+
+    def __init__(self, send, broadcaster, batch_size=500):
+        self.send = send
+        self.broadcaster = broadcaster
+        self.batch_size = batch_size
+        self._task = None
+
+        # Счетчики для мониторинга
+        self.events = 0
+        self.collapsed = 0
+        self.skipped_blocked = 0
+        self.sent = 0
+        self.failed = 0
+        self.running = False
+        self.last_run_seconds = 0.0
+
+    def start(self):
+        """Запускает отправку в фоне"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+
+    async def run(self):
+        self.running = True
+        started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        notified = set()
+        after_id = 0
+        try:
+            while True:
+                rows = await loop.run_in_executor(
+                    None, db.get_unprocessed_pending_events, after_id, self.batch_size)
+                if not rows:
+                    break
+                after_id = rows[-1]['id']
+                self.events += len(rows)
+                await self._process(rows, notified)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error replaying pending events: {e}")
+        finally:
+            self.running = False
+            self.last_run_seconds = time.monotonic() - started
+        logger.info(f"Pending events replayed: {self.sent} sent, {self.failed} failed, "
+                    f"{self.collapsed} collapsed, {self.skipped_blocked} skipped")
+
+    async def _process(self, rows, notified):
+        done = []
+        events = {}
+        for row in rows:
+            user_id = row['user_id']
+            if row['blocked']:
+                self.skipped_blocked += 1
+                done.append(row['id'])
+                continue
+            if user_id in notified:
+                # Пользователь уже получил уведомление в этом прогоне
+                self.collapsed += 1
+                done.append(row['id'])
+                continue
+            if user_id in events:
+                self.collapsed += 1
+            events.setdefault(user_id, []).append(row)
+
+        # Если среди событий был /start, отправляем приветствие с меню
+        jobs = [(user_id, 'start' if any(row['event_type'] == 'start' for row in user_rows)
+                 else user_rows[-1]['event_type'])
+                for user_id, user_rows in events.items()]
+        result = await self.broadcaster.broadcast(jobs, self.send) if jobs else None
+
+        loop = asyncio.get_running_loop()
+        if result:
+            for user_id, _ in result.sent + result.blocked:
+                notified.add(user_id)
+                done.extend(row['id'] for row in events[user_id])
+            self.sent += len(result.sent)
+            self.failed += len(result.failed)
+            # Неудачные события остаются processed = 0 до следующего запуска
+            await loop.run_in_executor(None, db.mark_users_blocked, [user_id for user_id, _ in result.blocked])
+        await loop.run_in_executor(None, db.mark_pending_events_processed, done)
+
+    def metrics(self):
+        """Возвращает прогресс и счетчики отправки"""
+        return {
+            'running': self.running,
+            'events': self.events,
+            'collapsed': self.collapsed,
+            'skipped_blocked': self.skipped_blocked,
+            'sent': self.sent,
+            'failed': self.failed,
+            'last_run_s': round(self.last_run_seconds, 1),
+        }
@@ -0,0 +1,164 @@
+import asyncio
+import heapq
+import logging
+import time
+
+import db
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+
+class ReminderScheduler:
+    """Планировщик напоминаний по индексированному next_reminder_at.
+
+    В памяти держится min-heap сроков на ближайшие horizon секунд,
+    подгружаемый из sqlite по индексу. Задача спит ровно до ближайшего
+    срока; новые пользователи добавляются через schedule() и будят ее.
+    send - корутина send(user_id, stage), отправляющая напоминание;
+    пачка наступивших напоминаний рассылается через broadcaster.
+    """
+
+    def __init__(self, send, broadcaster, horizon=3600, batch_size=500, retry_delay=3600):
+        self.send = send
+        self.broadcaster = broadcaster
+        self.horizon = horizon
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self._heap = []
+        self._due = {}
+        self._loaded_until = 0
+        self._wakeup = asyncio.Event()
+
+        # Счетчики для мониторинга
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+
+    def schedule(self, user_id, due_at):
+        """Добавляет срок напоминания, если он попадает в загруженное окно"""
+        if due_at is None or due_at > self._loaded_until:
+            # Более поздние сроки подгрузятся из базы при следующем обновлении окна
+            return
+        self._push(user_id, due_at)
+        if self._heap[0][1] == user_id:
+            self._wakeup.set()
+
+    def _push(self, user_id, due_at):
+        current = self._due.get(user_id)
+        if current is not None and current <= due_at:
+            return
+        self._due[user_id] = due_at
+        heapq.heappush(self._heap, (due_at, user_id))
+
+    async def _refill(self, now):
+        # Окно считается загруженным еще до запроса: пользователь, добавленный
+        # через schedule() пока запрос идет в пуле потоков, не потеряется
+        self._loaded_until = now + self.horizon
+        rows = await asyncio.get_running_loop().run_in_executor(
+            None, db.get_due_reminders, now + self.horizon, self.batch_size)
+        for row in rows:
+            self._push(row['user_id'], row['next_reminder_at'])
+        if len(rows) >= self.batch_size:
+            # Загружена только часть окна - дальше дочитаем после обработки
+            self._loaded_until = rows[-1]['next_reminder_at']
+
+    def _pop_due(self, now):
+        user_ids = []
+        while self._heap and self._heap[0][0] <= now and len(user_ids) < self.batch_size:
+            due_at, user_id = heapq.heappop(self._heap)
+            # Устаревшие записи кучи (срок был перенесен) пропускаем
+            if self._due.get(user_id) == due_at:
+                del self._due[user_id]
+                user_ids.append(user_id)
+        return user_ids
+
+    @staticmethod
+    def due_stage(row, now):
+        """Возвращает самую позднюю наступившую стадию напоминания или None.
+
+        Если из-за простоя наступило сразу несколько стадий, отправляется
+        только последняя, чтобы не присылать пользователю пачку сообщений.
+        """
+        stages = [day for day in db.REMINDER_DAYS
+                  if day > row['reminder_stage'] and row['first_interaction_at'] + day * 86400 <= now]
+        return stages[-1] if stages else None
+
+    async def _process(self, user_ids, now):
+        # Чтение и запись в базу идут в пуле потоков, чтобы не задерживать update'ы
+        loop = asyncio.get_running_loop()
+        jobs = []
+        first_interaction = {}
+        reschedule = []
+        for row in await loop.run_in_executor(None, db.get_reminder_states, user_ids):
+            user_id = row['user_id']
+            if row['next_reminder_at'] is None:
+                continue
+            if row['next_reminder_at'] > now:
+                self.schedule(user_id, row['next_reminder_at'])
+                continue
+            stage = self.due_stage(row, now)
+            if stage is None:
+                # Срок в базе не соответствует стадии - пересчитываем его
+                later = [day for day in db.REMINDER_DAYS if day > row['reminder_stage']]
+                reschedule.append((user_id, row['first_interaction_at'] + later[0] * 86400 if later else None))
+                continue
+            jobs.append((user_id, stage))
+            first_interaction[user_id] = row['first_interaction_at']
+        if reschedule:
+            await loop.run_in_executor(None, db.reschedule_reminders, reschedule)
+        if not jobs:
+            return
+
+        result = await self.broadcaster.broadcast(jobs, self.send)
+
+        # Результаты рассылки фиксируются в базе пачками
+        await loop.run_in_executor(None, db.mark_reminders_sent, result.sent)
+        await loop.run_in_executor(None, db.mark_users_blocked, [user_id for user_id, _ in result.blocked])
+        # Повтор после ошибки откладываем в базе, чтобы он не подхватился сразу же
+        retry_at = int(now) + self.retry_delay
+        await loop.run_in_executor(None, db.reschedule_reminders, [(user_id, retry_at) for user_id, _ in result.failed])
+
+        self.sent += len(result.sent)
+        self.failed += len(result.failed)
+        self.blocked += len(result.blocked)
+        for user_id, stage in result.sent:
+            later = [day for day in db.REMINDER_DAYS if day > stage]
+            if later:
+                self.schedule(user_id, first_interaction[user_id] + later[0] * 86400)
+        for user_id, _ in result.failed:
+            self.schedule(user_id, retry_at)
+
+    async def run(self):
+        """Основной цикл: спит до ближайшего срока и отправляет напоминания"""
+        while True:
+            try:
+                now = time.time()
+                if now >= self._loaded_until:
+                    await self._refill(now)
+                user_ids = self._pop_due(now)
+                if user_ids:
+                    await self._process(user_ids, now)
+                    continue
+                next_at = min(self._heap[0][0], self._loaded_until) if self._heap else self._loaded_until
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max(next_at - time.time(), 0))
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error in reminder scheduler: {e}")
+                await asyncio.sleep(60)
+
+    def metrics(self):
+        """Возвращает размер кучи и счетчики отправки"""
+        next_at = self._heap[0][0] if self._heap else None
+        return {
+            'heap_size': len(self._due),
+            'next_due_in_s': round(next_at - time.time()) if next_at else None,
+            'sent': self.sent,
+            'failed': self.failed,
+            'blocked': self.blocked,
+        }
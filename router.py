@@ -0,0 +1,77 @@
+import logging
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Ключ обработчика в узле trie (не может совпасть с символом callback_data)
+_HANDLER = None
+
+
+class CallbackRouter:
+    """Маршрутизатор callback_data.
+
+    Точные ключи ищутся в словаре за O(1), префиксные - по trie за
+    O(длины callback_data) с выбором самого длинного совпадения.
+    Обработчик вызывается как handler(callback_query, state, arg), где arg -
+    сам callback_data для точного маршрута или его остаток после префикса.
+    """
+
+    def __init__(self, fallback=None):
+        self._exact = {}
+        self._trie = {}
+        self.fallback = fallback
+
+    def add_exact(self, key, handler):
+        """Регистрирует обработчик для точного значения callback_data"""
+        if key in self._exact:
+            raise ValueError(f"Route already registered: {key}")
+        self._exact[key] = handler
+
+    def add_prefix(self, prefix, handler):
+        """Регистрирует обработчик для callback_data, начинающихся с prefix"""
+        node = self._trie
+        for char in prefix:
+            node = node.setdefault(char, {})
+        if _HANDLER in node:
+            raise ValueError(f"Prefix route already registered: {prefix}")
+        node[_HANDLER] = (len(prefix), handler)
+
+    def exact(self, key):
+        """Декоратор для add_exact"""
+        def decorator(handler):
+            self.add_exact(key, handler)
+            return handler
+        return decorator
+
+    def prefix(self, prefix):
+        """Декоратор для add_prefix"""
+        def decorator(handler):
+            self.add_prefix(prefix, handler)
+            return handler
+        return decorator
+
+    def resolve(self, data):
+        """Возвращает (handler, arg) для callback_data или (fallback, data)"""
+        handler = self._exact.get(data)
+        if handler is not None:
+            return handler, data
+        match = None
+        node = self._trie
+        for char in data:
+            node = node.get(char)
+            if node is None:
+                break
+            if _HANDLER in node:
+                match = node[_HANDLER]
+        if match is not None:
+            return match[1], data[match[0]:]
+        return self.fallback, data
+
+    async def dispatch(self, callback_query, state):
+        """Находит обработчик для callback_query и вызывает его"""
+        handler, arg = self.resolve(callback_query.data or '')
+        if handler is None:
+            logger.warning(f"No route for callback_data: {callback_query.data}")
+            await callback_query.answer()
+            return None
+        return await handler(callback_query, state, arg)
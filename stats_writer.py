@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import time
+
+import db
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+
+class StatsWriter:
+    """Фоновая (write-behind) запись статистики пачками.
+
+    Хендлеры кладут событие в очередь за O(1), а фоновая задача
+    сбрасывает накопленные строки одной транзакцией через db.add_stat_rows:
+    либо когда набралось batch_size строк, либо раз в flush_interval секунд.
+    Та же пачка затем дописывается в CSV-зеркало csv_log, если оно задано.
+    Пачка, которую не удалось записать, откладывается и повторяется после
+    следующего удачного сброса и при остановке.
+    """
+
+    def __init__(self, batch_size=200, flush_interval=1.0, max_queue_size=100000, csv_log=None):
+        self.csv_log = csv_log
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.queue = asyncio.Queue(maxsize=max_queue_size)
+        self._task = None
+        self._stopping = False
+        self._pending = []
+        # Строки неудавшихся сбросов, ждущие повторной записи
+        self._retry = []
+
+        # Счетчики для мониторинга
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.flushes = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def add(self, user_id, full_name, username, action, source='direct'):
+        """Ставит строку статистики в очередь (не блокирует event loop)"""
+        try:
+            self.queue.put_nowait((user_id, full_name, username, action, source, time.time()))
+            self.enqueued += 1
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.error(f"Stats queue is full, dropped action {action} for user {user_id}")
+
+    def start(self):
+        """Запускает фоновую задачу сброса очереди"""
+        if self._task is None or self._task.done():
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+            logger.info("Stats writer started")
+
+    async def stop(self):
+        """Останавливает фоновую задачу и сбрасывает остаток очереди.
+
+        Задача не отменяется: отмена не прерывает запись в потоке пула, и она
+        могла бы закончиться уже после закрытия CSV и соединений с базой.
+        Вместо этого цикл получает сигнал остановки, а текущий сброс дожидается.
+        """
+        if self._task:
+            self._stopping = True
+            # Будим цикл, ждущий строк; полная очередь разбудит его и так
+            try:
+                self.queue.put_nowait(None)
+            except asyncio.QueueFull:
+                pass
+            await self._task
+            self._task = None
+        while not self.queue.empty():
+            await self._flush(self._take_batch())
+        # Последняя попытка для строк неудавшихся сбросов
+        await self._flush_retry()
+        if self._retry:
+            self.failed += len(self._retry)
+            logger.error(f"Dropped {len(self._retry)} stat rows that could not be written before shutdown")
+            self._retry = []
+        logger.info("Stats writer stopped, queue flushed")
+
+    def _take_batch(self, limit=None):
+        batch = []
+        limit = limit or self.batch_size
+        while len(batch) < limit:
+            try:
+                row = self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            # None - сигнал остановки из stop()
+            if row is not None:
+                batch.append(row)
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while not self._stopping:
+            self._pending = [await self.queue.get()]
+            # Даем пачке набраться в пределах временного окна
+            deadline = loop.time() + self.flush_interval
+            while len(self._pending) < self.batch_size:
+                self._pending.extend(self._take_batch(self.batch_size - len(self._pending)))
+                timeout = deadline - loop.time()
+                if len(self._pending) >= self.batch_size or timeout <= 0 or self._stopping:
+                    break
+                try:
+                    self._pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            batch, self._pending = [row for row in self._pending if row is not None], []
+            if await self._flush(batch):
+                await self._flush_retry()
+
+    async def _flush_retry(self):
+        """Повторяет запись строк неудавшихся сбросов"""
+        batch, self._retry = self._retry, []
+        for i in range(0, len(batch), self.batch_size):
+            if not await self._flush(batch[i:i + self.batch_size]):
+                # База снова недоступна - остальное отложим до следующего раза
+                self._keep_for_retry(batch[i + self.batch_size:])
+                return
+
+    def _write(self, batch):
+        db.add_stat_rows(batch)
+        if self.csv_log is None:
+            return
+        try:
+            self.csv_log.write_rows(batch)
+        except Exception as e:
+            # Продолжаем работу даже если не удалось записать в CSV
+            logger.error(f"Error writing to CSV: {e}")
+
+    def _keep_for_retry(self, batch):
+        # Отложенные строки ограничены размером очереди; сверх него - самые старые теряются
+        self._retry.extend(batch)
+        overflow = len(self._retry) - self.max_queue_size
+        if overflow > 0:
+            self.failed += overflow
+            del self._retry[:overflow]
+
+    async def _flush(self, batch):
+        """Записывает пачку; при ошибке откладывает ее для повтора. Возвращает успех"""
+        if not batch:
+            return True
+        started = time.perf_counter()
+        try:
+            # Запись в sqlite и CSV выполняется в пуле потоков
+            await asyncio.get_running_loop().run_in_executor(None, self._write, batch)
+            self.written += len(batch)
+            return True
+        except Exception as e:
+            self._keep_for_retry(batch)
+            logger.error(f"Error flushing {len(batch)} stat rows, kept for retry: {e}")
+            return False
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.flushes += 1
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            self.total_flush_ms += elapsed_ms
+
+    def metrics(self):
+        """Возвращает счетчики очереди и задержки сброса"""
+        return {
+            'queue_depth': self.queue.qsize(),
+            'enqueued': self.enqueued,
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'retry_rows': len(self._retry),
+            'flushes': self.flushes,
+            'last_flush_ms': round(self.last_flush_ms, 2),
+            'avg_flush_ms': round(self.total_flush_ms / self.flushes, 2) if self.flushes else 0.0,
+            'max_flush_ms': round(self.max_flush_ms, 2),
+        }
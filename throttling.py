@@ -0,0 +1,83 @@
+import logging
+import time
+from collections import Counter, OrderedDict
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+
+class CallbackThrottler(BaseMiddleware):
+    """Гасит повторные нажатия одной и той же inline-кнопки.
+
+    Пока для пары (пользователь, callback_data) не истекло окно,
+    повторные callback'и сразу получают пустой answer() и до хендлера
+    не доходят. Окно задается по точному callback_data или по префиксу
+    (самый длинный подходящий), иначе используется default_window.
+    Состояние - упорядоченный словарь сроков, из начала которого при
+    каждой проверке вычищаются истекшие записи.
+    """
+
+    def __init__(self, default_window=1.0, windows=None, max_entries=100000):
+        super().__init__()
+        self.default_window = default_window
+        self.windows = dict(windows or {})
+        self.max_entries = max_entries
+        self._prefixes = sorted(self.windows, key=len, reverse=True)
+        self._until = OrderedDict()
+
+        # Счетчики для мониторинга
+        self.passed = 0
+        self.suppressed = 0
+        self.suppressed_by_key = Counter()
+
+    def window_for(self, data):
+        """Возвращает (ключ настройки, окно в секундах) для callback_data"""
+        if data in self.windows:
+            return data, self.windows[data]
+        for prefix in self._prefixes:
+            if data.startswith(prefix):
+                return prefix, self.windows[prefix]
+        return None, self.default_window
+
+    def _expire(self, now):
+        while self._until:
+            key, until = next(iter(self._until.items()))
+            if until > now and len(self._until) <= self.max_entries:
+                break
+            del self._until[key]
+
+    def throttled(self, user_id, data, now=None):
+        """Проверяет нажатие; True - нажатие нужно погасить"""
+        now = time.monotonic() if now is None else now
+        self._expire(now)
+        key = (user_id, data)
+        until = self._until.get(key)
+        if until is not None and until > now:
+            self.suppressed += 1
+            self.suppressed_by_key[self.window_for(data)[0] or 'default'] += 1
+            return True
+        window = self.window_for(data)[1]
+        if window > 0:
+            self._until[key] = now + window
+            self._until.move_to_end(key)
+        self.passed += 1
+        return False
+
+    async def on_pre_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        if self.throttled(callback_query.from_user.id, callback_query.data or ''):
+            logger.info(f"Callback {callback_query.data} from {callback_query.from_user.id} throttled")
+            await callback_query.answer()
+            raise CancelHandler()
+
+    def metrics(self):
+        """Возвращает число погашенных нажатий"""
+        return {
+            'tracked': len(self._until),
+            'passed': self.passed,
+            'suppressed': self.suppressed,
+            'suppressed_by_key': dict(self.suppressed_by_key),
+        }
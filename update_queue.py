@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from aiogram import Bot, Dispatcher
+from aiogram.dispatcher.webhook import WebhookRequestHandler
+from aiohttp import web
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Поля Update, в которых есть отправитель (from_user)
+USER_UPDATE_FIELDS = (
+    'message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+    'shipping_query', 'pre_checkout_query', 'poll_answer', 'my_chat_member', 'chat_member',
+    'chat_join_request',
+)
+
+
+def update_user_id(update):
+    """Возвращает id пользователя, от которого пришел update (или update_id)"""
+    for field in USER_UPDATE_FIELDS:
+        event = getattr(update, field, None)
+        if event is None:
+            continue
+        user = getattr(event, 'from_user', None) or getattr(event, 'user', None)
+        if user is not None:
+            return user.id
+    return update.update_id
+
+
+class UpdateQueue:
+    """Очередь входящих update'ов с пулом обработчиков.
+
+    Вебхук только кладет update в очередь и сразу отвечает Telegram.
+    Update'ы распределяются по workers очередям по id пользователя:
+    разные пользователи обрабатываются параллельно, а события одного
+    пользователя - строго по порядку. Очереди ограничены max_size; если
+    очередь заполнена, вебхук ждет свободного места (backpressure).
+    """
+
+    def __init__(self, dispatcher, workers=8, max_size=1000, latency_window=1000):
+        self.dispatcher = dispatcher
+        self.workers = workers
+        self.max_size = max_size
+        self._queues = []
+        self._tasks = []
+        self._latencies = deque(maxlen=latency_window)
+
+        # Счетчики для мониторинга
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.backpressure_waits = 0
+        self.backpressure_ms = 0.0
+
+    def start(self):
+        """Запускает обработчики очереди"""
+        if self._tasks:
+            return
+        per_worker = max(1, self.max_size // self.workers)
+        self._queues = [asyncio.Queue(maxsize=per_worker) for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+        logger.info(f"Update queue started with {self.workers} workers")
+
+    async def stop(self, timeout=10):
+        """Дожидается обработки принятых update'ов и останавливает обработчики"""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Update queue not drained in {timeout}s, {self.depth()} updates dropped")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def depth(self):
+        return sum(queue.qsize() for queue in self._queues)
+
+    async def put(self, update):
+        """Ставит update в очередь его пользователя"""
+        queue = self._queues[update_user_id(update) % self.workers]
+        item = (update, time.monotonic())
+        try:
+            queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.backpressure_waits += 1
+            started = time.perf_counter()
+            await queue.put(item)
+            self.backpressure_ms += (time.perf_counter() - started) * 1000
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self.depth())
+
+    async def _worker(self, queue):
+        Dispatcher.set_current(self.dispatcher)
+        Bot.set_current(self.dispatcher.bot)
+        while True:
+            update, enqueued_at = await queue.get()
+            try:
+                await self.dispatcher.updates_handler.notify(update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Error processing update {update.update_id}: {e}")
+            finally:
+                self._latencies.append(time.monotonic() - enqueued_at)
+                queue.task_done()
+
+    @property
+    def request_handler(self):
+        """Класс обработчика вебхука, привязанный к этой очереди"""
+        return type('BoundQueuedWebhookRequestHandler', (QueuedWebhookRequestHandler,), {'update_queue': self})
+
+    def metrics(self):
+        """Возвращает глубину очереди, backpressure и задержку обработки"""
+        latencies = sorted(self._latencies)
+
+        def percentile(p):
+            if not latencies:
+                return 0.0
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 1)
+
+        return {
+            'depth': self.depth(),
+            'max_depth': self.max_depth,
+            'enqueued': self.enqueued,
+            'processed': self.processed,
+            'failed': self.failed,
+            'backpressure_waits': self.backpressure_waits,
+            'backpressure_ms': round(self.backpressure_ms, 1),
+            'latency_p50_ms': percentile(0.5),
+            'latency_p95_ms': percentile(0.95),
+            'latency_max_ms': percentile(1.0),
+        }
+
+
+class QueuedWebhookRequestHandler(WebhookRequestHandler):
+    """Вебхук с быстрым ответом: update проверяется, ставится в очередь и сразу подтверждается"""
+
+    update_queue = None
+
+    async def post(self):
+        self.validate_ip()
+        dispatcher = self.get_dispatcher()
+        try:
+            update = await self.parse_update(dispatcher.bot)
+        except Exception as e:
+            logger.warning(f"Invalid update received: {e}")
+            return web.Response(status=400, text='bad update')
+
+        await self.update_queue.put(update)
+
+        web_response = web.Response(text='ok')
+        if self.request.app.get('RETRY_AFTER', None):
+            web_response.headers['Retry-After'] = str(self.request.app['RETRY_AFTER'])
+        return web_response